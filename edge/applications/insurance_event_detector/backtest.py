@@ -0,0 +1,339 @@
+import csv
+import time
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from applications.insurance_event_detector import instrumentation
+from applications.insurance_event_detector.event_detector import RiskEvent, order_events, setup_signal_history, setup_signal_ids
+from recording.columnar import ColumnarRecording, is_columnar_recording
+
+# Batch backtesting: re-scores a whole recording at once instead of feeding it row by row
+# through risk_event_detector.
+#
+# - The recording is loaded into columnar arrays, and the history of every signal is kept as one array of samples.
+# - For every event, the start and end conditions are evaluated as whole-array operations at all rows that
+#   would have triggered an evaluation in the streaming path, i.e. the updates of its relevant signals and the
+#   rows at which an event it depends on flipped. Events are processed in topological order, so these are known.
+# - Only the rows where a condition set passes are walked in Python, to apply the running state and the timeout.
+#
+# The result is the same sequence of RiskEvents as process_sample_file produces for the same recording, also in
+# frame mode, where an event is evaluated once at the last row of each frame (run of rows with the same timestamp).
+# With instrumentation enabled, the same per event counters as in the streaming path are recorded.
+
+
+# A recording in columnar form. Signal names are interned, signal_ids index into names.
+class Recording:
+
+    def __init__(self, names, signal_ids, timestamps, values):
+        self.names = names
+        self.signal_ids = signal_ids
+        self.timestamps = timestamps
+        self.values = values
+
+    def __len__(self):
+        return len(self.signal_ids)
+
+
+def load_csv_recording(filename):
+    """
+    Loads a recording in the source_id, signal, timestamp, value CSV format into columnar arrays.
+    """
+    name_ids = {}
+    signal_ids = []
+    timestamps = []
+    values = []
+    with open(filename, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        # Ignore the first line, which is the header
+        next(reader)
+        for row in reader:
+            signal_ids.append(name_ids.setdefault(row[1], len(name_ids)))
+            timestamps.append(float(row[2]))
+            values.append(float(row[3]))
+    return Recording(
+        list(name_ids),
+        np.array(signal_ids, dtype=np.int32),
+        np.array(timestamps, dtype=np.float64),
+        np.array(values, dtype=np.float64)
+    )
+
+
+def load_recording(filename):
+    """
+    Loads a recording in either the CSV or the columnar format.
+    Columnar recordings stay memory mapped, nothing is parsed.
+    """
+    if is_columnar_recording(filename):
+        recording = ColumnarRecording(filename)
+        return Recording(recording.signals, recording.signal_ids, recording.timestamps, recording.values)
+    return load_csv_recording(filename)
+
+
+class _SignalColumns:
+    """
+    History of the signals of a recording, with the rows at which each sample arrived.
+    """
+
+    def __init__(self, recording, signal_names, hist_signals):
+        self.hist_signals = hist_signals
+        self.samples = {}
+        self.sample_rows = {}
+        self.sample_timestamps = {}
+        for signal_id, name in enumerate(recording.names):
+            if name in signal_names:
+                rows = np.flatnonzero(recording.signal_ids == signal_id)
+                self.samples[name] = recording.values[rows]
+                self.sample_rows[name] = rows
+                self.sample_timestamps[name] = recording.timestamps[rows]
+        self._tables = {}
+        self._prefix_sums = {}
+
+    def counts(self, name, rows):
+        """
+        Number of samples of a signal received up to and including each of the rows.
+        """
+        sample_rows = self.sample_rows.get(name)
+        if sample_rows is None:
+            return np.zeros(len(rows), dtype=np.int64)
+        return np.searchsorted(sample_rows, rows, side='right')
+
+    def values(self, name, method, context_length, rows):
+        """
+        Processed value of a signal at each of the rows, 0 where there is not enough data, as in the streaming path.
+        """
+        counts = self.counts(name, rows)
+        # The streaming history holds at most hist_signals samples
+        valid = np.minimum(counts, self.hist_signals) >= context_length
+        result = np.zeros(len(rows))
+        if not valid.any():
+            return result
+        table = self._table(name, method, context_length)
+        result[valid] = table[counts[valid] - context_length]
+        return result
+
+    def window_starts(self, name, window, counts):
+        """
+        First sample of the window of window seconds ending at the latest of counts samples, for each of the counts.
+        """
+        sample_timestamps = self.sample_timestamps[name]
+        return np.searchsorted(sample_timestamps, sample_timestamps[counts - 1] - window, side='right')
+
+    def time_values(self, name, method, window, rows):
+        """
+        Processed value of a signal over a window of seconds at each of the rows, 0 where there is not enough data.
+        """
+        counts = self.counts(name, rows)
+        result = np.zeros(len(rows))
+        if not counts.any():
+            return result
+        sample_timestamps = self.sample_timestamps[name]
+        samples = self.samples[name]
+        # Enough data once the signal has been recorded for the whole window
+        valid = counts > 0
+        valid[valid] = sample_timestamps[0] <= sample_timestamps[counts[valid] - 1] - window
+        counts = counts[valid]
+        if not len(counts):
+            return result
+        starts = self.window_starts(name, window, counts)
+        if method == "prev":
+            result[valid] = samples[starts - 1]
+        elif method == "mean":
+            sums, nans = self._prefix_sum(name)
+            means = (sums[counts] - sums[starts]) / (counts - starts)
+            means[nans[counts] > nans[starts]] = np.nan
+            result[valid] = means
+        else:
+            # Reduce the window of every row at once, the reduction of (start, count) is the window and the
+            # reduction from count to the next start is dropped. The extra sample keeps the last count in bounds.
+            bounds = np.empty(2 * len(counts), dtype=np.int64)
+            bounds[0::2] = starts
+            bounds[1::2] = counts
+            reduce = np.minimum if method == "min" else np.maximum
+            result[valid] = reduce.reduceat(np.append(samples, np.nan), bounds)[0::2]
+        return result
+
+    def _prefix_sum(self, name):
+        # Sums of the samples and numbers of nan samples before each sample, nan samples counting as 0 in the sums
+        prefix = self._prefix_sums.get(name)
+        if prefix is None:
+            samples = self.samples[name]
+            is_nan = np.isnan(samples)
+            prefix = (np.concatenate(([0.0], np.cumsum(np.where(is_nan, 0.0, samples)))), np.concatenate(([0], np.cumsum(is_nan))))
+            self._prefix_sums[name] = prefix
+        return prefix
+
+    def _table(self, name, method, context_length):
+        # Value of (method, context_length) for each window of samples, indexed by the first sample of the window
+        key = (name, method, context_length)
+        table = self._tables.get(key)
+        if table is None:
+            samples = self.samples[name]
+            if not method or method == "prev":
+                # The current value is the last sample of a window of 1, prev the first sample of the window
+                table = samples
+            else:
+                windows = sliding_window_view(samples, context_length)
+                if method == "mean":
+                    table = windows.mean(axis=1)
+                elif method == "min":
+                    table = windows.min(axis=1)
+                else:
+                    table = windows.max(axis=1)
+            self._tables[key] = table
+        return table
+
+
+def _compare(values, operator, cond_value):
+    if operator == "eq":
+        return values == cond_value
+    elif operator == "gt":
+        return values > cond_value
+    elif operator == "lt":
+        return values < cond_value
+    else:
+        return (values > cond_value[0]) & (values < cond_value[1])
+
+
+def _record_evaluations(event, event_timestamps, start_positions, end_positions, trigger_positions, elapsed_ns):
+    # Replays the state of the event at each of its rows: the triggers before a row give its running state and
+    # timeout, like in the streaming path, where it is only evaluated past the timeout
+    positions = np.arange(len(event_timestamps))
+    trigger_positions = np.array(trigger_positions, dtype=np.int64)
+    previous = np.searchsorted(trigger_positions, positions, side='left') - 1
+    timeouts = np.where(previous >= 0, event_timestamps[trigger_positions[previous]] + event.timeout, 0)
+    due = event_timestamps > timeouts
+    running = (previous % 2 == 0) if event.toggles else np.zeros(len(positions), dtype=bool)
+    start_due = due & ~running
+    end_due = due & running
+    stats = instrumentation.stats_for(event.name)
+    stats.record_evaluations(
+        int(start_due.sum()),
+        int(start_due[start_positions].sum()),
+        int(end_due.sum()),
+        int(end_due[end_positions].sum()),
+        elapsed_ns
+    )
+    stats.timeout_suppressions += int((~due).sum())
+
+
+def run_backtest(recording, event_dict, hist_signals, callback, frames=False):
+    """
+    Evaluates all events of event_dict over the recording and calls callback with every RiskEvent,
+    in the same order as the streaming detector would, with or without frames.
+    The running state of the definitions in event_dict is not modified.
+    """
+    signal_ids = setup_signal_ids(setup_signal_history(event_dict, hist_signals))
+    signal_names = set(signal_ids)
+    columns = _SignalColumns(recording, signal_names, hist_signals)
+
+    # Rows of signals that are not tracked are dropped by the streaming path before detection
+    known = np.array([name in signal_names for name in recording.names], dtype=bool)
+    tracked_rows = np.flatnonzero(known[recording.signal_ids]) if len(recording) else np.zeros(0, dtype=np.int64)
+    timestamps = recording.timestamps
+    monotonic = bool(np.all(np.diff(timestamps[tracked_rows]) >= 0))
+    if frames:
+        # Last tracked row of the frame of every tracked row, which is where the frame is evaluated
+        tracked_timestamps = timestamps[tracked_rows]
+        ends = np.append(np.flatnonzero(tracked_timestamps[1:] != tracked_timestamps[:-1]), len(tracked_rows) - 1)
+        frame_ends = tracked_rows[ends[np.searchsorted(ends, np.arange(len(tracked_rows)))]]
+
+    ordered_events = order_events(event_dict)
+    event_order = {event.name: i for i, event in enumerate(ordered_events)}
+    # Rows at which the running state of an event flipped, used by event_name conditions
+    flips = {}
+    triggers = []
+
+    for event in ordered_events:
+        name = event.name
+        relevant_ids = [i for i, s in enumerate(recording.names) if s in event.relevant_signals]
+        relevant = np.isin(recording.signal_ids[tracked_rows], relevant_ids)
+        rows = np.unique(frame_ends[relevant]) if frames else tracked_rows[relevant]
+        for upstream in event.upstream_events:
+            rows = np.union1d(rows, flips[upstream])
+
+        def passes(conditions):
+            mask = np.ones(len(rows), dtype=bool)
+            for cond in conditions:
+                if cond.get("window") is not None:
+                    values = columns.time_values(cond["signal_name"], cond["method"], cond["window"], rows)
+                elif cond.get("signal_name", False):
+                    values = columns.values(cond["signal_name"], cond["method"], cond["context_length"], rows)
+                else:
+                    # Upstream events are evaluated first in the streaming path, so their state after the row is seen
+                    values = (np.searchsorted(flips[cond["event_name"]], rows, side='right') % 2).astype(float)
+                mask &= _compare(values, cond["operator"], cond["value"])
+            return np.flatnonzero(mask)
+
+        # Scalar searches below run on lists, bisect is much cheaper than numpy for single lookups
+        evaluation_start = time.perf_counter_ns()
+        start_positions = passes(event.startConditions).tolist()
+        end_positions = passes(event.endConditions).tolist() if event.toggles else []
+        elapsed = time.perf_counter_ns() - evaluation_start
+        event_timestamps = timestamps[rows].tolist()
+        event_rows = rows.tolist()
+
+        running = False
+        timeout = 0
+        position = 0
+        event_flips = []
+        trigger_positions = []
+        while True:
+            candidates = end_positions if running else start_positions
+            i = bisect_left(candidates, position)
+            if i == len(candidates):
+                break
+            p = candidates[i]
+            timestamp = event_timestamps[p]
+            if timestamp <= timeout:
+                # Suppressed by the timeout, skip ahead to the first row past it
+                position = p + 1
+                if monotonic:
+                    position = max(position, bisect_right(event_timestamps, timeout))
+                continue
+            if event.toggles:
+                running = not running
+                event_flips.append(event_rows[p])
+            timeout = timestamp + event.timeout
+            triggers.append((event_rows[p], event_order[name], event, running))
+            trigger_positions.append(p)
+            position = p + 1
+        flips[name] = np.array(event_flips, dtype=np.int64)
+        if instrumentation.enabled:
+            _record_evaluations(event, timestamps[rows], start_positions, end_positions, trigger_positions, elapsed)
+
+    triggers.sort(key=lambda t: (t[0], t[1]))
+    trigger_rows = np.array([t[0] for t in triggers], dtype=np.int64)
+    captured = {s for _, _, event, _ in triggers for s in event.eventData}
+    trigger_counts = {s: columns.counts(s, trigger_rows).tolist() for s in captured}
+    empty = np.zeros(0)
+
+    for t, (row, _, event, running) in enumerate(triggers):
+        collect_start = time.perf_counter_ns()
+        callback_data = {}
+        for s, l in event.eventData.items():
+            count = trigger_counts[s][t]
+            samples = columns.samples.get(s, empty)
+            if isinstance(l, dict):
+                start = columns.window_starts(s, l["window"], np.array([count]))[0] if count else 0
+                callback_data[signal_ids[s]] = samples[start:count].tolist()
+            elif l == 1:
+                if count == 0:
+                    raise IndexError(f"No value of {s} available for event {event.name}.")
+                callback_data[signal_ids[s]] = samples[count - 1]
+            else:
+                callback_data[signal_ids[s]] = samples[max(0, count - min(l, hist_signals)):count].tolist()
+        if running:
+            callback_data["start"] = True
+        if instrumentation.enabled:
+            instrumentation.stats_for(event.name).record_trigger(time.perf_counter_ns() - collect_start)
+        callback(
+            RiskEvent(
+                event.name,
+                event.eventId,
+                event.riskLevel,
+                float(timestamps[row]),
+                callback_data
+            )
+        )
@@ -0,0 +1,275 @@
+import time
+
+import numpy as np
+
+from applications.insurance_event_detector import instrumentation
+from applications.insurance_event_detector.event_definitions import ConditionNodes, default_condition_nodes
+from applications.insurance_event_detector.event_detector import RiskEvent, order_events
+from applications.insurance_event_detector.signal_registry import default_registry
+
+# Matrix form of the start and end conditions of all events, an alternative to check_condition for large rule sets.
+#
+# - Every distinct value read by a condition, a signal with method and context_length or window, or the running
+#   state of an event, gets a slot in a value vector. Signal slots are computed by the shared value nodes of the
+#   event definitions (ConditionNodes). Slots without enough data hold 0, like False in the streaming path.
+# - Each condition becomes a row of the condition tables: slot, lower and upper bound and the condition set it
+#   belongs to. Events are indexed in topological order, the start conditions of the i-th event form set 2 * i, its
+#   end conditions set 2 * i + 1, so the rows of a set are contiguous. Every operator is lowered to
+#   lower <= value <= upper, strict bounds being moved to the next float, so nan never passes.
+# - The result of every row and set is kept. When a signal is updated, only the rows reading it and the sets they
+#   belong to are evaluated again, in a few vectorized operations. The same happens for the rows reading the
+#   running state of an event when it flips.
+# - Detection selects the events past their timeout whose current condition set passes with one vectorized
+#   lookup, only the events that trigger are handled in Python.
+#
+# The running states and timeouts of the events are mirrored in arrays. The matrix keeps them in sync with the
+# event definitions and timeout_dict as long as it is the only one changing them, call sync after resetting the
+# events otherwise. The risk events are the same as with detect_events.
+#
+# With instrumentation enabled, the time of the updates and of the selection is spread evenly over the events
+# evaluated, the counters are the same as with detect_events.
+
+
+def _bounds(operator, value):
+    # Lowers a comparison to lower <= v <= upper
+    if operator == "eq":
+        return value, value
+    elif operator == "gt":
+        return np.nextafter(value, np.inf), np.inf
+    elif operator == "lt":
+        return -np.inf, np.nextafter(value, -np.inf)
+    elif operator == "bt":
+        low, high = value
+        return np.nextafter(low, np.inf), np.nextafter(high, -np.inf)
+    raise ValueError(f"Condition parameter {operator} unsupported. Supported are [eq, gt, lt, bt].")
+
+
+class ConditionMatrix:
+
+    def __init__(self, event_dict, signal_history, registry=None, nodes=None):
+        if registry is None:
+            registry = default_registry()
+        if nodes is None:
+            nodes = default_condition_nodes() if registry is default_registry() else ConditionNodes(registry)
+        self.event_dict = event_dict
+        self.signal_history = signal_history
+        # Sorted event indices are in topological order
+        self.events = order_events(event_dict)
+        self.event_index = {event.name: i for i, event in enumerate(self.events)}
+
+        slots = {}
+        # Value nodes of the slots of every signal id, as (slot, node), and slots of the running state of events
+        signal_slots = {}
+        self.event_slots = {}
+        slot, lower, upper, condition_set = [], [], [], []
+
+        for i, event in enumerate(self.events):
+            for set_index, conditions in ((2 * i, event.startConditions), (2 * i + 1, event.endConditions)):
+                for cond in conditions:
+                    signal_name = cond.get("signal_name", False)
+                    if signal_name:
+                        key = (registry.id_of(signal_name), cond["method"], cond.get("context_length"), cond.get("window"))
+                    else:
+                        key = cond["event_name"]
+                    if key not in slots:
+                        slots[key] = len(slots)
+                        if signal_name:
+                            signal_slots.setdefault(key[0], []).append((slots[key], nodes.value(*key)))
+                        else:
+                            self.event_slots[self.event_index[key]] = slots[key]
+                    low, high = _bounds(cond["operator"], cond["value"])
+                    slot.append(slots[key])
+                    lower.append(low)
+                    upper.append(high)
+                    condition_set.append(set_index)
+
+        self.slot = np.array(slot, dtype=np.int64)
+        self.lower = np.array(lower, dtype=np.float64)
+        self.upper = np.array(upper, dtype=np.float64)
+        self.condition_set = np.array(condition_set, dtype=np.int64)
+        self.values = np.zeros(len(slots))
+        self.passed = np.ones(len(slot), dtype=bool)
+        # Empty sets pass, as check_condition does without conditions
+        self.set_passed = np.ones(2 * len(self.events), dtype=bool)
+        sets = np.arange(2 * len(self.events))
+        self._set_start = np.searchsorted(self.condition_set, sets, side='left')
+        self._set_end = np.searchsorted(self.condition_set, sets, side='right')
+
+        # Everything an update of a signal touches: its value nodes, the plan to evaluate its rows again and the
+        # events depending on it
+        self.signal_updates = {}
+        for signal_id, nodes_of_signal in signal_slots.items():
+            events = sorted(self.event_index[event.name] for event in self.events if signal_id in event.relevant_signal_ids)
+            self.signal_updates[signal_id] = (tuple(nodes_of_signal), self._plan([s for s, _ in nodes_of_signal]), np.array(events, dtype=np.int64))
+        # Plans of the rows reading the running state of an event, and the events depending on it
+        self.event_updates = {}
+        for i, event_slot in self.event_slots.items():
+            dependents = sorted(self.event_index[event.name] for event in self.events if self.events[i].name in event.upstream_events)
+            self.event_updates[i] = (self._plan([event_slot]), np.array(dependents, dtype=np.int64))
+
+        self.state = np.zeros(len(self.events), dtype=np.int64)
+        self.timeouts = np.zeros(len(self.events))
+        self._timeout_dict = None
+        # Time spent in updates since the last detection, while instrumented
+        self._update_time_ns = 0
+        self.sync()
+
+    def _plan(self, slots):
+        # Rows reading the slots with their bounds, and the rows of the sets they belong to to reduce per set.
+        # When the sets only consist of these rows, the reduction is done on the fresh results directly.
+        rows = np.flatnonzero(np.isin(self.slot, slots))
+        sets = np.unique(self.condition_set[rows])
+        lengths = self._set_end[sets] - self._set_start[sets]
+        gather = np.concatenate([np.arange(self._set_start[s], self._set_end[s]) for s in sets]) if len(sets) else rows
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        if np.array_equal(gather, rows):
+            gather = None
+        return rows, self.slot[rows], self.lower[rows], self.upper[rows], gather, offsets, sets
+
+    def _evaluate(self, plan):
+        rows, slot, lower, upper, gather, offsets, sets = plan
+        if not len(rows):
+            return
+        v = self.values[slot]
+        passed = (v >= lower) & (v <= upper)
+        if gather is None:
+            self.set_passed[sets] = np.logical_and.reduceat(passed, offsets)
+        else:
+            self.passed[rows] = passed
+            self.set_passed[sets] = np.logical_and.reduceat(self.passed[gather], offsets)
+
+    def sync(self):
+        """
+        Reloads the running states of the events and evaluates all conditions again.
+        """
+        for i, event in enumerate(self.events):
+            self.state[i] = 2 * i + event.running
+        for i, event_slot in self.event_slots.items():
+            self.values[event_slot] = 1.0 if self.events[i].running else 0.0
+        for signal_id in self.signal_updates:
+            if self.signal_history[signal_id] is not None:
+                self.update(signal_id)
+        for plan, _ in self.event_updates.values():
+            self._evaluate(plan)
+
+    def update(self, signal_id):
+        """
+        Refreshes the slots of a signal and evaluates the conditions reading them, call it after every update of the
+        signal history.
+        """
+        signal_update = self.signal_updates.get(signal_id)
+        if signal_update is None:
+            return
+        nodes_of_signal, plan, _ = signal_update
+        if instrumentation.enabled:
+            start = time.perf_counter_ns()
+        values = self.values
+        for slot, node in nodes_of_signal:
+            values[slot] = node(self.signal_history, self.event_dict)
+        self._evaluate(plan)
+        if instrumentation.enabled:
+            self._update_time_ns += time.perf_counter_ns() - start
+
+    def evaluate(self):
+        """
+        Returns an array telling for every condition set if all of its conditions pass. Sets 2 * i and 2 * i + 1 are
+        the start and end conditions of the i-th event of the topological order (see event_index).
+        """
+        return self.set_passed
+
+    def detect_signal(self, signal_id, timeout_dict, timestamp, callback):
+        """
+        Same as detect_events for the events depending on a signal, after update(signal_id).
+        """
+        signal_update = self.signal_updates.get(signal_id)
+        if signal_update is not None:
+            self._detect(signal_update[2], timeout_dict, timestamp, callback)
+
+    def detect(self, events, timeout_dict, timestamp, callback):
+        """
+        Same as detect_events, for events of the event_dict of this matrix.
+        """
+        index = self.event_index
+        self._detect(np.sort(np.fromiter((index[event.name] for event in events), np.int64, len(events))), timeout_dict, timestamp, callback)
+
+    def _detect(self, indices, timeout_dict, timestamp, callback):
+        if timeout_dict is not self._timeout_dict:
+            self.timeouts[:] = [timeout_dict[event.name] for event in self.events]
+            self._timeout_dict = timeout_dict
+        if instrumentation.enabled:
+            return self._instrumented_detect(indices, timeout_dict, timestamp, callback)
+        triggered = indices[(self.timeouts[indices] < timestamp) & self.set_passed[self.state[indices]]]
+        for i in triggered.tolist():
+            event = self.events[i]
+            if event.toggles:
+                event.running = not event.running
+                self.state[i] ^= 1
+            timeout = timestamp + event.timeout
+            self.timeouts[i] = timeout
+            timeout_dict[event.name] = timeout
+            callback(
+                RiskEvent(
+                    event.name,
+                    event.eventId,
+                    event.riskLevel,
+                    timestamp,
+                    event.collect_callback_data(self.signal_history)
+                )
+            )
+            event_update = self.event_updates.get(i)
+            if event.toggles and event_update is not None:
+                # Only dependents read the running state, evaluate them against the new state
+                plan, dependents = event_update
+                self.values[self.event_slots[i]] = 1.0 if event.running else 0.0
+                self._evaluate(plan)
+                return self._detect(np.union1d(indices[indices > i], dependents), timeout_dict, timestamp, callback)
+
+    # Same as _detect, recording per event statistics in the instrumentation module
+    def _instrumented_detect(self, indices, timeout_dict, timestamp, callback):
+        clock = time.perf_counter_ns
+        start = clock()
+        state = self.state[indices]
+        due = self.timeouts[indices] < timestamp
+        passed = self.set_passed[state]
+        triggered = indices[due & passed]
+        share = (clock() - start + self._update_time_ns) // max(1, int(due.sum()))
+        self._update_time_ns = 0
+        for i in triggered.tolist():
+            event = self.events[i]
+            if event.toggles:
+                event.running = not event.running
+                self.state[i] ^= 1
+            timeout = timestamp + event.timeout
+            self.timeouts[i] = timeout
+            timeout_dict[event.name] = timeout
+            start = clock()
+            callback_data = event.collect_callback_data(self.signal_history)
+            instrumentation.stats_for(event.name).record_trigger(clock() - start)
+            callback(
+                RiskEvent(
+                    event.name,
+                    event.eventId,
+                    event.riskLevel,
+                    timestamp,
+                    callback_data
+                )
+            )
+            event_update = self.event_updates.get(i)
+            if event.toggles and event_update is not None:
+                # The events after this one are evaluated again against the new state, only count them there
+                self._record(indices, state, due, passed, share, i)
+                plan, dependents = event_update
+                self.values[self.event_slots[i]] = 1.0 if event.running else 0.0
+                self._evaluate(plan)
+                return self._instrumented_detect(np.union1d(indices[indices > i], dependents), timeout_dict, timestamp, callback)
+        self._record(indices, state, due, passed, share)
+
+    def _record(self, indices, state, due, passed, share, last=None):
+        for i, s, d, p in zip(indices.tolist(), state.tolist(), due.tolist(), passed.tolist()):
+            if last is not None and i > last:
+                break
+            stats = instrumentation.stats_for(self.events[i].name)
+            if d:
+                stats.record_evaluation(s & 1, p, share)
+            else:
+                stats.timeout_suppressions += 1
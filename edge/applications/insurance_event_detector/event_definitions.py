@@ -1,51 +1,228 @@
-
-import numpy as np
-
-
-def process_signal_data(condition, signal_data):
-    method = condition["method"]
-    context_length = condition["context_length"]
+import copy
+
+from applications.insurance_event_detector.signal_registry import default_registry
+
+
+# Conditions are compiled once, when the EventDefinition is created, into closures.
+# All validation happens at compile time, so a malformed rule fails when it is loaded and
+# evaluating a condition does neither dict lookups nor string compares on the condition itself.
+# Signals are resolved to their ids in the signal registry, which index the signal history.
+#
+# Conditions of all event definitions are compiled into shared nodes (ConditionNodes): identical values of a
+# signal (signal, method, context_length or window) and identical comparisons are compiled once and reused by every
+# rule. Signal nodes compute their result once per update of the signal and return the cached result until the next one.
+#
+# Instead of a context_length in samples, a condition can give a window in seconds, e.g. "mean" over the last 30
+# seconds or the "prev" value 0.5 seconds ago. Windows end at the timestamp of the latest sample of the signal:
+# mean, min and max cover the samples after latest timestamp - window, prev is the value the signal had at that time.
+# There is enough data once the signal has been recorded for the whole window. Likewise, eventData can capture
+# {"window": seconds} instead of a number of samples. Signals used with windows keep a TimedSignalBuffer.
+
+# Methods that are computed over a window and maintained incrementally by the signal history
+AGGREGATE_METHODS = ("mean", "min", "max")
+
+def compile_signal_value(signal_id, method, context_length, window=None):
+    """
+    Returns a function that computes the (processed) value of a signal from the signal history.
+    The function returns False when there is not enough data available.
+    """
+    if window is not None:
+        return compile_window_value(signal_id, method, context_length, window)
+    if context_length is None:
+        raise ValueError("Either context_length or window must be given when a signal is used.")
     if method:
         if context_length <= 1:
             raise ValueError("Context length must be above 1 when a method is applied.")
         if method == "prev":
-            processed_signal_value = signal_data[-context_length]
+            def process(signal_data):
+                return signal_data.back(context_length)
         elif method == "mean":
-            processed_signal_value = np.mean(signal_data[-context_length:])
+            def process(signal_data):
+                return signal_data.mean(context_length)
         elif method == "min":
-            processed_signal_value = min(signal_data[-context_length:])
+            def process(signal_data):
+                return signal_data.min(context_length)
         elif method == "max":
-            processed_signal_value = max(signal_data[-context_length:])
+            def process(signal_data):
+                return signal_data.max(context_length)
         else:
             raise ValueError(f"Method {method} is not supported. Supported methods are: [prev, mean, min, max].")
-    
+
     else:
         if context_length != 1:
             raise ValueError("Context length must be 1 if no method is applied.")
-        processed_signal_value = signal_data[-1]
-        
-    return processed_signal_value
+        def process(signal_data):
+            return signal_data.last()
 
-def get_signal_value(cond, signal_dict, event_dict):
-    signal_name = cond.get("signal_name", False)
-    if signal_name:
-        signal_data = signal_dict[signal_name]
-        if len(signal_data) < cond["context_length"]:
+    def get_value(signal_history, event_dict):
+        signal_data = signal_history[signal_id]
+        if len(signal_data) < context_length:
+            # Not enough data available
+            return False
+        return process(signal_data)
+
+    return get_value
+
+def compile_window_value(signal_id, method, context_length, window):
+    """
+    Same as compile_signal_value for a window in seconds. The history of the signal must be a TimedSignalBuffer.
+    """
+    if context_length is not None:
+        raise ValueError("Only one of context_length and window can be given.")
+    if not window > 0:
+        raise ValueError("Window must be a positive number of seconds.")
+    if method == "prev":
+        def process(signal_data):
+            return signal_data.value_at(signal_data.last_timestamp - window)
+    elif method == "mean":
+        def process(signal_data):
+            return signal_data.mean_over(window)
+    elif method == "min":
+        def process(signal_data):
+            return signal_data.min_over(window)
+    elif method == "max":
+        def process(signal_data):
+            return signal_data.max_over(window)
+    elif not method:
+        raise ValueError("A method must be applied when a window is given.")
+    else:
+        raise ValueError(f"Method {method} is not supported. Supported methods are: [prev, mean, min, max].")
+
+    def get_value(signal_history, event_dict):
+        signal_data = signal_history[signal_id]
+        if not signal_data.covers(window):
             # Not enough data available
             return False
-        signal_value = process_signal_data(cond, signal_data)
+        return process(signal_data)
+
+    return get_value
+
+def compile_event_value(event_name):
+    """
+    Returns a function that reports 1 while the event is running and 0 otherwise.
+    """
+    def get_value(signal_history, event_dict):
+        return 1 if event_dict[event_name].running else 0
+
+    return get_value
+
+def cache_per_update(signal_id, compute):
+    """
+    Wraps compute(signal_history, event_dict), which only depends on the history of signal_id, so that it runs once
+    per update of that signal. Until the next update, the cached result is returned.
+    """
+    cached_generation = 0
+    cached_result = None
+
+    def get(signal_history, event_dict):
+        nonlocal cached_generation, cached_result
+        # Generations are unique across buffers, so this also tells apart the histories of different vehicles
+        generation = signal_history[signal_id].generation
+        if generation != cached_generation:
+            cached_result = compute(signal_history, event_dict)
+            cached_generation = generation
+        return cached_result
+
+    return get
+
+def compile_condition(cond, registry, nodes=None):
+    """
+    Compiles a condition dict into a predicate taking (signal_history, event_dict).
+    Comparisons involving nan are always false, which prevents positive events with nan.
+    With nodes, the value of the signal is the shared node of nodes.
+    """
+    signal_name = cond.get("signal_name", False)
+    if signal_name:
+        if nodes is not None:
+            get_value = nodes.value(registry.id_of(signal_name), cond["method"], cond.get("context_length"), cond.get("window"))
+        else:
+            get_value = compile_signal_value(registry.id_of(signal_name), cond["method"], cond.get("context_length"), cond.get("window"))
     else:
         event_name = cond.get("event_name", False)
         if not event_name:
             raise ValueError("Either signal_name or event_name must be specified in a condition.")
-        signal_value = 1 if event_dict[event_name].running else 0
-    return signal_value
-
+        get_value = compile_event_value(event_name)
+
+    operator = cond["operator"]
+    cond_value = cond["value"]
+    if operator == "eq":
+        def predicate(signal_history, event_dict):
+            return get_value(signal_history, event_dict) == cond_value
+    elif operator == "gt":
+        def predicate(signal_history, event_dict):
+            return get_value(signal_history, event_dict) > cond_value
+    elif operator == "lt":
+        def predicate(signal_history, event_dict):
+            return get_value(signal_history, event_dict) < cond_value
+    elif operator == "bt":
+        if type(cond_value) != tuple or len(cond_value) != 2:
+            raise ValueError(f"Value must be a tuple when operator is 'bt'. Given is: {cond_value}")
+        low, high = cond_value
+        def predicate(signal_history, event_dict):
+            return low < get_value(signal_history, event_dict) < high
+    else:
+        raise ValueError(f"Condition parameter {operator} unsupported. Supported are [eq, gt, lt, bt].")
+
+    return predicate
+
+
+class ConditionNodes:
+    """
+    Shared nodes of the conditions of all event definitions compiled against a registry.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.values = {}
+        self.conditions = {}
+
+    def value(self, signal_id, method, context_length, window=None):
+        """
+        Returns the node computing the (processed) value of a signal, cached per update of the signal.
+        """
+        key = (signal_id, method, context_length, window)
+        node = self.values.get(key)
+        if node is None:
+            node = self.values[key] = cache_per_update(signal_id, compile_signal_value(signal_id, method, context_length, window))
+        return node
+
+    def condition(self, cond):
+        """
+        Returns the predicate of a condition, shared by all identical conditions.
+        Predicates on signals are cached per update of the signal, predicates on events are not, as they read the
+        running state of the event.
+        """
+        value = cond.get("value")
+        if isinstance(value, list):
+            # Not hashable, and not a valid value either, let compile_condition report it
+            return compile_condition(cond, self.registry, self)
+        signal_name = cond.get("signal_name", False)
+        key = (signal_name, cond.get("event_name", False), cond.get("method"), cond.get("context_length"), cond.get("window"), cond.get("operator"), value)
+        predicate = self.conditions.get(key)
+        if predicate is None:
+            predicate = compile_condition(cond, self.registry, self)
+            if signal_name:
+                predicate = cache_per_update(self.registry.id_of(signal_name), predicate)
+            self.conditions[key] = predicate
+        return predicate
+
+
+_default_condition_nodes = None
+
+
+def default_condition_nodes():
+    """
+    Returns the shared nodes of all event definitions compiled against the default registry.
+    """
+    global _default_condition_nodes
+    if _default_condition_nodes is None:
+        _default_condition_nodes = ConditionNodes(default_registry())
+    return _default_condition_nodes
 
        
 class EventDefinition:
 
-    def __init__(self, name, eventId, riskLevel, startConditions, endConditions, eventData, timeout):
+    def __init__(self, name, eventId, riskLevel, startConditions, endConditions, eventData, timeout, registry=None, nodes=None):
         self.name = name
         self.eventId = eventId
         self.riskLevel = riskLevel
@@ -56,53 +233,77 @@ class EventDefinition:
         
         self.relevant_signals = list(set([c.get("signal_name", False) for c in self.startConditions if c.get("signal_name", False)] + [c.get("signal_name", False) for c in self.endConditions if c.get("signal_name", False)]))
         self.running = False
+
+        if registry is None:
+            registry = default_registry()
+        self.relevant_signal_ids = [registry.id_of(s) for s in self.relevant_signals]
+        # Signals captured when the event triggers, as (signal_id, length, window), one of length and window is None
+        self.capture = tuple(
+            (registry.id_of(s), None, l["window"]) if isinstance(l, dict) else (registry.id_of(s), l, None)
+            for s, l in self.eventData.items()
+        )
+
+        if nodes is None:
+            nodes = default_condition_nodes() if registry is default_registry() else ConditionNodes(registry)
+        self.start_predicates = tuple(nodes.condition(c) for c in self.startConditions)
+        self.end_predicates = tuple(nodes.condition(c) for c in self.endConditions)
+        # Events referenced in event_name conditions. The events depending on this one and its position in the
+        # topological order of the events are set by setup_event_graph.
+        self.upstream_events = list(dict.fromkeys(c["event_name"] for c in self.startConditions + self.endConditions if not c.get("signal_name", False)))
+        self.dependents = ()
+        self.position = 0
+        self.toggles = len(self.endConditions) > 0
+        # Windowed aggregates used by the conditions, as (signal_id, method, context_length).
+        # They are registered on the signal history so that they are maintained incrementally.
+        signal_conditions = [c for c in self.startConditions + self.endConditions if c.get("signal_name", False)]
+        self.aggregates = list(dict.fromkeys(
+            (registry.id_of(c["signal_name"]), c["method"], c["context_length"])
+            for c in signal_conditions
+            if c["method"] in AGGREGATE_METHODS and c.get("window") is None
+        ))
+        # Aggregates over time windows, as (signal_id, method, window), and the longest window of every signal
+        # used with windows, which is how long the history of the signal has to be retained
+        self.time_aggregates = list(dict.fromkeys(
+            (registry.id_of(c["signal_name"]), c["method"], c["window"])
+            for c in signal_conditions
+            if c["method"] in AGGREGATE_METHODS and c.get("window") is not None
+        ))
+        self.retention = {}
+        windows = [(registry.id_of(c["signal_name"]), c["window"]) for c in signal_conditions if c.get("window") is not None]
+        windows += [(s, window) for s, _, window in self.capture if window is not None]
+        for s, window in windows:
+            if not window > 0:
+                raise ValueError("Window must be a positive number of seconds.")
+            self.retention[s] = max(window, self.retention.get(s, 0))
+        for _, l, _ in self.capture:
+            if l is not None and l < 1:
+                raise ValueError("Length of callback data must be greater 0.")
     
-    def check_condition(self, event_dict, signal_dict):
+    def check_condition(self, event_dict, signal_history):
         if self.running:
-            relevant_conditions = self.endConditions
+            relevant_predicates = self.end_predicates
         else:
-            relevant_conditions = self.startConditions
+            relevant_predicates = self.start_predicates
         
-        for cond in relevant_conditions:
-            signal_value = get_signal_value(cond, signal_dict, event_dict)
-            
-            if signal_value != signal_value:
-                # Prevent positive events with nan
+        for predicate in relevant_predicates:
+            if not predicate(signal_history, event_dict):
                 return False
-            elif cond["operator"] == "eq":
-                if signal_value != cond["value"]:
-                    return False
-            elif cond["operator"] == "gt":
-                if signal_value <= cond["value"]:
-                    return False
-            elif cond["operator"] == "lt":
-                if signal_value >= cond["value"]:
-                    return False
-            elif cond["operator"] == "bt":
-                cond_value = cond["value"]
-                if type(cond_value) != tuple:
-                    raise ValueError(f"Value must be a tuple when operator is 'bt'. Given is: {cond_value}")
-                if signal_value <= cond_value[0] or signal_value >= cond_value[1]:
-                    return False
-            else:
-                raise ValueError(f"Condition parameter {cond[0]} unsupported. Supported are [eq, gt, lt, bt].")
         
-        if len(self.endConditions) > 0:
-            if self.running:
-                self.running = False
-            else:
-                self.running = True
+        if self.toggles:
+            self.running = not self.running
         return True
     
-    def collect_callback_data(self, signal_dict):
+    def collect_callback_data(self, signal_history):
+        # Keyed by signal id, converted to names when the risk event is serialized
         callback_data = {}
-        for s, l in self.eventData.items():
-            if l == 1:
-                callback_data[s] = signal_dict[s][-1]
-            elif l > 1:
-                callback_data[s] = signal_dict[s][-l:]
+        for s, l, window in self.capture:
+            if window is not None:
+                callback_data[s] = signal_history[s].window_values(window).tolist()
+            elif l == 1:
+                callback_data[s] = signal_history[s].last()
             else:
-                raise ValueError("Length of callback data must be greater 0.")
+                # Copy out of the ring buffer, the view is overwritten by later updates
+                callback_data[s] = signal_history[s].last_n(l).tolist()
         if self.running:
             callback_data["start"] = True
         return callback_data
@@ -560,3 +761,24 @@ harsh_cornering = EventDefinition(
 
 ###############################################################################
 
+###### Default event set ######################################################
+
+def create_event_dict():
+    """
+    Returns the default event definitions keyed by name.
+    Each call returns new copies, so every caller keeps its own running state.
+    """
+    return copy.deepcopy({
+        "speeding": speeding,
+        "massive_speeding": massive_speeding,
+        "cruise_control_activated": cruise_control_activated,
+        "tcs_activated": tcs_activated,
+        "esc_activated": esc_activated,
+        "performance_mode_activated": performance_mode_activated,
+        "autobahn": autobahn,
+        "traffic_jam": traffic_jam,
+        "no_seatbelt": no_seatbelt,
+        "harsh_braking": harsh_braking,
+        "harsh_acceleration": harsh_acceleration,
+        "harsh_cornering": harsh_cornering,
+        })
@@ -1,35 +1,259 @@
+import time
+from operator import attrgetter
+
+from applications.insurance_event_detector import instrumentation
+from applications.insurance_event_detector.signal_history import SignalBuffer, TimedSignalBuffer
+from applications.insurance_event_detector.signal_registry import default_registry
+
+
+def setup_timeout_dict(event_list):
+    return {e.name:0 for e in event_list}
+    
+def setup_signal_history(event_dict, hist_signals, registry=None, create_buffer=None):
+    """
+    Returns the signal history, indexed by signal id. Signals that no event uses have no history (None).
+    create_buffer(signal_id) creates the buffer of a signal, a SignalBuffer by default. Signals used with time
+    windows always get a TimedSignalBuffer retaining their longest window.
+    """
+    if registry is None:
+        registry = default_registry()
+    if create_buffer is None:
+        # Each signal keeps its last hist_signals values in a preallocated ring buffer
+        create_buffer = lambda signal_id: SignalBuffer(hist_signals)
+    retention = {}
+    for event in event_dict.values():
+        for cond in event.startConditions + event.endConditions:
+            context_length = cond.get("context_length")
+            # Such a condition would never have enough data and evaluate as False forever
+            if cond.get("signal_name", False) and context_length is not None and context_length > hist_signals:
+                raise ValueError(f"Context length {context_length} of {cond['signal_name']} in event {event.name} exceeds the {hist_signals} values kept per signal.")
+        for s, window in event.retention.items():
+            retention[s] = max(window, retention.get(s, 0))
+    signal_history = [None] * len(registry)
+    for event in event_dict.values():
+        for s in event.relevant_signal_ids + [s for s, _, _ in event.capture]:
+            if signal_history[s] is None:
+                signal_history[s] = TimedSignalBuffer(hist_signals, retention[s]) if s in retention else create_buffer(s)
+    # Windowed aggregates are shared by all conditions using the same signal, method and window
+    for event in event_dict.values():
+        for signal_id, method, context_length in event.aggregates:
+            signal_history[signal_id].add_aggregate(method, context_length)
+        for signal_id, method, window in event.time_aggregates:
+            signal_history[signal_id].add_time_aggregate(method, window)
+    return signal_history
+
+# Maps the name of every signal that has a history to its id.
+# This is where signals enter the detector, names are not used past this lookup.
+def setup_signal_ids(signal_history, registry=None):
+    if registry is None:
+        registry = default_registry()
+    return {registry.name_of(i): i for i, buffer in enumerate(signal_history) if buffer is not None}
+
+def update_signal_value(signal_history, signal):
+    signal_history[signal.id].append(signal.value, signal.timestamp)
+    return signal_history
+
+def reset_all_events(event_dict):
+    for event in event_dict.values():
+        event.running = False
+
+# Represents a vehicle signal, identified by its id in the signal registry.
+class Signal:
+
+    def __init__(self, id, value, timestamp):
+        self.id = id
+        self.value = value
+        self.timestamp = timestamp
+
 
 # Represents the Risk Event. This is the payload that will be send from the vehicle to the cloud
 class RiskEvent:
 
-    def __init__(self, name, eventId, riskLevel, timestamp, eventData):
+    def __init__(self, name, eventId, riskLevel, timestamp, eventData, sourceId=None):
         self.name = name
         self.eventId = eventId
         self.riskLevel = riskLevel
         self.timestamp = timestamp
+        # Captured signals keyed by signal id, converted to names when serialized (SignalRegistry.data_by_name)
         self.eventData = eventData
+        # Vehicle that produced the event, set when processing recordings of a fleet
+        self.sourceId = sourceId
     
         
           
+def order_events(event_dict):
+    """
+    Orders the events so that every event comes after the events referenced in its event_name conditions,
+    keeping the order of event_dict otherwise.
+
+    Returns:
+        A list of events
+    """
+    ordered = []
+    visited = set()
+
+    def visit(event, path):
+        if event.name in visited:
+            return
+        if event.name in path:
+            raise ValueError(f"Cyclic event dependencies are not supported: {' -> '.join(path + [event.name])}")
+        for upstream in event.upstream_events:
+            if upstream not in event_dict:
+                raise ValueError(f"Event {upstream} referenced by {event.name} is not defined.")
+            visit(event_dict[upstream], path + [event.name])
+        visited.add(event.name)
+        ordered.append(event)
+
+    for event in event_dict.values():
+        visit(event, [])
+    return ordered
+
+
+# Builds the dependency graph of the events at load time: sets the position of every event in the topological order
+# and the events depending on it, which are evaluated as well when its running state flips.
+def setup_event_graph(event_dict):
+    ordered = order_events(event_dict)
+    for position, event in enumerate(ordered):
+        event.position = position
+        event.dependents = ()
+    for event in ordered:
+        for upstream in event.upstream_events:
+            event_dict[upstream].dependents += (event,)
+    return ordered
+
+
+def in_topological_order(events):
+    return sorted(events, key=attrgetter("position"))
+
+
+def schedule_dependents(remaining, dependents):
+    """
+    Returns the events left to evaluate in a tick together with the dependents of an event that flipped, in topological order.
+    """
+    scheduled = set(remaining)
+    return in_topological_order(list(remaining) + [event for event in dependents if event not in scheduled])
+
+
+# Maps each signal id to the list of events that depend on it, in topological order.
+# Built once at startup so that dispatching a signal only touches the affected events.
+def setup_signal_event_index(event_dict, registry=None):
+    if registry is None:
+        registry = default_registry()
+    signal_event_index = [() for _ in range(len(registry))]
+    for event in setup_event_graph(event_dict):
+        for s in event.relevant_signal_ids:
+            signal_event_index[s] = signal_event_index[s] + (event,)
+    return signal_event_index
+
+
+# Maps the MQTT topic of each signal to its history buffer, the events depending on it and its id, so a message is
+# routed without rebuilding the signal name. topics maps each topic to its signal id.
+def setup_topic_dispatch(topics, signal_history, signal_event_index):
+    topic_dispatch = {}
+    for topic, signal_id in topics.items():
+        if signal_history[signal_id] is not None:
+            topic_dispatch[topic] = (signal_history[signal_id], signal_event_index[signal_id], signal_id)
+    return topic_dispatch
+
+
 # For now, a risk detector needs to keep track of their own internal history.
-def risk_event_detector(event_dict, timeout_dict, signal, signal_dict, callback):
+# With a condition_matrix (see condition_matrix.py), the conditions are evaluated in matrix form instead of per event.
+def risk_event_detector(event_dict, timeout_dict, signal, signal_history, callback, signal_event_index, condition_matrix=None):
     """
     Event detector
     """
-    for event in event_dict.values():
-        if signal.name in event.relevant_signals: 
-            if signal.timestamp > timeout_dict[event.name]:
-                if event.check_condition(event_dict, signal_dict):
-                    timeout_dict[event.name] = signal.timestamp + event.timeout
-                    callback_data = event.collect_callback_data(signal_dict)
-                    callback(
-                        RiskEvent(
-                            event.name,
-                            event.eventId,
-                            event.riskLevel,
-                            signal.timestamp,
-                            callback_data
-                        )
+    if condition_matrix is not None:
+        condition_matrix.update(signal.id)
+        condition_matrix.detect_signal(signal.id, timeout_dict, signal.timestamp, callback)
+        return
+    detect_events(signal_event_index[signal.id], event_dict, timeout_dict, signal.timestamp, signal_history, callback)
+
+
+# Frame detector: applies all signals of one timestamp (a frame) first, then evaluates every affected event once,
+# in topological order, so events see the complete state of the frame regardless of the order of its signals.
+def frame_event_detector(event_dict, timeout_dict, signals, signal_history, callback, signal_event_index, condition_matrix=None):
+    """
+    Frame event detector
+    """
+    affected = set()
+    for signal in signals:
+        update_signal_value(signal_history, signal)
+        affected.update(signal_event_index[signal.id])
+        if condition_matrix is not None:
+            condition_matrix.update(signal.id)
+    if affected:
+        events = in_topological_order(affected)
+        if condition_matrix is not None:
+            condition_matrix.detect(events, timeout_dict, signals[-1].timestamp, callback)
+        else:
+            detect_events(events, event_dict, timeout_dict, signals[-1].timestamp, signal_history, callback)
+
+
+def group_frames(signals):
+    """
+    Groups consecutive signals with the same timestamp into frames.
+
+    Returns:
+        A generator of lists of signals
+    """
+    frame = []
+    for signal in signals:
+        if frame and signal.timestamp != frame[-1].timestamp:
+            yield frame
+            frame = []
+        frame.append(signal)
+    if frame:
+        yield frame
+
+
+# Evaluates the given events, which depend on a signal that changed at timestamp, in topological order.
+# When the running state of an event flips, the events depending on it are evaluated in the same tick.
+def detect_events(events, event_dict, timeout_dict, timestamp, signal_history, callback):
+    if instrumentation.enabled:
+        return instrumented_detect_events(events, event_dict, timeout_dict, timestamp, signal_history, callback)
+    for i, event in enumerate(events):
+        if timestamp > timeout_dict[event.name]:
+            if event.check_condition(event_dict, signal_history):
+                timeout_dict[event.name] = timestamp + event.timeout
+                callback_data = event.collect_callback_data(signal_history)
+                callback(
+                    RiskEvent(
+                        event.name,
+                        event.eventId,
+                        event.riskLevel,
+                        timestamp,
+                        callback_data
+                    )
+                )
+                if event.toggles and event.dependents:
+                    return detect_events(schedule_dependents(events[i + 1:], event.dependents), event_dict, timeout_dict, timestamp, signal_history, callback)
+
+
+# Same as detect_events, recording per event statistics in the instrumentation module
+def instrumented_detect_events(events, event_dict, timeout_dict, timestamp, signal_history, callback):
+    clock = time.perf_counter_ns
+    for i, event in enumerate(events):
+        stats = instrumentation.stats_for(event.name)
+        if timestamp > timeout_dict[event.name]:
+            running = event.running
+            start = clock()
+            passed = event.check_condition(event_dict, signal_history)
+            stats.record_evaluation(running, passed, clock() - start)
+            if passed:
+                timeout_dict[event.name] = timestamp + event.timeout
+                start = clock()
+                callback_data = event.collect_callback_data(signal_history)
+                stats.record_trigger(clock() - start)
+                callback(
+                    RiskEvent(
+                        event.name,
+                        event.eventId,
+                        event.riskLevel,
+                        timestamp,
+                        callback_data
                     )
-                
-            
\ No newline at end of file
+                )
+                if event.toggles and event.dependents:
+                    return instrumented_detect_events(schedule_dependents(events[i + 1:], event.dependents), event_dict, timeout_dict, timestamp, signal_history, callback)
+        else:
+            stats.timeout_suppressions += 1
@@ -0,0 +1,126 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from applications.insurance_event_detector.event_detector import Signal, frame_event_detector, group_frames, risk_event_detector, setup_signal_event_index, setup_signal_history, setup_signal_ids, setup_timeout_dict, update_signal_value
+from applications.insurance_event_detector import event_definitions
+from applications.insurance_event_detector import instrumentation
+from recording.columnar import ColumnarRecording, convert_csv_recording, is_columnar_recording
+
+# Fleet replay: processes a recording that contains several vehicles, identified by the source_id column.
+#
+# - Each vehicle gets its own event definitions, timeouts and signal history, so the results of a vehicle are
+#   the same as when its recording is processed alone.
+# - Vehicles are sharded across a pool of worker processes, each worker processing whole vehicles.
+# - Workers memory map the recording in the columnar format and read the rows of their vehicles through its source
+#   index, only the source ids and the risk events cross the process boundary. CSV recordings are converted into a
+#   temporary columnar recording first.
+# - With instrumentation enabled, workers send the statistics of each vehicle along with its risk events, and they
+#   are merged into the statistics of the main process.
+
+# Recording memory mapped by each worker process
+_recording = None
+
+
+# Detector state of a single vehicle
+class VehicleDetector:
+
+    def __init__(self, sourceId, hist_signals):
+        self.sourceId = sourceId
+        self.event_dict = event_definitions.create_event_dict()
+        self.timeout_dict = setup_timeout_dict(self.event_dict.values())
+        self.signal_history = setup_signal_history(self.event_dict, hist_signals)
+        self.signal_event_index = setup_signal_event_index(self.event_dict)
+        self.signal_ids = setup_signal_ids(self.signal_history)
+
+    def process(self, signal, callback):
+        update_signal_value(self.signal_history, signal)
+        risk_event_detector(self.event_dict, self.timeout_dict, signal, self.signal_history, callback, self.signal_event_index)
+
+    def process_frame(self, signals, callback):
+        frame_event_detector(self.event_dict, self.timeout_dict, signals, self.signal_history, callback, self.signal_event_index)
+
+
+def process_vehicle(sourceId, rows, hist_signals, frames=False):
+    """
+    Runs the detector over the (signal, timestamp, value) rows of one vehicle and returns the detected risk events.
+    With frames, the signals of one timestamp are applied together before the events are evaluated.
+    """
+    detector = VehicleDetector(sourceId, hist_signals)
+    signal_ids = detector.signal_ids
+    signals = (Signal(signal_ids[name], value, timestamp) for name, timestamp, value in rows if name in signal_ids)
+    return _detect(detector, signals, frames)
+
+
+def _detect(detector, signals, frames):
+    riskEvents = []
+
+    def collect(riskEvent):
+        riskEvent.sourceId = detector.sourceId
+        riskEvents.append(riskEvent)
+
+    if frames:
+        for frame in group_frames(signals):
+            detector.process_frame(frame, collect)
+    else:
+        for signal in signals:
+            detector.process(signal, collect)
+    return riskEvents
+
+
+def _init_worker(filename, instrumented):
+    global _recording
+    _recording = ColumnarRecording(filename)
+    if instrumented:
+        instrumentation.enable()
+
+
+def process_recorded_vehicle(sourceId, hist_signals, frames=False):
+    """
+    Same as process_vehicle, reading the rows of the vehicle from the recording opened in this worker.
+
+    Returns:
+        The risk events of the vehicle, and the exported statistics of its detection if instrumented (else None)
+    """
+    instrumentation.reset()
+    detector = VehicleDetector(sourceId, hist_signals)
+    recording = _recording
+    rows = recording.source_rows(sourceId)
+    # Recording signal index to registry id, None for the signals without history
+    ids = [detector.signal_ids.get(name) for name in recording.signals]
+    signals = (
+        Signal(ids[s], value, timestamp)
+        for s, timestamp, value in zip(recording.signal_ids[rows].tolist(), recording.timestamps[rows].tolist(), recording.values[rows].tolist())
+        if ids[s] is not None
+    )
+    riskEvents = _detect(detector, signals, frames)
+    return riskEvents, instrumentation.export() if instrumentation.enabled else None
+
+
+def process_fleet_file(filename, callback, hist_signals, workers=None, frames=False):
+    """
+    Processes a recording with several vehicles, sharding the vehicles across worker processes.
+    The callback receives the risk events grouped per vehicle, in the order in which the vehicles
+    first appear in the recording.
+    """
+    if not is_columnar_recording(filename):
+        with tempfile.TemporaryDirectory() as directory:
+            columnar_file = os.path.join(directory, "recording.rec")
+            convert_csv_recording(filename, columnar_file)
+            return process_fleet_file(columnar_file, callback, hist_signals, workers, frames)
+
+    with ColumnarRecording(filename) as recording:
+        # Interned in the order of their first row
+        sources = list(recording.sources)
+    workers = workers or os.cpu_count() or 1
+
+    # Hand out vehicles in chunks so each worker gets a share of the fleet without one round trip per vehicle
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(filename, instrumentation.enabled)) as pool:
+        chunksize = max(1, len(sources) // (4 * workers))
+        results = pool.map(process_recorded_vehicle, sources, repeat(hist_signals), repeat(frames), chunksize=chunksize)
+        for riskEvents, stats in results:
+            if stats is not None:
+                instrumentation.merge(stats)
+            for riskEvent in riskEvents:
+                callback(riskEvent)
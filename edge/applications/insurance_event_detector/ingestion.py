@@ -0,0 +1,156 @@
+import threading
+from collections import deque
+
+# Decouples receiving messages from detecting risk events.
+#
+# The MQTT network thread only appends raw messages to a bounded queue. A dedicated detector worker drains the
+# queue in batches and runs the detection, so a slow rule never stalls the socket reads. When the queue is full,
+# the overflow policy decides what happens:
+#
+# - drop_oldest: the oldest queued message is discarded to make room (default, keeps the detector current)
+# - drop_newest: the incoming message is discarded
+# - block: the network thread waits for room, which pushes back on the broker
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+# Seconds without messages after which the queue is considered idle
+IDLE_DELAY = 0.005
+
+
+class IngestionQueue:
+
+    def __init__(self, maxsize, overflow_policy="drop_oldest"):
+        if maxsize < 1:
+            raise ValueError("The ingestion queue size must be at least 1.")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Overflow policy {overflow_policy} is not supported. Supported policies are: {list(OVERFLOW_POLICIES)}.")
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.processed = 0
+        self.batches = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Adds a message, applying the overflow policy when the queue is full.
+        Returns False if a message was dropped.
+        """
+        with self._lock:
+            accepted = True
+            if len(self._items) >= self.maxsize:
+                if self.overflow_policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                elif self.overflow_policy == "drop_oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                    accepted = False
+                else:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+            self._items.append(item)
+            self.enqueued += 1
+            depth = len(self._items)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self._not_empty.notify()
+            return accepted
+
+    def get_batch(self, max_batch, timeout=None):
+        """
+        Waits until messages are available and returns up to max_batch of them, oldest first.
+        Returns an empty list on timeout or when the queue is closed and drained.
+        """
+        with self._lock:
+            if not self._items and not self._closed:
+                self._not_empty.wait(timeout)
+            items = self._items
+            batch = [items.popleft() for _ in range(min(max_batch, len(items)))]
+            if batch:
+                self._not_full.notify_all()
+            return batch
+
+    def reject(self):
+        """
+        Counts a message that was skipped by the detector, e.g. because its payload is not a number.
+        """
+        with self._lock:
+            self.invalid += 1
+
+    def task_done(self, count):
+        with self._lock:
+            self.processed += count
+            self.batches += 1
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "depth": len(self._items),
+                "max_depth": self.max_depth,
+                "capacity": self.maxsize,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "invalid": self.invalid,
+                "processed": self.processed,
+                "batches": self.batches,
+            }
+
+
+def start_detector_worker(queue, process_batch, max_batch=256, on_idle=None):
+    """
+    Starts the thread that drains the queue and hands each batch to process_batch, which is expected to skip
+    (and reject) bad messages itself: an exception leaves the rest of the batch unprocessed.
+    on_idle() is called once the queue stayed empty for IDLE_DELAY after a batch, and when it is closed.
+    The thread ends once the queue is closed and empty.
+    """
+    def idle():
+        if on_idle is not None:
+            try:
+                on_idle()
+            except Exception as e:
+                print(f"Error processing the pending messages: {e}")
+
+    def run():
+        busy = False
+        while True:
+            batch = queue.get_batch(max_batch, timeout=IDLE_DELAY if busy else 1.0)
+            if not batch:
+                if busy:
+                    busy = False
+                    idle()
+                if queue.closed and len(queue) == 0:
+                    return
+                continue
+            busy = True
+            try:
+                process_batch(batch)
+            except Exception as e:
+                # Last resort, bad messages are skipped one by one in process_batch
+                print(f"Error processing a batch of {len(batch)} messages: {e}")
+            queue.task_done(len(batch))
+
+    worker = threading.Thread(target=run, name="detector-worker", daemon=True)
+    worker.start()
+    return worker
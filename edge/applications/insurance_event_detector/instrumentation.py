@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+
+# Optional per event instrumentation of the detector.
+#
+# While enabled, risk_event_detector records for every event how often it was evaluated, how often its start and
+# end conditions passed, how often it triggered or was suppressed by its timeout, and how long check_condition and
+# collect_callback_data took. When disabled, the detector only pays for reading the enabled flag once per signal.
+#
+# The condition matrix and the backtest evaluate many conditions in one vectorized operation, their evaluation time
+# is spread evenly over the events evaluated. Worker processes (fleet and sharded mode) export their statistics
+# and the main process merges them into its own.
+
+enabled = False
+
+_stats = {}
+
+
+# Counters of a single event
+class EventStats:
+
+    __slots__ = (
+        "evaluations", "start_evaluations", "start_passes", "end_evaluations", "end_passes",
+        "triggers", "timeout_suppressions", "eval_time_ns", "max_eval_time_ns",
+        "callback_time_ns", "max_callback_time_ns",
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def record_evaluation(self, running, passed, elapsed_ns):
+        self.evaluations += 1
+        if running:
+            self.end_evaluations += 1
+            self.end_passes += passed
+        else:
+            self.start_evaluations += 1
+            self.start_passes += passed
+        self.eval_time_ns += elapsed_ns
+        if elapsed_ns > self.max_eval_time_ns:
+            self.max_eval_time_ns = elapsed_ns
+
+    def record_evaluations(self, start_evaluations, start_passes, end_evaluations, end_passes, elapsed_ns):
+        # Evaluations done in one vectorized operation
+        evaluations = start_evaluations + end_evaluations
+        self.evaluations += evaluations
+        self.start_evaluations += start_evaluations
+        self.start_passes += start_passes
+        self.end_evaluations += end_evaluations
+        self.end_passes += end_passes
+        self.eval_time_ns += elapsed_ns
+        if evaluations and elapsed_ns // evaluations > self.max_eval_time_ns:
+            self.max_eval_time_ns = elapsed_ns // evaluations
+
+    def record_trigger(self, callback_elapsed_ns):
+        self.triggers += 1
+        self.callback_time_ns += callback_elapsed_ns
+        if callback_elapsed_ns > self.max_callback_time_ns:
+            self.max_callback_time_ns = callback_elapsed_ns
+
+    def merge(self, counters):
+        for name, value in counters.items():
+            if name.startswith("max_"):
+                if value > getattr(self, name):
+                    setattr(self, name, value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result["start_pass_rate"] = self.start_passes / self.start_evaluations if self.start_evaluations else 0.0
+        result["end_pass_rate"] = self.end_passes / self.end_evaluations if self.end_evaluations else 0.0
+        result["mean_eval_time_ns"] = self.eval_time_ns / self.evaluations if self.evaluations else 0.0
+        return result
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    _stats.clear()
+
+
+def stats_for(event_name):
+    stats = _stats.get(event_name)
+    if stats is None:
+        stats = _stats[event_name] = EventStats()
+    return stats
+
+
+def snapshot():
+    """
+    Returns the statistics of all events evaluated so far, keyed by event name, sorted by cumulative evaluation time.
+    """
+    ordered = sorted(list(_stats.items()), key=lambda item: item[1].eval_time_ns, reverse=True)
+    return {name: stats.as_dict() for name, stats in ordered}
+
+
+def export():
+    """
+    Returns the counters of all events, keyed by event name, to be merged into the statistics of another process.
+    """
+    return {name: {slot: getattr(stats, slot) for slot in EventStats.__slots__} for name, stats in list(_stats.items())}
+
+
+def merge(exported):
+    """
+    Adds the counters exported by another process to the statistics of this one.
+    """
+    for name, counters in exported.items():
+        stats_for(name).merge(counters)
+
+
+def start_periodic_dump(interval, filename=None, extra=None):
+    """
+    Writes a snapshot every interval seconds, as one JSON line appended to filename, or printed if no file is given.
+    extra maps additional keys of the line to functions returning their current value, e.g. queue metrics.
+
+    Returns:
+        A threading.Event, set it to stop dumping
+    """
+    stop = threading.Event()
+
+    def dump():
+        while not stop.wait(interval):
+            entry = {"timestamp": time.time(), "events": snapshot()}
+            for key, current in (extra or {}).items():
+                entry[key] = current()
+            line = json.dumps(entry)
+            if filename:
+                with open(filename, "a") as f:
+                    f.write(line + "\n")
+            else:
+                print(f"Detector statistics {line}")
+
+    threading.Thread(target=dump, name="detector-stats", daemon=True).start()
+    return stop
@@ -1,11 +1,21 @@
 import argparse
-import csv
+import json
 import time
 
-from applications.insurance_event_detector.event_detector import risk_event_detector
+from applications.insurance_event_detector.event_detector import Signal, detect_events, frame_event_detector, group_frames, in_topological_order, risk_event_detector, reset_all_events, setup_signal_event_index, setup_signal_history, setup_signal_ids, setup_timeout_dict, setup_topic_dispatch, update_signal_value
+from applications.insurance_event_detector import backtest
+from applications.insurance_event_detector import condition_matrix
 from applications.insurance_event_detector import event_definitions
+from applications.insurance_event_detector import fleet
+from applications.insurance_event_detector import ingestion
+from applications.insurance_event_detector import instrumentation
+from applications.insurance_event_detector import sharding
+from applications.insurance_event_detector import signal_registry
+from applications.insurance_event_detector import uplink
 
 from proto_build import consumer
+from proto_build import discovery_cache
+from recording.columnar import read_recording_rows
 
 # This script is a very basic simulation of the seuence of events to detect risk events in a vehicle.
 # 
@@ -15,64 +25,27 @@ from proto_build import consumer
 # - If a risk event is detected, a Risk Event is created and posted
 # - Risk event is transmitted to the cloud
 
-def setup_timeout_dict(event_list):
-    return {e.name:0 for e in event_list}
-    
-def setup_signal_dict(event_dict):
-    relevant_signals = []
-    for event in event_dict.values():
-        relevant_signals = relevant_signals + event.relevant_signals
-        relevant_signals = relevant_signals + list(event.eventData.keys())
-    relevant_signals = list(set(relevant_signals))
-    relevant_signals = [x for x in relevant_signals if x not in event_dict.keys()]
-    signal_dict = {}
-    for s in relevant_signals:
-        signal_dict[s] = []
-        # Alternative setup:
-        # signal_dict[s] = [np.nan]*hist_signals
-    return signal_dict
-
-def update_signal_value(signal_dict, signal, hist_signals):
-    signal_dict[signal.name].append(signal.value)
-    signal_dict[signal.name] = signal_dict[signal.name][-hist_signals:]
-    return signal_dict
-
-# Alternative setup:
-# def update_signal_value(signal_dict, signal):
-#     signal_dict[signal.name].append(signal.value)
-#     del signal_dict[signal.name][0]
-#     return signal_dict
-
-def reset_all_events(event_dict):
-    for event in event_dict.values():
-        event.running = False
-
-# Represents a vehicle signal.
-class Signal:
-
-    def __init__(self, name, value, timestamp):
-        self.name = name
-        self.value = value
-        self.timestamp = timestamp
-
-
 # Here we will showcase the telemetry platform part - which is basically just serializing the risk event and sending it to the cloud
-def post(riskEvent):    
-    print("Posting risk event to cloud, eventually")  
+# The uplink hands over compressed batches of risk events, the batch stays spooled until this returns without error
+def post(payload):    
+    print(f"Posting a batch of risk events ({len(payload)} bytes) to cloud, eventually")  
+    return True
 
 # This is the callback from the risk event detectors
 def risk_event_callback(riskEvent):
     print(f"Received a risk event {riskEvent.name} at {riskEvent.timestamp} with risk level {riskEvent.riskLevel} and start {riskEvent.eventData.get('start', False)}") #and {riskEvent.eventData}")
+    if risk_event_uplink:
+        risk_event_uplink.submit(riskEvent)
     
 
-# This just creates a Signal object from the CSV line
+# This just creates a Signal object from a recording row, or returns None if no event uses the signal
 # This will be replaced by a proper notification from the In-Vehicle Digital Twin
-def process_signal(data):
-    return Signal(data[1], float(data[3]), float(data[2]))
+def process_signal(data, signal_ids):
+    signal_id = signal_ids.get(data[1])
+    if signal_id is None:
+        return None
+    return Signal(signal_id, float(data[3]), float(data[2]))
 
-def process_mqtt_signal(data):
-    topic = data.topic.replace("/", "_")
-    return Signal(topic, float(data.payload), float(time.time() * 1000))
 
 
 # Each time that a signal change is posted in the in-vehicle digital twin, the risk event detectors will be notified.
@@ -81,82 +54,256 @@ def process_mqtt_signal(data):
 
 
 # This method will read the recording file line by line, create a Signal object and notify the risk event detectors.
+# The recording can be a CSV file or a columnar recording, which is memory mapped instead of parsed.
+# In frame mode, all signals with the same timestamp are applied before the affected events are evaluated once.
+# With matrix, the conditions of all events are evaluated in matrix form.
 # This will be replaced by listening to changes on the in-vehicle digital twin
-def process_sample_file(filename):
+def process_sample_file(filename, frames=False, matrix=False):
     
-    # Read the file as CSV, line by line
-    with open(filename, newline='') as csvfile:
-        hist_signals = 60
-        timeout_dict = setup_timeout_dict(event_dict.values())
-        signal_dict = setup_signal_dict(event_dict)
-        
-        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        # Ignore the first line, which is the header
-        next(reader)
-        for row in reader:
-            signal = process_signal(row)
-            if signal.name in signal_dict:
-                update_signal_value(signal_dict, signal, hist_signals)
-                risk_event_detector(event_dict, timeout_dict, signal, signal_dict, risk_event_callback)
-        reset_all_events(event_dict)
-        
+    timeout_dict = setup_timeout_dict(event_dict.values())
+    signal_history = setup_signal_history(event_dict, hist_signals)
+    signal_event_index = setup_signal_event_index(event_dict)
+    signal_ids = setup_signal_ids(signal_history)
+    conditions = condition_matrix.ConditionMatrix(event_dict, signal_history) if matrix else None
+
+    signals = (process_signal(row, signal_ids) for row in read_recording_rows(filename))
+    if frames:
+        for frame in group_frames(signal for signal in signals if signal is not None):
+            frame_event_detector(event_dict, timeout_dict, frame, signal_history, risk_event_callback, signal_event_index, conditions)
+    else:
+        for signal in signals:
+            if signal is not None:
+                update_signal_value(signal_history, signal)
+                risk_event_detector(event_dict, timeout_dict, signal, signal_history, risk_event_callback, signal_event_index, conditions)
+    reset_all_events(event_dict)
+
+
+# Sharded mode: this process only reads the recording, the events are detected by worker processes
+def process_sample_file_sharded(filename, shards, slack):
 
+    detector = sharding.ShardedDetector(risk_event_callback, hist_signals, shards, slack)
+    signal_ids = detector.signal_ids
 
+    for row in read_recording_rows(filename):
+        signal = process_signal(row, signal_ids)
+        if signal is not None:
+            detector.submit(signal.id, signal.value, signal.timestamp)
+    detector.close()
 
+
+# Runs in the MQTT network thread: only queue the message with its receive time, detection runs in the detector worker
 def on_message(client, userdata, msg):
     #print(f"Received message {msg.payload} on topic {msg.topic}")
 
-    hist_signals = 60
-    signal = process_mqtt_signal(msg)
-
-    if signal.name in signal_dict:
-        update_signal_value(signal_dict, signal, hist_signals)
-        risk_event_detector(event_dict, timeout_dict, signal, signal_dict, risk_event_callback)
+    # Seconds like the timestamps of recordings, which timeouts and time windows are given in
+    ingestion_queue.put((msg.topic, msg.payload, round(time.time(), 3)))
+
+
+# Returns the value of a message, or None if its payload is not a number. Such a message is skipped and counted as
+# invalid in the queue metrics, the rest of its batch is processed.
+def parse_payload(payload):
+    try:
+        return float(payload)
+    except ValueError:
+        ingestion_queue.reject()
+        return None
+
+
+def process_mqtt_batch(batch):
+    if sharded_detector is not None:
+        return process_mqtt_sharded(batch)
+    if frames:
+        return process_mqtt_frames(batch)
+    for topic, payload, timestamp in batch:
+        route = topic_dispatch.get(topic)
+
+        if route is not None:
+            value = parse_payload(payload)
+            if value is None:
+                continue
+            buffer, events, signal_id = route
+            buffer.append(value, timestamp)
+            if conditions is not None:
+                conditions.update(signal_id)
+                conditions.detect_signal(signal_id, timeout_dict, timestamp, risk_event_callback)
+            else:
+                detect_events(events, event_dict, timeout_dict, timestamp, signal_history, risk_event_callback)
+
+
+# Frame mode: messages received in the same millisecond are applied together, then the affected events are evaluated once.
+# A frame can span batches, it is evaluated when a message with a later timestamp arrives or the queue goes idle.
+def process_mqtt_frames(batch):
+    global frame_timestamp
+    for topic, payload, timestamp in batch:
+        route = topic_dispatch.get(topic)
+
+        if route is not None:
+            # Parsed before the frame is touched, so a bad message leaves it as it was
+            value = parse_payload(payload)
+            if value is None:
+                continue
+            if frame_affected and timestamp != frame_timestamp:
+                flush_mqtt_frame()
+            buffer, events, signal_id = route
+            buffer.append(value, timestamp)
+            if conditions is not None:
+                conditions.update(signal_id)
+            frame_affected.update(events)
+            frame_timestamp = timestamp
+
+
+# Evaluates the pending frame, called when the ingestion queue goes idle
+def flush_mqtt_frame():
+    if frame_affected:
+        detect_frame(frame_affected, frame_timestamp)
+        frame_affected.clear()
+
+
+# Sharded mode: hand the messages over to the detector workers
+def process_mqtt_sharded(batch):
+    for topic, payload, timestamp in batch:
+        route = topic_dispatch.get(topic)
+
+        if route is not None:
+            value = parse_payload(payload)
+            if value is not None:
+                sharded_detector.submit(route[2], value, timestamp)
+    sharded_detector.publish()
+
+
+def detect_frame(affected, timestamp):
+    events = in_topological_order(affected)
+    if conditions is not None:
+        conditions.detect(events, timeout_dict, timestamp, risk_event_callback)
+    else:
+        detect_events(events, event_dict, timeout_dict, timestamp, signal_history, risk_event_callback)
 
 
-def process_vehicle_integration():
+def process_vehicle_integration(cache=None):
         
-    # Make the ids compatible with DTDL
-    collectedSignals = [ ("dtmi:" + element.replace("_", ":") + ";1") for element in signal_dict.keys()]
+    # The DTDL ids of all signals used by the events
+    registry = signal_registry.default_registry()
+    signal_ids = {registry.dtdl_ids[i]: i for i in setup_signal_ids(signal_history).values()}
+    collectedSignals = list(signal_ids)
 
     print(f"{collectedSignals}")
 
-    consumer.start(collectedSignals)
+    # Route the topic of every subscribed signal straight to its history and events
+    def on_subscribe(signalID, topic):
+        if signalID in signal_ids:
+            topic_dispatch.update(setup_topic_dispatch({topic: signal_ids[signalID]}, signal_history, signal_event_index))
+
+    # Messages of a topic that is no longer subscribed are dropped
+    def on_unsubscribe(signalID, topic):
+        topic_dispatch.pop(topic, None)
+
+    consumer.onSubscribe = on_subscribe
+    consumer.onUnsubscribe = on_unsubscribe
+    consumer.start(collectedSignals, cache)
 
     consumer.mqttClient.on_message = on_message
 
-    consumer.mqttClient.loop_forever()
+    ingestion.start_detector_worker(ingestion_queue, process_mqtt_batch, batch_size, flush_mqtt_frame if frames else None)
+
+    consumer.loopForever()
+
+
+# Number of values kept per signal
+hist_signals = 60
+
+# Maximum number of messages handed to the detector at once
+batch_size = 256
 
+# Evaluate the events once per timestamp instead of once per signal
+frames = False
+
+# Events affected by the frame of MQTT messages not evaluated yet, and its timestamp
+frame_affected = set()
+frame_timestamp = None
+
+# Condition matrix of event_dict, when conditions are evaluated in matrix form
+conditions = None
+
+# Detector running the events in worker processes, in sharded mode
+sharded_detector = None
 
 event_dict = {}
 timeout_dict = {}
-signal_dict = {}
+signal_history = []
+signal_event_index = []
+topic_dispatch = {}
+ingestion_queue = None
+risk_event_uplink = None
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Starts the sample process")
     parser.add_argument("-f", "--file", dest="file", help="Path to the file containing the recording.")
+    parser.add_argument("--fleet", dest="fleet", action="store_true", help="Process the recording per source_id, as a fleet of vehicles.")
+    parser.add_argument("--backtest", dest="backtest", action="store_true", help="Re-score the recording with the vectorized batch engine.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, help="Number of worker processes used in fleet mode. Defaults to the number of CPUs.")
+    parser.add_argument("--stats-interval", dest="statsInterval", type=float, help="Collect per event statistics and dump them every given number of seconds.")
+    parser.add_argument("--stats-file", dest="statsFile", help="Append the statistics to this file as JSON lines instead of printing them.")
+    parser.add_argument("--queue-size", dest="queueSize", type=int, default=10000, help="Maximum number of received messages waiting for detection.")
+    parser.add_argument("--overflow", dest="overflow", choices=ingestion.OVERFLOW_POLICIES, default="drop_oldest", help="What to do with messages when the queue is full.")
+    parser.add_argument("--batch-size", dest="batchSize", type=int, default=batch_size, help="Maximum number of messages the detector worker processes at once.")
+    parser.add_argument("--uplink", dest="uplink", action="store_true", help="Send the risk events of a recording to the cloud too. They are always sent when connected to the vehicle.")
+    parser.add_argument("--spool-dir", dest="spoolDir", default="uplink_spool", help="Directory where risk events are kept until they are sent to the cloud.")
+    parser.add_argument("--spool-max-bytes", dest="spoolMaxBytes", type=int, default=uplink.DEFAULT_MAX_SPOOL_BYTES, help="Maximum size of the batches waiting in the spool, the oldest are dropped beyond it.")
+    parser.add_argument("--uplink-batch-events", dest="uplinkBatchEvents", type=int, default=50, help="Maximum number of risk events sent in one batch.")
+    parser.add_argument("--uplink-batch-delay", dest="uplinkBatchDelay", type=float, default=5.0, help="Maximum number of seconds a risk event waits for its batch to be closed.")
+    parser.add_argument("--uplink-format", dest="uplinkFormat", choices=["json", "protobuf", "protobuf-float32"], default="json", help="Format of the risk event batches sent to the cloud.")
+    parser.add_argument("--discovery-cache", dest="discoveryCache", default=discovery_cache.DEFAULT_CACHE_FILE, help="File caching the discovered services and signals between restarts.")
+    parser.add_argument("--discovery-ttl", dest="discoveryTtl", type=float, default=discovery_cache.DEFAULT_TTL, help="Seconds after which cached discovery results are no longer used.")
+    parser.add_argument("--frames", dest="frames", action="store_true", help="Apply all signals with the same timestamp before evaluating the affected events once.")
+    parser.add_argument("--condition-matrix", dest="conditionMatrix", action="store_true", help="Evaluate the conditions of all events in one vectorized pass, for large rule sets.")
+    parser.add_argument("--shards", dest="shards", type=int, help="Detect the events in the given number of worker processes, reading the signal history from shared memory.")
+    parser.add_argument("--shard-slack", dest="shardSlack", type=int, default=sharding.DEFAULT_SLACK, help="Number of signal updates the workers may lag behind in sharded mode.")
     args = parser.parse_args()
+    if(args.statsFile and not args.statsInterval):
+        parser.error("--stats-file requires --stats-interval.")
     
-    event_dict = {
-        "speeding": event_definitions.speeding,
-        "massive_speeding": event_definitions.massive_speeding,
-        "cruise_control_activated": event_definitions.cruise_control_activated,
-        "tcs_activated": event_definitions.tcs_activated,
-        "esc_activated": event_definitions.esc_activated,
-        "performance_mode_activated": event_definitions.performance_mode_activated,
-        "autobahn": event_definitions.autobahn,
-        "traffic_jam": event_definitions.traffic_jam,
-        "no_seatbelt": event_definitions.no_seatbelt,
-        "harsh_braking": event_definitions.harsh_braking,
-        "harsh_acceleration": event_definitions.harsh_acceleration,
-        "harsh_cornering": event_definitions.harsh_cornering,
-        }
+    event_dict = event_definitions.create_event_dict()
     
     timeout_dict = setup_timeout_dict(event_dict.values())
-    signal_dict = setup_signal_dict(event_dict)
-
-    if(args.file):
-        process_sample_file(args.file)
+    signal_history = setup_signal_history(event_dict, hist_signals)
+    signal_event_index = setup_signal_event_index(event_dict)
+    if(args.conditionMatrix):
+        conditions = condition_matrix.ConditionMatrix(event_dict, signal_history)
+    ingestion_queue = ingestion.IngestionQueue(args.queueSize, args.overflow)
+    batch_size = args.batchSize
+    frames = args.frames
+    encode = uplink.encode_batch
+    if(args.uplinkFormat != "json"):
+        encode = uplink.protobuf_batch_encoder(signal_registry.load_signal_registry(), args.uplinkFormat == "protobuf-float32")
+    # Recordings are processed offline, their risk events are only sent when asked for
+    if(not args.file or args.uplink):
+        risk_event_uplink = uplink.Uplink(args.spoolDir, post, args.uplinkBatchEvents, args.uplinkBatchDelay, encode=encode, max_spool_bytes=args.spoolMaxBytes)
+
+    if(args.statsInterval):
+        instrumentation.enable()
+        extra = {"ingestion": ingestion_queue.metrics}
+        if(risk_event_uplink):
+            extra["uplink"] = risk_event_uplink.metrics
+        instrumentation.start_periodic_dump(args.statsInterval, args.statsFile, extra)
+
+    if(args.file and args.fleet):
+        fleet.process_fleet_file(args.file, risk_event_callback, hist_signals, args.workers, frames)
+    elif(args.file and args.backtest):
+        backtest.run_backtest(backtest.load_recording(args.file), event_dict, hist_signals, risk_event_callback, frames)
+    elif(args.file and args.shards):
+        process_sample_file_sharded(args.file, args.shards, args.shardSlack)
+    elif(args.file):
+        process_sample_file(args.file, frames, args.conditionMatrix)
     else:
-        process_vehicle_integration()
+        if(args.shards):
+            sharded_detector = sharding.ShardedDetector(risk_event_callback, hist_signals, args.shards, args.shardSlack)
+        process_vehicle_integration(discovery_cache.DiscoveryCache(args.discoveryCache, args.discoveryTtl))
+        if(sharded_detector):
+            sharded_detector.close()
+
+    if(risk_event_uplink):
+        risk_event_uplink.close()
+
+    if(args.statsInterval):
+        print(f"Detector statistics {json.dumps(instrumentation.snapshot())}")
         
\ No newline at end of file
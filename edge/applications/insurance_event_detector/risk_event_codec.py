@@ -0,0 +1,204 @@
+import argparse
+import json
+import time
+import zlib
+
+import proto_build.risk_event.v1.risk_event_pb2 as risk_event_pb2
+
+from applications.insurance_event_detector.signal_registry import load_signal_registry
+
+# Protobuf wire format of risk events (proto_build/risk_event/v1/risk_event.proto).
+#
+# Signals are sent as integer ids of the signal registry and the captured samples as packed arrays typed after the
+# schema of the signal in the registry: boolean signals as bools and integer signals as zigzag varints, one byte
+# per sample for small values. Only double signals are sent as doubles, or as floats when float_values is set,
+# which halves them again at the cost of precision. Samples that do not fit their schema (e.g. nan) are sent as
+# doubles, so the typed encoding stays lossless. The uplink encodes the RiskEvents of the detector straight from
+# their signal ids, the converters work on events in the JSON form of data/out/risk_events.json, so both formats
+# can be translated losslessly (apart from float precision).
+
+# Values of boolean samples, 0.0 and 1.0 compare equal to them
+_BOOLEAN_VALUES = frozenset((0, 1))
+
+# Range of sint32
+_INT_MIN = -2 ** 31
+_INT_MAX = 2 ** 31 - 1
+
+
+def _int32_values(data):
+    # The samples as ints if they are all whole numbers in the range of sint32, else None
+    try:
+        values = list(map(int, data))
+    except (ValueError, OverflowError):
+        return None
+    if values != data or (values and (min(values) < _INT_MIN or max(values) > _INT_MAX)):
+        return None
+    return values
+
+
+def encode_samples(samples, data, schema=None, float_values=False, typed=True):
+    """
+    Fills a SignalSamples message with the captured data of a signal, a single value or a list of values.
+    With typed, the samples of boolean and integer signals (by schema) are encoded as varints.
+    """
+    if not isinstance(data, list):
+        samples.scalar = True
+        data = [data]
+    int_values = _int32_values(data) if typed and schema == "integer" else None
+    if typed and schema == "boolean" and _BOOLEAN_VALUES.issuperset(data):
+        samples.bool_values.extend(map(bool, data))
+    elif int_values is not None:
+        samples.int_values.extend(int_values)
+    elif float_values:
+        samples.float_values.extend(data)
+    else:
+        samples.values.extend(data)
+
+
+def encode_event(event, registry, float_values=False, typed=True):
+    """
+    Builds the protobuf message of an event in the JSON form.
+    """
+    message = risk_event_pb2.RiskEvent(
+        name=event["name"],
+        event_id=event["eventId"],
+        risk_level=event["riskLevel"],
+        timestamp=event["timestamp"],
+        source_id=event.get("sourceId") or "",
+    )
+    for signal, data in event["eventData"].items():
+        if signal == "start":
+            message.start = bool(data)
+            continue
+        samples = message.event_data.add()
+        schema = None
+        if signal in registry:
+            samples.signal_id = registry.id_of(signal)
+            schema = registry.schemas[samples.signal_id]
+        else:
+            samples.signal_name = signal
+        encode_samples(samples, data, schema, float_values, typed)
+    return message
+
+
+def encode_risk_event(riskEvent, registry, float_values=False, typed=True):
+    """
+    Builds the protobuf message of a RiskEvent of the detector, whose captured data is keyed by signal id.
+    """
+    message = risk_event_pb2.RiskEvent(
+        name=riskEvent.name,
+        event_id=riskEvent.eventId,
+        risk_level=riskEvent.riskLevel,
+        timestamp=riskEvent.timestamp,
+        source_id=riskEvent.sourceId or "",
+    )
+    schemas = registry.schemas
+    for signal, data in riskEvent.eventData.items():
+        if signal == "start":
+            message.start = bool(data)
+            continue
+        samples = message.event_data.add()
+        if type(signal) is int:
+            samples.signal_id = signal
+            encode_samples(samples, data, schemas[signal], float_values, typed)
+        else:
+            samples.signal_name = signal
+            encode_samples(samples, data, None, float_values, typed)
+    return message
+
+
+def decode_event(message, registry):
+    """
+    Returns the JSON form of a protobuf RiskEvent message.
+    """
+    eventData = {}
+    for samples in message.event_data:
+        signal = samples.signal_name or registry.name_of(samples.signal_id)
+        if samples.bool_values or samples.int_values:
+            values = [float(v) for v in samples.bool_values or samples.int_values]
+        else:
+            values = list(samples.float_values or samples.values)
+        eventData[signal] = values[0] if samples.scalar else values
+    if message.start:
+        eventData["start"] = True
+    event = {
+        "name": message.name,
+        "eventId": message.event_id,
+        "riskLevel": message.risk_level,
+        "timestamp": message.timestamp,
+        "eventData": eventData,
+    }
+    if message.source_id:
+        event["sourceId"] = message.source_id
+    return event
+
+
+def encode_events(events, registry, float_values=False, typed=True):
+    batch = risk_event_pb2.RiskEventBatch()
+    batch.events.extend(encode_event(event, registry, float_values, typed) for event in events)
+    return batch.SerializeToString()
+
+
+def encode_risk_events(riskEvents, registry, float_values=False, typed=True):
+    batch = risk_event_pb2.RiskEventBatch()
+    batch.events.extend(encode_risk_event(riskEvent, registry, float_values, typed) for riskEvent in riskEvents)
+    return batch.SerializeToString()
+
+
+def decode_events(payload, registry):
+    batch = risk_event_pb2.RiskEventBatch()
+    batch.ParseFromString(payload)
+    return [decode_event(message, registry) for message in batch.events]
+
+
+def json_to_protobuf(risk_events_json, registry, float_values=False, typed=True):
+    """
+    Converts a list of risk events in the format of data/out/risk_events.json (JSON strings or dictionaries)
+    into a serialized RiskEventBatch.
+    """
+    events = [json.loads(e) if isinstance(e, str) else e for e in risk_events_json]
+    return encode_events(events, registry, float_values, typed)
+
+
+def protobuf_to_json(payload, registry):
+    """
+    Converts a serialized RiskEventBatch back into the format of data/out/risk_events.json.
+    """
+    return [json.dumps(event) for event in decode_events(payload, registry)]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Converts risk events from the JSON format into the protobuf format and compares their size")
+    parser.add_argument("json_file", help="Risk events in the format of data/out/risk_events.json.")
+    parser.add_argument("-o", "--output", dest="output", help="File to write the serialized RiskEventBatch to.")
+    parser.add_argument("--float32", dest="float32", action="store_true", help="Send the samples of double signals as floats instead of doubles.")
+    parser.add_argument("--untyped", dest="untyped", action="store_true", help="Send the samples of boolean and integer signals as doubles too, for comparison.")
+    args = parser.parse_args()
+
+    registry = load_signal_registry()
+    with open(args.json_file) as f:
+        risk_events_json = json.load(f)
+    events = [json.loads(e) if isinstance(e, str) else e for e in risk_events_json]
+
+    start = time.perf_counter()
+    text = json.dumps([json.dumps(event) for event in events]).encode("utf-8")
+    json_encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    [json.loads(e) for e in json.loads(text)]
+    json_decode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    payload = encode_events(events, registry, args.float32, not args.untyped)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decode_events(payload, registry)
+    decode_time = time.perf_counter() - start
+
+    print(f"{len(risk_events_json)} risk events")
+    print(f"JSON:     {len(text):>9} bytes, {len(zlib.compress(text)):>9} bytes compressed (encoded in {json_encode_time * 1000:.2f} ms, decoded in {json_decode_time * 1000:.2f} ms)")
+    print(f"Protobuf: {len(payload):>9} bytes, {len(zlib.compress(payload)):>9} bytes compressed (encoded in {encode_time * 1000:.2f} ms, decoded in {decode_time * 1000:.2f} ms)")
+
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(payload)
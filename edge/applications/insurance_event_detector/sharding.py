@@ -0,0 +1,212 @@
+import gc
+import queue
+import threading
+import time
+from multiprocessing import Condition, Process, Queue
+
+from applications.insurance_event_detector import event_definitions
+from applications.insurance_event_detector import instrumentation
+from applications.insurance_event_detector.event_detector import Signal, risk_event_detector, setup_signal_event_index, setup_signal_history, setup_signal_ids, setup_timeout_dict, update_signal_value
+from applications.insurance_event_detector.shared_history import SharedSignalHistory
+from applications.insurance_event_detector.signal_registry import default_registry
+
+# Sharded detection: the event definitions are partitioned across worker processes, so rule evaluation is not
+# limited to the one core the GIL allows.
+#
+# - The process receiving the signals (the ingest process) writes every update into the shared signal history
+#   (see shared_history.py).
+# - Each worker replays the updates against its partition of the events, reading the history zero-copy, and sends
+#   the risk events it detects to a collector thread of the ingest process, which calls the callback.
+# - Events connected through event_name conditions stay in the same partition, so their dependents are scheduled as
+#   in the single-process detector. Partitions are balanced by their number of conditions.
+# - With instrumentation enabled, workers send the statistics collected since their last report along with their
+#   risk events, at most every STATS_INTERVAL seconds, and the collector merges them into its own.
+#
+# The risk events are the same as with the single-process detector. The callback gets the events of every worker in
+# order, but the events of different workers may interleave.
+
+# Number of updates the ingest process may be ahead of the slowest worker
+DEFAULT_SLACK = 4096
+
+# Updates written before they are published to the workers, unless publish is called earlier
+PUBLISH_INTERVAL = 256
+
+# Seconds between the statistics reports of an instrumented worker
+STATS_INTERVAL = 1.0
+
+
+def partition_events(event_dict, shards):
+    """
+    Splits the events into at most shards partitions, keeping events that depend on each other together.
+
+    Returns:
+        A list of lists of event names, each in event_dict order
+    """
+    component = {name: name for name in event_dict}
+
+    def find(name):
+        while component[name] != name:
+            component[name] = component[component[name]]
+            name = component[name]
+        return name
+
+    for event in event_dict.values():
+        for upstream in event.upstream_events:
+            if upstream not in event_dict:
+                raise ValueError(f"Event {upstream} referenced by {event.name} is not defined.")
+            component[find(upstream)] = find(event.name)
+    components = {}
+    for name in event_dict:
+        components.setdefault(find(name), []).append(name)
+
+    def weight(names):
+        return sum(len(event_dict[name].startConditions) + len(event_dict[name].endConditions) for name in names)
+
+    # Largest components first, each to the partition with the fewest conditions so far
+    partitions = [[] for _ in range(max(1, min(shards, len(components))))]
+    loads = [0] * len(partitions)
+    for names in sorted(components.values(), key=weight, reverse=True):
+        i = loads.index(min(loads))
+        partitions[i] += names
+        loads[i] += weight(names)
+    order = {name: i for i, name in enumerate(event_dict)}
+    return [sorted(names, key=order.get) for names in partitions if names]
+
+
+def run_worker(worker, names, history_args, hist_signals, results, create_event_dict, instrumented=False):
+    """
+    Detects the events in names over the updates of the shared history, sending the risk events to results as
+    (risk events, exported statistics or None) pairs, and None once done.
+    """
+    if instrumented:
+        instrumentation.enable()
+    instrumentation.reset()
+    history = SharedSignalHistory(*history_args)
+    all_events = create_event_dict()
+    event_dict = {name: all_events[name] for name in names}
+    timeout_dict = setup_timeout_dict(event_dict.values())
+    signal_history = setup_signal_history(event_dict, hist_signals, create_buffer=lambda signal_id: history.view(signal_id, hist_signals))
+    signal_event_index = setup_signal_event_index(event_dict)
+
+    def report():
+        stats = instrumentation.export()
+        instrumentation.reset()
+        return stats
+
+    read = 0
+    reported = time.monotonic()
+    while True:
+        written, closed = history.wait_for_updates(read)
+        if written == read:
+            if closed:
+                break
+            continue
+        riskEvents = []
+        for signal_id, value, timestamp in history.updates(read, written):
+            if signal_history[signal_id] is not None:
+                signal = Signal(signal_id, value, timestamp)
+                update_signal_value(signal_history, signal)
+                risk_event_detector(event_dict, timeout_dict, signal, signal_history, riskEvents.append, signal_event_index)
+        stats = None
+        if instrumented and time.monotonic() - reported >= STATS_INTERVAL:
+            stats = report()
+            reported = time.monotonic()
+        if riskEvents or stats:
+            results.put((riskEvents, stats))
+        read = written
+        history.mark_read(worker, read)
+
+    if instrumented:
+        results.put(([], report()))
+    results.put(None)
+    # The views of the history must be gone before the shared memory can be released. Views and their aggregates
+    # reference each other, so they are only freed by the garbage collector.
+    del signal_history, event_dict, all_events
+    gc.collect()
+    history.release()
+
+
+class ShardedDetector:
+    """
+    Runs the events created by create_event_dict in shards worker processes and calls callback with every RiskEvent.
+    Signals are handed over with submit, as (signal id, value, timestamp) like Signal.
+    """
+
+    def __init__(self, callback, hist_signals, shards, slack=DEFAULT_SLACK, create_event_dict=event_definitions.create_event_dict, registry=None):
+        if registry is None:
+            registry = default_registry()
+        self.callback = callback
+        event_dict = create_event_dict()
+        self.partitions = partition_events(event_dict, shards)
+        signal_history = setup_signal_history(event_dict, hist_signals, registry)
+        # Names of the signals the events use, mapped to their ids
+        self.signal_ids = setup_signal_ids(signal_history, registry)
+        self._tracked = [buffer is not None for buffer in signal_history]
+        self._unpublished = 0
+
+        condition = Condition()
+        self.history = SharedSignalHistory(len(registry), hist_signals, slack, len(self.partitions), condition)
+        history_args = (len(registry), hist_signals, slack, len(self.partitions), condition, self.history.name)
+        self._results = Queue()
+        self.workers = [
+            Process(target=run_worker, args=(i, names, history_args, hist_signals, self._results, create_event_dict, instrumentation.enabled), name=f"detector-shard-{i}", daemon=True)
+            for i, names in enumerate(self.partitions)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self._collector = threading.Thread(target=self._collect, name="detector-shard-collector", daemon=True)
+        self._collector.start()
+
+    def submit(self, signal_id, value, timestamp):
+        """
+        Writes a signal update for the workers. Blocks while the slowest worker is too far behind.
+        """
+        if not self._tracked[signal_id]:
+            return
+        while not self.history.write(signal_id, value, timestamp):
+            self.history.wait_for_space(1.0)
+            self._check_workers()
+        self._unpublished += 1
+        if self._unpublished >= PUBLISH_INTERVAL:
+            self.publish()
+
+    def publish(self):
+        """
+        Hands the submitted updates over to the workers.
+        """
+        self.history.publish()
+        self._unpublished = 0
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if worker.exitcode not in (None, 0):
+                raise RuntimeError(f"Detector worker {worker.name} failed with exit code {worker.exitcode}.")
+
+    def _collect(self):
+        remaining = len(self.workers)
+        while remaining:
+            try:
+                result = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if all(not worker.is_alive() for worker in self.workers):
+                    return
+                continue
+            if result is None:
+                remaining -= 1
+                continue
+            riskEvents, stats = result
+            if stats:
+                instrumentation.merge(stats)
+            for riskEvent in riskEvents:
+                self.callback(riskEvent)
+
+    def close(self):
+        """
+        Waits until the workers processed all submitted updates and their risk events were collected.
+        """
+        self.history.close()
+        self._collector.join()
+        for worker in self.workers:
+            worker.join()
+        self.history.release()
+        self._check_workers()
@@ -0,0 +1,224 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+from applications.insurance_event_detector import signal_history
+from applications.insurance_event_detector.signal_history import SignalBuffer
+
+# Signal history in shared memory, written by one ingest process and read zero-copy by detector worker processes.
+#
+# The shared block holds
+# - a header: the number of updates written, the closed flag and the number of updates read by every worker,
+# - an update log with the signal id, value and timestamp of the last slack updates, in arrival order,
+# - one ring per signal with room for hist_signals + slack samples, each sample written twice as in SignalBuffer.
+#
+# Workers replay the update log at their own pace. Each counts the samples of every signal it has replayed and reads
+# the history as of that position, so it sees the same history as the single-process detector. The ingest process
+# never gets more than slack updates ahead of the slowest worker, so the samples a worker can still read are never
+# overwritten.
+
+_WRITTEN = 0
+_CLOSED = 1
+_READ = 2
+
+
+class SharedSignalHistory:
+
+    def __init__(self, num_signals, hist_signals, slack, workers, condition, name=None):
+        """
+        Creates the shared history, or attaches to the existing one called name.
+        condition (a multiprocessing.Condition) guards the header and wakes up waiting processes.
+        """
+        if slack < 1:
+            raise ValueError("Slack of the shared signal history must be at least 1.")
+        self.num_signals = num_signals
+        self.slack = slack
+        self.workers = workers
+        self.condition = condition
+        self.ring_capacity = hist_signals + slack
+
+        header_size = _READ + workers
+        ring_size = 2 * self.ring_capacity
+        size = 8 * (header_size + 3 * slack + num_signals * ring_size)
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._owner = True
+        else:
+            # Worker processes share the resource tracker of the creating process, which unlinks the block
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self.name = self._shm.name
+
+        offset = 0
+        def array(dtype, shape):
+            nonlocal offset
+            a = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+            offset += a.nbytes
+            return a
+        self.header = array(np.int64, header_size)
+        self.log_signal = array(np.int64, slack)
+        self.log_value = array(np.float64, slack)
+        self.log_timestamp = array(np.float64, slack)
+        self.rings = array(np.float64, (num_signals, ring_size))
+
+        # State of the ingest process
+        self._written = 0
+        self._published = 0
+        self._min_read = 0
+        self._counts = [0] * num_signals
+
+    # Ingest process
+
+    def write(self, signal_id, value, timestamp):
+        """
+        Appends an update, without making it visible to the workers yet (see publish).
+
+        Returns:
+            False if the slowest worker is slack updates behind, nothing is written then
+        """
+        written = self._written
+        if written - self._min_read >= self.slack:
+            return False
+        i = written % self.slack
+        self.log_signal[i] = signal_id
+        self.log_value[i] = value
+        self.log_timestamp[i] = timestamp
+        count = self._counts[signal_id]
+        p = count % self.ring_capacity
+        ring = self.rings[signal_id]
+        ring[p] = value
+        ring[p + self.ring_capacity] = value
+        self._counts[signal_id] = count + 1
+        self._written = written + 1
+        return True
+
+    def publish(self):
+        """
+        Makes the written updates visible to the workers.
+        """
+        if self._written == self._published:
+            return
+        with self.condition:
+            self.header[_WRITTEN] = self._written
+            self.condition.notify_all()
+        self._published = self._written
+
+    def wait_for_space(self, timeout=None):
+        """
+        Publishes the written updates and waits up to timeout seconds until a worker has caught up.
+        """
+        self.publish()
+        with self.condition:
+            self._min_read = int(self.header[_READ:].min())
+            if self._written - self._min_read >= self.slack:
+                self.condition.wait(timeout)
+                self._min_read = int(self.header[_READ:].min())
+
+    def close(self):
+        """
+        Publishes the written updates and tells the workers that no more will follow.
+        """
+        self.publish()
+        with self.condition:
+            self.header[_CLOSED] = 1
+            self.condition.notify_all()
+
+    # Worker processes
+
+    def wait_for_updates(self, read):
+        """
+        Waits until updates past read are published or the history is closed.
+
+        Returns:
+            The number of updates published and if the history is closed
+        """
+        with self.condition:
+            while True:
+                written = int(self.header[_WRITTEN])
+                closed = bool(self.header[_CLOSED])
+                if written > read or closed:
+                    return written, closed
+                self.condition.wait()
+
+    def updates(self, start, end):
+        """
+        Returns the updates from start to end as (signal id, value, timestamp) tuples.
+        """
+        positions = np.arange(start, end) % self.slack
+        return zip(self.log_signal[positions].tolist(), self.log_value[positions].tolist(), self.log_timestamp[positions].tolist())
+
+    def mark_read(self, worker, read):
+        with self.condition:
+            self.header[_READ + worker] = read
+            self.condition.notify_all()
+
+    def view(self, signal_id, hist_signals):
+        return SharedSignalView(self.rings[signal_id], hist_signals)
+
+    def release(self):
+        """
+        Detaches from the shared memory, and frees it in the creating process.
+        All views must be released before.
+        """
+        self.header = self.log_signal = self.log_value = self.log_timestamp = self.rings = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+# History of one signal as seen by a worker: the last capacity samples before the position of the worker in the
+# update log, read from the shared ring without copying. append advances the position by one sample, which
+# the ingest process has already written. Aggregates are maintained locally by each worker.
+#
+# A view never writes to the shared ring, the ingest process is its only writer. All state of a view (its position,
+# how many samples it holds, its aggregates) is local, so clear only forgets the samples seen by this worker.
+class SharedSignalView(SignalBuffer):
+
+    def __init__(self, ring, capacity):
+        if capacity < 1 or 2 * capacity > len(ring):
+            raise ValueError(f"Capacity {capacity} of a shared signal view must be between 1 and the ring capacity.")
+        self.capacity = capacity
+        self._ring = ring
+        self._ring_capacity = len(ring) // 2
+        self._total = 0
+        self._count = 0
+        self.generation = next(signal_history._generations)
+        self._aggregates = {}
+        self._aggregate_list = []
+
+    def append(self, value, timestamp=None):
+        total = self._total
+        for aggregate in self._aggregate_list:
+            window = aggregate.window
+            evicted = self._ring[(total - window) % self._ring_capacity] if self._count >= window else None
+            aggregate.push(value, evicted)
+        self._total = total + 1
+        if self._count < self.capacity:
+            self._count += 1
+        self.generation = next(signal_history._generations)
+
+    def _end(self):
+        return self._total % self._ring_capacity + self._ring_capacity
+
+    def last(self):
+        if self._count == 0:
+            raise IndexError("Signal buffer is empty.")
+        return self._ring[self._end() - 1]
+
+    def back(self, n):
+        if n < 1 or n > self._count:
+            raise IndexError(f"Signal buffer holds {self._count} values, cannot go back {n}.")
+        return self._ring[self._end() - n]
+
+    def last_n(self, n):
+        n = min(n, self._count)
+        end = self._end()
+        view = self._ring[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        # The position stays, the next append is still the next sample of the update log
+        self._count = 0
+        self.generation = next(signal_history._generations)
+        for aggregate in self._aggregate_list:
+            aggregate.clear()
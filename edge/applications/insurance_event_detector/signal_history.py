@@ -0,0 +1,470 @@
+from collections import deque
+from itertools import count
+
+import numpy as np
+
+
+# Generations of all signal buffers of the process, see SignalBuffer.generation
+_generations = count(1)
+
+
+# Fixed-size circular history of a single signal.
+#
+# Each sample is written twice, at position i and i + capacity, so the most recent samples
+# are always available as one contiguous view of the array. Appending is O(1) and never
+# allocates, and reading the last N samples returns a view instead of a copy.
+class SignalBuffer:
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Capacity of a signal buffer must be at least 1.")
+        self.capacity = capacity
+        self._data = np.full(2 * capacity, np.nan)
+        self._pos = 0
+        self._count = 0
+        # Changes with every change of the buffer, so values derived from it can be cached until the next one.
+        # Generations are unique across all buffers, so a generation alone identifies the buffer and its state.
+        self.generation = next(_generations)
+        # Incremental aggregates keyed by (method, window), shared by every condition using them
+        self._aggregates = {}
+        self._aggregate_list = []
+
+    def __len__(self):
+        return self._count
+
+    def append(self, value, timestamp=None):
+        """
+        Appends a sample. Its timestamp is only kept by TimedSignalBuffer.
+        """
+        pos = self._pos
+        for aggregate in self._aggregate_list:
+            window = aggregate.window
+            # Value leaving the window of this aggregate with this append, if the window is full
+            evicted = self._data[pos + self.capacity - window] if self._count >= window else None
+            aggregate.push(value, evicted)
+        self._data[pos] = value
+        self._data[pos + self.capacity] = value
+        pos += 1
+        self._pos = 0 if pos == self.capacity else pos
+        if self._count < self.capacity:
+            self._count += 1
+        self.generation = next(_generations)
+
+    def last(self):
+        """
+        Returns the most recent value.
+        """
+        if self._count == 0:
+            raise IndexError("Signal buffer is empty.")
+        return self._data[self._pos + self.capacity - 1]
+
+    def back(self, n):
+        """
+        Returns the value n samples back, where back(1) is the most recent value.
+        Equivalent to history[-n] on a list.
+        """
+        if n < 1 or n > self._count:
+            raise IndexError(f"Signal buffer holds {self._count} values, cannot go back {n}.")
+        return self._data[self._pos + self.capacity - n]
+
+    def last_n(self, n):
+        """
+        Returns a read-only view of the last n values, oldest first.
+        Fewer values are returned if the buffer does not hold n values yet, like history[-n:] on a list.
+        The view is overwritten by later appends, copy it if it needs to be kept.
+        """
+        n = min(n, self._count)
+        end = self._pos + self.capacity
+        view = self._data[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def add_aggregate(self, method, window):
+        """
+        Registers an incremental aggregate ("mean", "min" or "max") over the last window values.
+        Registering the same aggregate twice returns the existing one.
+        """
+        key = (method, window)
+        aggregate = self._aggregates.get(key)
+        if aggregate is None:
+            if window < 1 or window > self.capacity:
+                raise ValueError(f"Window {window} of aggregate {method} must be between 1 and the buffer capacity {self.capacity}.")
+            if method == "mean":
+                aggregate = RollingMean(self, window)
+            elif method == "min":
+                aggregate = RollingExtreme(window, lambda kept, new: kept <= new)
+            elif method == "max":
+                aggregate = RollingExtreme(window, lambda kept, new: kept >= new)
+            else:
+                raise ValueError(f"Aggregate {method} is not supported. Supported aggregates are: [mean, min, max].")
+            # Catch up with the values already in the buffer
+            for value in self.last_n(window):
+                aggregate.push(value, None)
+            self._aggregates[key] = aggregate
+            self._aggregate_list.append(aggregate)
+        return aggregate
+
+    def mean(self, n):
+        aggregate = self._aggregates.get(("mean", n))
+        if aggregate is None:
+            return np.mean(self.last_n(n))
+        return aggregate.value()
+
+    def min(self, n):
+        aggregate = self._aggregates.get(("min", n))
+        if aggregate is None:
+            return self.last_n(n).min()
+        return aggregate.value()
+
+    def max(self, n):
+        aggregate = self._aggregates.get(("max", n))
+        if aggregate is None:
+            return self.last_n(n).max()
+        return aggregate.value()
+
+    def clear(self):
+        self._pos = 0
+        self._count = 0
+        self.generation = next(_generations)
+        for aggregate in self._aggregate_list:
+            aggregate.clear()
+
+
+# Running mean over the last window values of a SignalBuffer.
+# The sum is recomputed from the buffer once every window updates, so rounding errors
+# cannot accumulate while the cost stays amortized O(1) per sample.
+class RollingMean:
+
+    def __init__(self, buffer, window):
+        self._buffer = buffer
+        self.window = window
+        self.clear()
+
+    def clear(self):
+        self._sum = 0.0
+        self._nan_count = 0
+        self._since_resync = 0
+
+    def push(self, value, evicted):
+        if value != value:
+            self._nan_count += 1
+        else:
+            self._sum += value
+        if evicted is not None:
+            if evicted != evicted:
+                self._nan_count -= 1
+            else:
+                self._sum -= evicted
+        self._since_resync += 1
+
+    def value(self):
+        count = min(len(self._buffer), self.window)
+        if self._nan_count or count == 0:
+            return np.nan
+        if self._since_resync >= self.window:
+            self._since_resync = 0
+            self._sum = float(np.sum(self._buffer.last_n(self.window)))
+        return self._sum / count
+
+
+# Running minimum or maximum over the last window values of a SignalBuffer, using a monotonic
+# deque of (sample index, value). keep(kept, new) tells if an older value still beats the new one.
+class RollingExtreme:
+
+    def __init__(self, window, keep):
+        self.window = window
+        self._keep = keep
+        self.clear()
+
+    def clear(self):
+        self._candidates = deque()
+        self._nan_indices = deque()
+        self._index = 0
+
+    def push(self, value, evicted):
+        index = self._index
+        self._index = index + 1
+        candidates = self._candidates
+        if value != value:
+            self._nan_indices.append(index)
+        else:
+            keep = self._keep
+            while candidates and not keep(candidates[-1][1], value):
+                candidates.pop()
+            candidates.append((index, value))
+        oldest = index - self.window
+        while candidates and candidates[0][0] <= oldest:
+            candidates.popleft()
+        nan_indices = self._nan_indices
+        while nan_indices and nan_indices[0] <= oldest:
+            nan_indices.popleft()
+
+    def value(self):
+        if self._nan_indices or not self._candidates:
+            return np.nan
+        return self._candidates[0][1]
+
+
+# History of a signal with the timestamp of every sample, for conditions and captures over time windows.
+#
+# Samples are kept while they are within retention seconds of the latest sample, plus the newest one before that so
+# the value at any time of the retention can be looked up, and never fewer than the last capacity samples, so the
+# sample-based lookups of SignalBuffer behave the same. Memory is bounded by the retention instead of a sample count.
+# Values and timestamps are two growing arrays, the retained samples being one contiguous slice of each, and time
+# lookups are binary searches over the timestamps. Timestamps of a signal must not decrease.
+class TimedSignalBuffer(SignalBuffer):
+
+    def __init__(self, capacity, retention):
+        if capacity < 1:
+            raise ValueError("Capacity of a signal buffer must be at least 1.")
+        if not retention > 0:
+            raise ValueError("Retention of a timed signal buffer must be a positive number of seconds.")
+        self.capacity = capacity
+        self.retention = retention
+        size = max(16, 2 * capacity)
+        self._values = np.full(size, np.nan)
+        self._timestamps = np.full(size, np.nan)
+        self._head = 0
+        self._tail = 0
+        # Number of samples appended so far, samples are numbered in that order
+        self._total = 0
+        self._count = 0
+        self.first_timestamp = None
+        self.generation = next(_generations)
+        self._aggregates = {}
+        self._aggregate_list = []
+        self._time_aggregates = {}
+        self._time_aggregate_list = []
+
+    def append(self, value, timestamp=None):
+        if timestamp is None:
+            raise ValueError("Samples of a timed signal buffer need a timestamp.")
+        if self._tail == len(self._values):
+            self._make_room()
+        tail = self._tail
+        for aggregate in self._aggregate_list:
+            window = aggregate.window
+            evicted = self._values[tail - window] if self._count >= window else None
+            aggregate.push(value, evicted)
+        self._values[tail] = value
+        self._timestamps[tail] = timestamp
+        self._tail = tail + 1
+        self._total += 1
+        if self._count < self.capacity:
+            self._count += 1
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        for aggregate in self._time_aggregate_list:
+            aggregate.push(value, timestamp)
+        # Drop the oldest sample while the next one is old enough to answer lookups at the start of the retention
+        limit = timestamp - self.retention
+        head = self._head
+        while self._tail - head > self.capacity and self._timestamps[head + 1] <= limit:
+            head += 1
+        self._head = head
+        self.generation = next(_generations)
+
+    def _make_room(self):
+        size = self._tail - self._head
+        if size > len(self._values) // 2:
+            # Mostly full, grow instead of moving the samples to the front only
+            values = np.full(2 * len(self._values), np.nan)
+            timestamps = np.full(2 * len(self._timestamps), np.nan)
+        else:
+            values = self._values
+            timestamps = self._timestamps
+        values[:size] = self._values[self._head:self._tail]
+        timestamps[:size] = self._timestamps[self._head:self._tail]
+        self._values = values
+        self._timestamps = timestamps
+        self._head = 0
+        self._tail = size
+
+    def _position(self, index):
+        # Position of the sample with the given number in the arrays
+        return self._tail - (self._total - index)
+
+    def last(self):
+        if self._count == 0:
+            raise IndexError("Signal buffer is empty.")
+        return self._values[self._tail - 1]
+
+    def back(self, n):
+        if n < 1 or n > self._count:
+            raise IndexError(f"Signal buffer holds {self._count} values, cannot go back {n}.")
+        return self._values[self._tail - n]
+
+    def last_n(self, n):
+        n = min(n, self._count)
+        view = self._values[self._tail - n:self._tail]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def last_timestamp(self):
+        if self._count == 0:
+            raise IndexError("Signal buffer is empty.")
+        return self._timestamps[self._tail - 1]
+
+    def covers(self, window):
+        """
+        Tells if the signal has been recorded for at least window seconds before its latest sample.
+        """
+        return self._count > 0 and self.first_timestamp <= self._timestamps[self._tail - 1] - window
+
+    def value_at(self, timestamp):
+        """
+        Returns the value the signal had at timestamp, i.e. of the latest sample not after it.
+        """
+        i = int(np.searchsorted(self._timestamps[self._head:self._tail], timestamp, side='right'))
+        if i == 0:
+            raise IndexError(f"Signal buffer holds no value at {timestamp}.")
+        return self._values[self._head + i - 1]
+
+    def window_values(self, window):
+        """
+        Returns a read-only view of the values of the last window seconds, i.e. after the latest timestamp - window,
+        oldest first. The view is overwritten by later appends, copy it if it needs to be kept.
+        """
+        if self._count == 0:
+            return self._values[0:0]
+        limit = self._timestamps[self._tail - 1] - window
+        start = self._head + int(np.searchsorted(self._timestamps[self._head:self._tail], limit, side='right'))
+        view = self._values[start:self._tail]
+        view.flags.writeable = False
+        return view
+
+    def add_time_aggregate(self, method, window):
+        """
+        Registers an incremental aggregate ("mean", "min" or "max") over the values of the last window seconds.
+        Registering the same aggregate twice returns the existing one.
+        """
+        key = (method, window)
+        aggregate = self._time_aggregates.get(key)
+        if aggregate is None:
+            if not 0 < window <= self.retention:
+                raise ValueError(f"Window {window} of aggregate {method} must be positive and within the retention {self.retention}.")
+            if method == "mean":
+                aggregate = TimeWindowMean(self, window)
+            elif method == "min":
+                aggregate = TimeWindowExtreme(window, lambda kept, new: kept <= new)
+            elif method == "max":
+                aggregate = TimeWindowExtreme(window, lambda kept, new: kept >= new)
+            else:
+                raise ValueError(f"Aggregate {method} is not supported. Supported aggregates are: [mean, min, max].")
+            # Catch up with the values already in the buffer
+            for position in range(self._head, self._tail):
+                aggregate.push(self._values[position], self._timestamps[position])
+            self._time_aggregates[key] = aggregate
+            self._time_aggregate_list.append(aggregate)
+        return aggregate
+
+    def mean_over(self, window):
+        aggregate = self._time_aggregates.get(("mean", window))
+        if aggregate is None:
+            return np.mean(self.window_values(window))
+        return aggregate.value()
+
+    def min_over(self, window):
+        aggregate = self._time_aggregates.get(("min", window))
+        if aggregate is None:
+            return self.window_values(window).min()
+        return aggregate.value()
+
+    def max_over(self, window):
+        aggregate = self._time_aggregates.get(("max", window))
+        if aggregate is None:
+            return self.window_values(window).max()
+        return aggregate.value()
+
+    def clear(self):
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+        self.first_timestamp = None
+        self.generation = next(_generations)
+        for aggregate in self._aggregate_list + self._time_aggregate_list:
+            aggregate.clear()
+
+
+# Running mean over the values of the last window seconds of a TimedSignalBuffer, from the oldest sample in the
+# window to the latest. As in RollingMean, the sum is recomputed from the buffer regularly.
+class TimeWindowMean:
+
+    def __init__(self, buffer, window):
+        self._buffer = buffer
+        self.window = window
+        self.clear()
+
+    def clear(self):
+        # Number of the oldest sample in the window, the samples already in the buffer are pushed when registering
+        buffer = self._buffer
+        self._start = buffer._total - (buffer._tail - buffer._head)
+        self._sum = 0.0
+        self._nan_count = 0
+        self._since_resync = 0
+
+    def push(self, value, timestamp):
+        if value != value:
+            self._nan_count += 1
+        else:
+            self._sum += value
+        buffer = self._buffer
+        limit = timestamp - self.window
+        start = self._start
+        position = buffer._position(start)
+        while buffer._timestamps[position] <= limit:
+            evicted = buffer._values[position]
+            if evicted != evicted:
+                self._nan_count -= 1
+            else:
+                self._sum -= evicted
+            start += 1
+            position += 1
+        self._start = start
+        self._since_resync += 1
+
+    def value(self):
+        buffer = self._buffer
+        count = buffer._total - self._start
+        if self._nan_count or count == 0:
+            return np.nan
+        if self._since_resync >= count:
+            self._since_resync = 0
+            self._sum = float(np.sum(buffer._values[buffer._position(self._start):buffer._tail]))
+        return self._sum / count
+
+
+# Running minimum or maximum over the values of the last window seconds, using a monotonic deque of
+# (timestamp, value) as RollingExtreme does with sample indices.
+class TimeWindowExtreme:
+
+    def __init__(self, window, keep):
+        self.window = window
+        self._keep = keep
+        self.clear()
+
+    def clear(self):
+        self._candidates = deque()
+        self._nan_timestamps = deque()
+
+    def push(self, value, timestamp):
+        candidates = self._candidates
+        if value != value:
+            self._nan_timestamps.append(timestamp)
+        else:
+            keep = self._keep
+            while candidates and not keep(candidates[-1][1], value):
+                candidates.pop()
+            candidates.append((timestamp, value))
+        limit = timestamp - self.window
+        while candidates and candidates[0][0] <= limit:
+            candidates.popleft()
+        nan_timestamps = self._nan_timestamps
+        while nan_timestamps and nan_timestamps[0] <= limit:
+            nan_timestamps.popleft()
+
+    def value(self):
+        if self._nan_timestamps or not self._candidates:
+            return np.nan
+        return self._candidates[0][1]
@@ -0,0 +1,60 @@
+import json
+import os
+
+# Integer ids of the signals of the vehicle.
+#
+# Every property of the DTDL model gets the index of its position in the model contents as id, so ids are dense
+# and stable as long as properties are only appended to the model. The detector identifies signals by these ids
+# (history, conditions, captured event data) and only uses names where signals enter or leave it. The schema of
+# every signal types its samples in the protobuf uplink (see risk_event_codec).
+
+DEFAULT_TWIN_FILE = os.path.join(os.path.dirname(__file__), "..", "..", "digital-twin-model", "dtdl", "vehicle.json")
+
+
+class SignalRegistry:
+
+    def __init__(self, names, schemas, dtdl_ids=None):
+        self.names = list(names)
+        self.schemas = list(schemas)
+        self.dtdl_ids = list(dtdl_ids) if dtdl_ids is not None else [None] * len(self.names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def id_of(self, name):
+        signal_id = self.ids.get(name)
+        if signal_id is None:
+            raise ValueError(f"Signal {name} is not part of the DTDL model.")
+        return signal_id
+
+    def name_of(self, signal_id):
+        return self.names[signal_id]
+
+    def data_by_name(self, eventData):
+        """
+        Returns captured event data keyed by signal name instead of id. Keys that are not ids, like start, are kept.
+        """
+        return {(self.names[k] if type(k) is int else k): v for k, v in eventData.items()}
+
+
+def load_signal_registry(twinFile=DEFAULT_TWIN_FILE):
+    with open(twinFile) as f:
+        properties = [c for c in json.load(f)['contents'] if c['@type'] == "Property"]
+    return SignalRegistry([p['name'] for p in properties], [p['schema'] for p in properties], [p['@id'] for p in properties])
+
+
+_default_registry = None
+
+
+def default_registry():
+    """
+    Returns the registry of the default DTDL model, loaded once.
+    """
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = load_signal_registry()
+    return _default_registry
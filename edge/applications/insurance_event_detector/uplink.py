@@ -0,0 +1,368 @@
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+from applications.insurance_event_detector import risk_event_codec
+from applications.insurance_event_detector.signal_registry import default_registry
+
+# Store-and-forward uplink of risk events to the cloud.
+#
+# Risk events are collected into batches that are closed when they reach max_batch_events or when the oldest
+# event has waited max_batch_delay seconds. A closed batch is serialized as a JSON list of events (the format of
+# data/out/risk_events.json) or as a protobuf RiskEventBatch (see risk_event_codec), compressed with zlib and appended to an on-disk spool. A background thread sends
+# the spooled batches in order and records the offset of the last acknowledged one, so batches survive
+# connectivity gaps and restarts.
+#
+# - Offsets are logical, they keep growing over the life of the spool. The spool file starts with the offset of
+#   its first record, so the acknowledged offset stays valid when the file is rewritten.
+# - Once everything is acknowledged, or the acknowledged records reach COMPACT_BYTES, the file is rewritten with
+#   the unacknowledged records only.
+# - The unacknowledged records are limited to max_bytes. When a new batch exceeds it, the oldest unsent batches
+#   are dropped (counted in dropped_batches), so the spool holds the most recent events. The newest batch is
+#   always kept.
+#
+# Spool file: magic (8 bytes) | offset of the first record (uint64, little endian) | records
+# Spool record: payload length (uint32, little endian) | CRC32 of the payload (uint32, little endian) | payload
+
+SPOOL_FILE = "risk_events.spool"
+ACK_FILE = "risk_events.ack"
+
+SPOOL_MAGIC = b"EISPOOL\x01"
+
+# Acknowledged bytes after which the spool file is rewritten without them
+COMPACT_BYTES = 1 << 20
+
+# Default limit of the unacknowledged batches in the spool
+DEFAULT_MAX_SPOOL_BYTES = 64 << 20
+
+_SPOOL_HEADER = struct.Struct("<8sQ")
+_RECORD_HEADER = struct.Struct("<II")
+
+
+def serialize_risk_event(riskEvent, registry=None):
+    if registry is None:
+        registry = default_registry()
+    event = {
+        "name": riskEvent.name,
+        "eventId": riskEvent.eventId,
+        "riskLevel": riskEvent.riskLevel,
+        "timestamp": riskEvent.timestamp,
+        "eventData": registry.data_by_name(riskEvent.eventData),
+    }
+    if riskEvent.sourceId is not None:
+        event["sourceId"] = riskEvent.sourceId
+    return event
+
+
+def encode_batch(riskEvents, level=6):
+    return zlib.compress(json.dumps([serialize_risk_event(e) for e in riskEvents]).encode("utf-8"), level)
+
+
+def protobuf_batch_encoder(registry, float_values=False, level=6):
+    """
+    Returns an encoder for Uplink that sends batches in the protobuf format instead of JSON.
+    """
+    def encode(riskEvents):
+        return zlib.compress(risk_event_codec.encode_risk_events(riskEvents, registry, float_values), level)
+    return encode
+
+
+def decode_batch(payload):
+    """
+    Returns the events of a compressed batch as dictionaries.
+    """
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+class Spool:
+    """
+    Append-only file of compressed batches, with the offset up to which they were acknowledged.
+    A partially written record at the end of the file (e.g. after a power loss) is discarded when opening it.
+    max_bytes limits the unacknowledged batches, None keeps all of them.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_SPOOL_BYTES, compact_bytes=COMPACT_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.spool_file = os.path.join(directory, SPOOL_FILE)
+        self.ack_file = os.path.join(directory, ACK_FILE)
+        self.max_bytes = max_bytes
+        self.compact_bytes = compact_bytes
+        self.dropped_batches = 0
+        self._lock = threading.Lock()
+        self.ack_offset = self._read_ack_offset()
+        self._recover()
+        self._file = open(self.spool_file, "ab")
+
+    def _read_ack_offset(self):
+        try:
+            with open(self.ack_file) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_ack_offset(self, offset):
+        tmp = self.ack_file + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.ack_file)
+
+    def _position(self, offset):
+        # Position of a logical offset in the spool file
+        return offset - self.base + _SPOOL_HEADER.size
+
+    def _recover(self):
+        # Find the end of the last complete record and cut anything after it
+        if not os.path.exists(self.spool_file):
+            self.size = self.ack_offset
+            self._rewrite(self.ack_offset, None)
+            return
+        with open(self.spool_file, "r+b") as f:
+            header = f.read(_SPOOL_HEADER.size)
+            if len(header) == _SPOOL_HEADER.size and header[:len(SPOOL_MAGIC)] == SPOOL_MAGIC:
+                self.base = _SPOOL_HEADER.unpack(header)[1]
+                start = _SPOOL_HEADER.size
+            else:
+                # Spool written without header, its offsets start at 0
+                self.base = 0
+                start = 0
+            f.seek(start)
+            valid = start
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    break
+                length, crc = _RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                valid = f.tell()
+            f.truncate(valid)
+        self.size = self.base + valid - start
+        self.ack_offset = min(max(self.ack_offset, self.base), self.size)
+        if not start:
+            # Rewrite it with a header, keeping the unacknowledged records
+            with open(self.spool_file, "rb") as f:
+                f.seek(self.ack_offset)
+                self._rewrite(self.ack_offset, f)
+
+    def _rewrite(self, base, records):
+        # Replaces the spool file with the records read from the file object records, starting at offset base
+        tmp = self.spool_file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_SPOOL_HEADER.pack(SPOOL_MAGIC, base))
+            if records is not None:
+                shutil.copyfileobj(records, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.spool_file)
+        self.base = base
+
+    def _compact(self):
+        # Drops the acknowledged records, the acknowledged offset is already on disk
+        self._file.close()
+        with open(self.spool_file, "rb") as f:
+            f.seek(self._position(self.ack_offset))
+            self._rewrite(self.ack_offset, f)
+        self._file = open(self.spool_file, "ab")
+
+    def _set_ack_offset(self, offset):
+        self.ack_offset = offset
+        self._write_ack_offset(offset)
+        if offset >= self.size or offset - self.base >= self.compact_bytes:
+            self._compact()
+
+    def _drop_oldest(self):
+        # Drops the oldest unacknowledged batches until the rest fits in max_bytes, keeping the newest one
+        offset = self.ack_offset
+        with open(self.spool_file, "rb") as f:
+            while self.size - offset > self.max_bytes:
+                f.seek(self._position(offset))
+                length, _ = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+                next_offset = offset + _RECORD_HEADER.size + length
+                if next_offset >= self.size:
+                    break
+                offset = next_offset
+                self.dropped_batches += 1
+        if offset > self.ack_offset:
+            self._set_ack_offset(offset)
+
+    def append(self, payload):
+        with self._lock:
+            self._file.write(_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.size = self.base + self._file.tell() - _SPOOL_HEADER.size
+            if self.max_bytes is not None and self.size - self.ack_offset > self.max_bytes:
+                self._drop_oldest()
+
+    def pending_bytes(self):
+        with self._lock:
+            return self.size - self.ack_offset
+
+    def next_record(self):
+        """
+        Returns the oldest unacknowledged payload and the offset following it, or None if all were acknowledged.
+        """
+        with self._lock:
+            if self.ack_offset >= self.size:
+                return None
+            offset = self.ack_offset
+            with open(self.spool_file, "rb") as f:
+                f.seek(self._position(offset))
+                length, _ = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+                return f.read(length), offset + _RECORD_HEADER.size + length
+
+    def acknowledge(self, offset):
+        with self._lock:
+            # The batch may have been dropped while it was sent
+            if offset > self.ack_offset:
+                self._set_ack_offset(offset)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Uplink:
+    """
+    Buffers risk events into batches, spools them and sends them in the background with send(payload),
+    which gets the compressed batch and must raise (or return False) if it was not delivered.
+    Batches are encoded with encode, JSON by default. The spool keeps at most max_spool_bytes of unsent batches.
+    """
+
+    def __init__(self, spool_dir, send, max_batch_events=50, max_batch_delay=5.0, retry_interval=1.0, max_retry_interval=60.0, encode=encode_batch, max_spool_bytes=DEFAULT_MAX_SPOOL_BYTES):
+        self.spool = Spool(spool_dir, max_spool_bytes)
+        self.send = send
+        self.encode = encode
+        self.max_batch_events = max_batch_events
+        self.max_batch_delay = max_batch_delay
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+
+        self._pending = []
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._batch_ready = threading.Condition(self._lock)
+        self._spooled = threading.Condition()
+        self._stop = False
+        self._closed = False
+
+        self.events = 0
+        self.batches = 0
+        self.sent_batches = 0
+        self.failed_sends = 0
+
+        self._batcher = threading.Thread(target=self._run_batcher, name="uplink-batcher", daemon=True)
+        self._drainer = threading.Thread(target=self._run_drainer, name="uplink-drainer", daemon=True)
+        self._batcher.start()
+        self._drainer.start()
+
+    def submit(self, riskEvent):
+        """
+        Adds a risk event to the current batch. Never waits for disk or network.
+        """
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append(riskEvent)
+            self.events += 1
+            if len(self._pending) >= self.max_batch_events:
+                self._batch_ready.notify()
+
+    def _take_batch(self):
+        batch = self._pending[:self.max_batch_events]
+        del self._pending[:self.max_batch_events]
+        # Events left over from a burst form the next batch
+        self._pending_since = time.monotonic() if self._pending else None
+        return batch
+
+    def _spool_batch(self, batch):
+        self.spool.append(self.encode(batch))
+        self.batches += 1
+        with self._spooled:
+            self._spooled.notify()
+
+    def _run_batcher(self):
+        while True:
+            with self._lock:
+                while not self._stop:
+                    if len(self._pending) >= self.max_batch_events:
+                        break
+                    if self._pending and time.monotonic() - self._pending_since >= self.max_batch_delay:
+                        break
+                    wait = self.max_batch_delay - (time.monotonic() - self._pending_since) if self._pending else None
+                    self._batch_ready.wait(wait)
+                batch = self._take_batch()
+                done = self._stop and not self._pending
+            # Compress and write outside of the lock, so submit is never blocked by the disk
+            if batch:
+                self._spool_batch(batch)
+            if done:
+                return
+
+    def _run_drainer(self):
+        backoff = self.retry_interval
+        while not self._closed:
+            record = self.spool.next_record()
+            if record is None:
+                with self._spooled:
+                    if self._stop and not self._batcher.is_alive():
+                        return
+                    self._spooled.wait(self.retry_interval)
+                continue
+            payload, next_offset = record
+            try:
+                delivered = self.send(payload) is not False
+            except Exception as e:
+                print(f"Sending risk events failed: {e}")
+                delivered = False
+            if delivered:
+                self.spool.acknowledge(next_offset)
+                self.sent_batches += 1
+                backoff = self.retry_interval
+            else:
+                self.failed_sends += 1
+                with self._spooled:
+                    if self._stop:
+                        # Keep retrying at the normal interval while close waits
+                        backoff = self.retry_interval
+                    self._spooled.wait(backoff)
+                backoff = min(backoff * 2, self.max_retry_interval)
+
+    def close(self, timeout=10.0):
+        """
+        Spools the current batch and waits up to timeout seconds for the spool to be sent.
+        Whatever is not sent by then stays in the spool for the next start.
+        """
+        with self._lock:
+            self._stop = True
+            self._batch_ready.notify()
+        self._batcher.join()
+        deadline = time.monotonic() + timeout
+        while self.spool.pending_bytes() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._spooled:
+            self._closed = True
+            self._spooled.notify()
+        self._drainer.join()
+        self.spool.close()
+
+    def metrics(self):
+        with self._lock:
+            pending_events = len(self._pending)
+        return {
+            "events": self.events,
+            "pending_events": pending_events,
+            "batches": self.batches,
+            "sent_batches": self.sent_batches,
+            "failed_sends": self.failed_sends,
+            "spool_bytes": self.spool.pending_bytes(),
+            "dropped_batches": self.spool.dropped_batches,
+        }
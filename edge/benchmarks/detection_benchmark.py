@@ -0,0 +1,288 @@
+"""
+SPDX-FileCopyrightText: 2023 Contributors to the Eclipse Foundation
+
+See the NOTICE file(s) distributed with this work for additional
+information regarding copyright ownership.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+from applications.insurance_event_detector import event_definitions
+from applications.insurance_event_detector.condition_matrix import ConditionMatrix
+from applications.insurance_event_detector.event_detector import Signal, risk_event_detector, setup_signal_event_index, setup_signal_history, setup_timeout_dict, update_signal_value
+from applications.insurance_event_detector.signal_registry import default_registry
+from recording.synthetic import generate_signal_columns
+
+# Micro-benchmarks for the detection hot path.
+#
+# A synthetic signal stream shaped like the properties of the DTDL model (one signal per property, each updated
+# every 10-100 ms, values following the property schema) is run against the default event definitions and
+# against rule sets scaled up by cloning them. For each benchmark the throughput, the p50/p99 latency per
+# operation and the memory allocated while running are reported and saved as JSON, so results can be
+# compared across commits with --compare.
+
+DEFAULT_TWIN_FILE = os.path.join(os.path.dirname(__file__), "..", "digital-twin-model", "dtdl", "vehicle.json")
+
+HIST_SIGNALS = 60
+
+
+def generate_signal_stream(twinFile, duration, seed=0):
+    """
+    Generates signal updates for every property of the DTDL model, ordered by timestamp.
+
+    Returns:
+        A list of Signal objects
+    """
+    names, signalIds, timestamps, values = generate_signal_columns(twinFile, duration, seed)
+    registry = default_registry()
+    ids = [registry.id_of(name) for name in names]
+    return [Signal(ids[i], value, timestamp) for i, timestamp, value in zip(signalIds.tolist(), timestamps.tolist(), values.tolist())]
+
+
+def scaled_event_dict(scale):
+    """
+    Returns the default event definitions cloned scale times, as a stand-in for larger per-insurer rule sets.
+    Clones reference the clones of their upstream events in event_name conditions.
+    """
+    base = event_definitions.create_event_dict()
+    if scale == 1:
+        return base
+    event_dict = {}
+    for i in range(scale):
+        for name, event in base.items():
+            startConditions = copy.deepcopy(event.startConditions)
+            endConditions = copy.deepcopy(event.endConditions)
+            for cond in startConditions + endConditions:
+                if cond.get("event_name", False):
+                    cond["event_name"] = f"{cond['event_name']}_{i}"
+            event_dict[f"{name}_{i}"] = event_definitions.EventDefinition(
+                name=f"{name}_{i}",
+                eventId=event.eventId,
+                riskLevel=event.riskLevel,
+                startConditions=startConditions,
+                endConditions=endConditions,
+                eventData=dict(event.eventData),
+                timeout=event.timeout
+            )
+    return event_dict
+
+
+def _summarize(name, scale, latencies_ns, elapsed, memory):
+    latencies = np.array(latencies_ns, dtype=np.float64) / 1000
+    return {
+        "name": name,
+        "rule_set_size": scale,
+        "operations": len(latencies),
+        "throughput_per_s": len(latencies) / elapsed if elapsed > 0 else float("inf"),
+        "p50_us": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+        "p99_us": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        "alloc_peak_bytes": memory[0],
+        "alloc_retained_bytes": memory[1],
+    }
+
+
+# Stands in for the latency list while tracing allocations, so the list itself is not counted
+class _Discard:
+
+    def append(self, value):
+        pass
+
+
+def _measure_memory(run):
+    # Allocations are traced in a separate pass, tracing distorts the timings
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - before, current - before
+
+
+def _detector_state(event_dict):
+    return setup_timeout_dict(event_dict.values()), setup_signal_history(event_dict, HIST_SIGNALS), setup_signal_event_index(event_dict)
+
+
+def _reset(event_dict):
+    for event in event_dict.values():
+        event.running = False
+
+
+def bench_risk_event_detector(signals, event_dict, scale, matrix=False):
+    """
+    Full per-signal path: history update plus detection, with the conditions evaluated in matrix form if matrix.
+    """
+    def run(latencies):
+        _reset(event_dict)
+        timeout_dict, signal_history, signal_event_index = _detector_state(event_dict)
+        conditions = ConditionMatrix(event_dict, signal_history) if matrix else None
+        callback = lambda riskEvent: None
+        clock = time.perf_counter_ns
+        for signal in signals:
+            if signal_history[signal.id] is not None:
+                t = clock()
+                update_signal_value(signal_history, signal)
+                risk_event_detector(event_dict, timeout_dict, signal, signal_history, callback, signal_event_index, conditions)
+                latencies.append(clock() - t)
+
+    latencies = []
+    start = time.perf_counter()
+    run(latencies)
+    elapsed = time.perf_counter() - start
+    return _summarize("condition_matrix" if matrix else "risk_event_detector", scale, latencies, elapsed, _measure_memory(lambda: run(_Discard())))
+
+
+def bench_condition_matrix(signals, event_dict, scale):
+    return bench_risk_event_detector(signals, event_dict, scale, matrix=True)
+
+
+def bench_update_signal_value(signals, event_dict, scale):
+    def run(latencies):
+        _, signal_history, _ = _detector_state(event_dict)
+        clock = time.perf_counter_ns
+        for signal in signals:
+            if signal_history[signal.id] is not None:
+                t = clock()
+                update_signal_value(signal_history, signal)
+                latencies.append(clock() - t)
+
+    latencies = []
+    start = time.perf_counter()
+    run(latencies)
+    elapsed = time.perf_counter() - start
+    return _summarize("update_signal_value", scale, latencies, elapsed, _measure_memory(lambda: run(_Discard())))
+
+
+def bench_check_condition(signals, event_dict, scale):
+    """
+    check_condition of every event depending on each signal, one latency sample per call.
+    """
+    def run(latencies):
+        _reset(event_dict)
+        _, signal_history, signal_event_index = _detector_state(event_dict)
+        clock = time.perf_counter_ns
+        for signal in signals:
+            if signal_history[signal.id] is not None:
+                update_signal_value(signal_history, signal)
+                for event in signal_event_index[signal.id]:
+                    t = clock()
+                    event.check_condition(event_dict, signal_history)
+                    latencies.append(clock() - t)
+
+    latencies = []
+    start = time.perf_counter()
+    run(latencies)
+    elapsed = time.perf_counter() - start
+    return _summarize("check_condition", scale, latencies, elapsed, _measure_memory(lambda: run(_Discard())))
+
+
+def bench_collect_callback_data(signals, event_dict, scale, repetitions=20):
+    """
+    collect_callback_data of every event over a history filled by the stream.
+    """
+    _, signal_history, _ = _detector_state(event_dict)
+    for signal in signals:
+        if signal_history[signal.id] is not None:
+            update_signal_value(signal_history, signal)
+
+    def run(latencies):
+        clock = time.perf_counter_ns
+        for _ in range(repetitions):
+            for event in event_dict.values():
+                t = clock()
+                event.collect_callback_data(signal_history)
+                latencies.append(clock() - t)
+
+    latencies = []
+    start = time.perf_counter()
+    run(latencies)
+    elapsed = time.perf_counter() - start
+    return _summarize("collect_callback_data", scale, latencies, elapsed, _measure_memory(lambda: run(_Discard())))
+
+
+BENCHMARKS = [bench_risk_event_detector, bench_condition_matrix, bench_update_signal_value, bench_check_condition, bench_collect_callback_data]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(twinFile, duration, scales):
+    signals = generate_signal_stream(twinFile, duration)
+    results = []
+    for scale in scales:
+        event_dict = scaled_event_dict(scale)
+        for bench in BENCHMARKS:
+            result = bench(signals, event_dict, scale)
+            print(f"{result['name']:<24} rules x{scale:<4} {result['throughput_per_s']:>12.0f} ops/s  p50 {result['p50_us']:8.2f} us  p99 {result['p99_us']:8.2f} us  peak alloc {result['alloc_peak_bytes']} B")
+            results.append(result)
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "signals": len(signals),
+        "duration_s": duration,
+        "results": results,
+    }
+
+
+def compare(current, baseline):
+    """
+    Prints the change of throughput and p99 latency against a previous result file.
+    """
+    previous = {(r["name"], r["rule_set_size"]): r for r in baseline["results"]}
+    print(f"Comparing against {baseline.get('commit')}")
+    for r in current["results"]:
+        p = previous.get((r["name"], r["rule_set_size"]))
+        if p is None:
+            continue
+        throughput = (r["throughput_per_s"] / p["throughput_per_s"] - 1) * 100 if p["throughput_per_s"] else 0.0
+        p99 = (r["p99_us"] / p["p99_us"] - 1) * 100 if p["p99_us"] else 0.0
+        print(f"{r['name']:<24} rules x{r['rule_set_size']:<4} throughput {throughput:+7.1f}%  p99 {p99:+7.1f}%")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the detection hot path")
+    parser.add_argument("-t", "--twin", dest="twinFile", default=DEFAULT_TWIN_FILE, help="DTDL model used to shape the signal stream.")
+    parser.add_argument("-d", "--duration", dest="duration", type=float, default=60, help="Simulated seconds of driving.")
+    parser.add_argument("-s", "--scales", dest="scales", default="1,10,50", help="Comma separated rule set scale factors.")
+    parser.add_argument("-o", "--output", dest="output", default="benchmark_results.json", help="File to write the results to.")
+    parser.add_argument("-c", "--compare", dest="baseline", help="Previous result file to compare against.")
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.twinFile, args.duration, [int(s) for s in args.scales.split(",")])
+    with open(args.output, "w") as f:
+        json.dump(current, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(current, json.load(f))
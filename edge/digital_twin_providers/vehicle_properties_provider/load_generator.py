@@ -0,0 +1,166 @@
+"""
+SPDX-FileCopyrightText: 2023 Contributors to the Eclipse Foundation
+
+See the NOTICE file(s) distributed with this work for additional
+information regarding copyright ownership.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from digital_twin_providers.vehicle_properties_provider.replay import BoundedPublisher, replay
+from recording.columnar import read_recording_rows
+from recording.synthetic import generate_signal_columns
+
+# Synthetic load for capacity planning of the broker and the detector.
+#
+# Simulates a fleet of vehicles publishing concurrently. Every vehicle has its own source_id, used as prefix of
+# its topics (veh-0000/Vehicle/Speed/Speed), and starts time_offset seconds after the previous one. Its signals
+# are either a recording, replayed by every vehicle, or generated from the properties of the DTDL model. The
+# vehicles are split over a pool of processes, each with its own MQTT connection, and every process replays its
+# vehicles merged in timestamp order with the drift-free scheduler of the provider.
+
+MQTT_SERVER = "0.0.0.0"
+MQTT_PORT = 1883
+
+DEFAULT_TWIN_FILE = os.path.join(os.path.dirname(__file__), "..", "..", "digital-twin-model", "dtdl", "vehicle.json")
+
+
+def loadRecording(recordingFile):
+    """
+    Returns the signal names and the signal index, timestamp and value of every row of a recording.
+    """
+    names = {}
+    signalIds = []
+    timestamps = []
+    values = []
+    for _, signal, timestamp, value in read_recording_rows(recordingFile):
+        signalIds.append(names.setdefault(signal, len(names)))
+        timestamps.append(timestamp)
+        values.append(value)
+    return list(names), np.array(signalIds, dtype=np.int32), np.array(timestamps), np.array(values)
+
+
+def vehicleRows(vehicles, source):
+    """
+    Merges the signals of several vehicles, each shifted by its time offset, into one timestamp ordered stream
+    of (source_id, signal, timestamp, value) rows.
+    """
+    parts = []
+    for vehicleIndex, (sourceId, offset, seed) in enumerate(vehicles):
+        if source["recording"]:
+            names, signalIds, timestamps, values = loadRecording(source["recording"]) if vehicleIndex == 0 else parts[0][1]
+        else:
+            # Each vehicle starts at another point of the speed wave, values are rounded to keep the payloads short
+            names, signalIds, timestamps, values = generate_signal_columns(source["twinFile"], source["duration"], seed, phase=seed)
+            values = np.round(values, 2)
+        parts.append((vehicleIndex, (names, signalIds, timestamps, values), timestamps + offset))
+
+    vehicleIds = np.concatenate([np.full(len(ts), i, dtype=np.int32) for i, _, ts in parts])
+    timestamps = np.concatenate([ts for _, _, ts in parts])
+    order = np.argsort(timestamps, kind="stable")
+
+    # Topics of each vehicle and signal, built once
+    topics = [[f"{sourceId}/{name.replace('_', '/')}" for name in data[0]] for (sourceId, _, _), (_, data, _) in zip(vehicles, parts)]
+    signalIds = np.concatenate([data[1] for _, data, _ in parts])[order].tolist()
+    values = np.concatenate([data[3] for _, data, _ in parts])[order].tolist()
+    vehicleIds = vehicleIds[order].tolist()
+    timestamps = timestamps[order].tolist()
+
+    for vehicleId, signalId, timestamp, value in zip(vehicleIds, signalIds, timestamps, values):
+        yield vehicleId, topics[vehicleId][signalId], timestamp, value
+
+
+def runWorker(worker, vehicles, source, speed, broker, reportInterval):
+    """
+    Publishes the signals of a group of vehicles over one MQTT connection.
+
+    Returns:
+        The number of rows published, the seconds it took until the last one was written, the maximum lag behind
+        schedule and the number of rows that could not be published
+    """
+    mqttClient = None
+    publisher = None
+    if broker:
+        mqttClient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5, client_id=f"load-generator-{os.getpid()}-{worker}")
+        mqttClient.connect(broker[0], broker[1], 60)
+        mqttClient.loop_start()
+        publisher = BoundedPublisher(mqttClient)
+        publish = lambda vehicleId, topic, value: publisher.publish(topic, value)
+    else:
+        publish = lambda vehicleId, topic, value: None
+
+    # Generating the rows is not part of the measured replay
+    rows = list(vehicleRows(vehicles, source))
+    stats = replay(iter(rows), publish, speed, reportInterval, label=f"worker {worker} ({len(vehicles)} vehicles)", flush=publisher.flush if publisher else None)
+    elapsed = stats.elapsed()
+
+    if mqttClient:
+        # Every message was written or timed out, stopping the loop loses nothing
+        mqttClient.loop_stop()
+        mqttClient.disconnect()
+        return publisher.published, elapsed, stats.maxLag, publisher.failed
+    return stats.rows, elapsed, stats.maxLag, 0
+
+
+def runLoad(vehicles, workers, source, speed=1.0, timeOffset=0.01, broker=(MQTT_SERVER, MQTT_PORT), reportInterval=5.0):
+    """
+    Simulates vehicles split over workers processes and prints the sustained publish rate, counting the rows
+    written to the broker connection (only scheduled with broker None).
+
+    Returns:
+        The total number of rows published and the sustained rate in rows per second
+    """
+    fleet = [(f"veh-{i:04d}", i * timeOffset, i) for i in range(vehicles)]
+    workers = min(workers, vehicles)
+    groups = [fleet[w::workers] for w in range(workers)]
+
+    print(f"Simulating {vehicles} vehicles in {workers} processes")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(runWorker, w, group, source, speed, broker, reportInterval) for w, group in enumerate(groups)]
+        results = [f.result() for f in futures]
+
+    rows = sum(r[0] for r in results)
+    # The workers run concurrently, the slowest one bounds the sustained rate
+    elapsed = max(r[1] for r in results)
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    print(f"{'Published' if broker else 'Scheduled'} {rows} rows in {elapsed:.1f} s: sustained {rate:.0f} rows/s, max lag {max(r[2] for r in results) * 1000:.1f} ms")
+    failed = sum(r[3] for r in results)
+    if failed:
+        print(f"{failed} rows could not be published")
+    return rows, rate
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulates a fleet of vehicles publishing their signals")
+    parser.add_argument("-n", "--vehicles", dest="vehicles", type=int, default=10, help="Number of simulated vehicles.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=os.cpu_count(), help="Number of publishing processes.")
+    parser.add_argument("-r", "--recording", dest="recordingFile", help="Recording replayed by every vehicle. Signals are generated from the DTDL model if not given.")
+    parser.add_argument("-t", "--twin", dest="twinFile", default=DEFAULT_TWIN_FILE, help="DTDL model used to generate the signals.")
+    parser.add_argument("-d", "--duration", dest="duration", type=float, default=60, help="Seconds of generated signals per vehicle.")
+    parser.add_argument("-s", "--speed", dest="speed", type=float, default=1.0, help="Replay speed factor. 0 publishes as fast as possible.")
+    parser.add_argument("--time-offset", dest="timeOffset", type=float, default=0.01, help="Seconds between the start of consecutive vehicles.")
+    parser.add_argument("--no-publish", dest="noPublish", action="store_true", help="Only generate and schedule the messages, to measure the headroom of the generator.")
+    parser.add_argument("--report-interval", dest="reportInterval", type=float, default=5.0, help="Seconds between rate reports of each worker.")
+    args = parser.parse_args()
+
+    source = {"recording": args.recordingFile, "twinFile": args.twinFile, "duration": args.duration}
+    runLoad(args.vehicles, args.workers, source, args.speed, args.timeOffset, None if args.noPublish else (MQTT_SERVER, MQTT_PORT), args.reportInterval)
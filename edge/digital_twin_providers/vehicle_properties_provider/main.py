@@ -25,17 +25,16 @@ import argparse
 import grpc
 
 from proto_build.common import discoverDigitalTwinService
+from proto_build import discovery_cache
 
 import proto_build.invehicle_digital_twin.v1.invehicle_digital_twin_pb2 as invehicle_digital_twin_pb2
 import proto_build.invehicle_digital_twin.v1.invehicle_digital_twin_pb2_grpc as invehicle_digital_twin_pb2_grpc
 
-import proto_build.module.managed_subscribe.v1.managed_subscribe_pb2 as managed_subscribe_pb2
-import proto_build.module.managed_subscribe.v1.managed_subscribe_pb2_grpc as managed_subscribe_pb2_grpc
+from digital_twin_providers.vehicle_properties_provider.replay import BoundedPublisher, replay
+from recording.columnar import read_recording_rows
 
 import paho.mqtt.client as mqtt
-import csv
 import json
-import time
 
 CHARIOTT_SERVICE_DISCOVERY_URI = "0.0.0.0:50000"
 INVEHICLE_DIGITAL_TWIN_SERVICE_NAMESPACE = "sdv.ibeji"
@@ -47,83 +46,105 @@ MQTT_SERVER = "0.0.0.0"
 MQTT_PORT = 1883
 
 
-def registerSignals(digitalTwinServiceMetadata, twinFile):
+# Number of signals sent in one RegisterRequest, and the deadline in seconds of each request
+REGISTER_BATCH_SIZE = 500
+REGISTER_TIMEOUT = 10.0
+
+
+def registerSignals(digitalTwinServiceMetadata, twinFile, batchSize=REGISTER_BATCH_SIZE):
+    """
+    Registers all properties of the DTDL model with the Digital Twin Service.
+    The properties are sent in batches of batchSize signals per RegisterRequest, all batches concurrently
+    over a single channel.
+
+    Returns:
+        The errors of the batches that failed, by index of their first signal in the model
+    """
     print(f"Registering signals with Digital Twin Service {digitalTwinServiceMetadata.name} at {digitalTwinServiceMetadata.uri}")
     
     # Read the json file
     with open(twinFile) as f:
         data = json.load(f)
 
-        # Iterate over the signals
-        for signal in data['contents']:
-            if (signal['@type'] == "Property"):
-                # Register the signal with the digital twin service
-                registerSignal(signal, digitalTwinServiceMetadata)
-
-
-
-def registerSignal(signal, digitalTwinServiceMetadata):	
-    print(f"Registering signal {signal['@id']} in Digital Twin Service {digitalTwinServiceMetadata.name} at {digitalTwinServiceMetadata.uri}")
+    entityAccessInfoList = [createEntityAccessInfo(signal) for signal in data['contents'] if signal['@type'] == "Property"]
 
     serviceAddress = digitalTwinServiceMetadata.uri.strip("http://").strip("https://")
 
+    failures = {}
     with closing(grpc.insecure_channel(serviceAddress)) as channel:
         stub = invehicle_digital_twin_pb2_grpc.InvehicleDigitalTwinStub(channel)
 
-        # Create the context by replacing all _ to / from the signal name
-        context = signal['name'].replace("_", "/")        
-
-        request = invehicle_digital_twin_pb2.RegisterRequest(
-            entityAccessInfoList = [
-                invehicle_digital_twin_pb2.EntityAccessInfo(
-                    name=signal['name'],
-                    id=signal['@id'],
-                    description="",
-                    endpointInfoList=[
-                        invehicle_digital_twin_pb2.EndpointInfo(
-                            protocol="mqtt_v5",
-                            operations = ["subscribe"],
-                            uri=f"mqtt://{MQTT_SERVER}:{MQTT_PORT}",
-                            context=context
-                        )
-                    ]
-                )
-            ]
-        )
-        
-        response = stub.Register(request)
-        print(f"Signal Registered {response}")
-
-
-def sendData(recordingFile):
-    print(f"Sending data from {recordingFile}")
+        futures = {}
+        for start in range(0, len(entityAccessInfoList), batchSize):
+            request = invehicle_digital_twin_pb2.RegisterRequest(
+                entityAccessInfoList = entityAccessInfoList[start:start + batchSize]
+            )
+            futures[start] = stub.Register.future(request, timeout=REGISTER_TIMEOUT)
+
+        for start, future in futures.items():
+            try:
+                future.result()
+            except grpc.RpcError as e:
+                failures[start] = e
+                print(f"Error registering signals {start} to {min(start + batchSize, len(entityAccessInfoList)) - 1}: {e.code()} {e.details()}")
+
+    print(f"Registered {len(entityAccessInfoList)} signals in {len(futures)} requests, {len(failures)} failed")
+    return failures
+
+
+def createEntityAccessInfo(signal) -> invehicle_digital_twin_pb2.EntityAccessInfo:
+    # Create the context by replacing all _ to / from the signal name
+    context = signal['name'].replace("_", "/")        
+
+    return invehicle_digital_twin_pb2.EntityAccessInfo(
+        name=signal['name'],
+        id=signal['@id'],
+        description="",
+        endpointInfoList=[
+            invehicle_digital_twin_pb2.EndpointInfo(
+                protocol="mqtt_v5",
+                operations = ["subscribe"],
+                uri=f"mqtt://{MQTT_SERVER}:{MQTT_PORT}",
+                context=context
+            )
+        ]
+    )
+
+
+def sendData(recordingFile, speed=1.0, verbose=False):
+    print(f"Sending data from {recordingFile} at {speed}x" if speed > 0 else f"Sending data from {recordingFile} as fast as possible")
 
     mqttClient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5, client_id="provider")
     mqttClient.on_connect = on_connect
 #    mqttClient.on_publish = on_publish
 
     mqttClient.connect(MQTT_SERVER, MQTT_PORT, 60)
+    # The network loop runs in its own thread. publish waits only while too many messages are not written yet,
+    # so a slow broker holds the replay back instead of growing paho's queue
+    mqttClient.loop_start()
+    publisher = BoundedPublisher(mqttClient)
+
+    # Topics are derived once per signal instead of once per row
+    topics = {}
 
-    # iterate over the CSV file and publish the data to the mqtt broker
-    with open(recordingFile, newline='') as csvfile:
-      
-        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        # Ignore the first line, which is the header
-        next(reader)
+    def publish(source_id, signal, data):
+        topic = topics.get(signal)
+        if topic is None:
+            topic = topics[signal] = signal.replace("_", "/")
+        publisher.publish(topic, data)
 
-        previoustimestamp = 0
+    def onTick(timestamp, count):
+        print(f"Published {count} signals with timestamp {timestamp}")
 
-        for row in reader:
-            topic = row[1].replace("_", "/")
-            data = float(row[3])
-            timestamp = float(row[2])
+    # iterate over the recording (CSV or columnar) and publish the data to the mqtt broker
+    stats = replay(read_recording_rows(recordingFile), publish, speed, onTick=onTick if verbose else None, flush=publisher.flush)
+    if publisher.failed:
+        print(f"{publisher.failed} of {stats.rows} signals could not be published")
 
-            sleepTime = timestamp - previoustimestamp
-            time.sleep(sleepTime)
-            print(f"Publishing {data} to {topic} with timestamp {timestamp} and sleep time {sleepTime} s")
-            ret, mid = mqttClient.publish(topic, data, qos=0)
-            
-            previoustimestamp = timestamp
+    # Every message was written or timed out, stopping the loop loses nothing
+    mqttClient.loop_stop()
+    mqttClient.disconnect()
+    return stats
 
 
 def on_connect(client, userdata, flags, rc, properties):
@@ -137,14 +158,25 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Starts the sample process")
     parser.add_argument("-r", "--recording", dest="recordingFile")
     parser.add_argument("-t", "--twin", dest="twinFile")
+    parser.add_argument("--discovery-cache", dest="discoveryCache", help="File caching the discovered Digital Twin Service between restarts.")
+    parser.add_argument("--discovery-ttl", dest="discoveryTtl", type=float, default=discovery_cache.DEFAULT_TTL, help="Seconds after which the cached service is no longer used.")
+    parser.add_argument("--register-batch-size", dest="registerBatchSize", type=int, default=REGISTER_BATCH_SIZE, help="Number of signals registered per request.")
+    parser.add_argument("-s", "--speed", dest="speed", type=float, default=1.0, help="Replay speed factor, e.g. 10 for 10x real time. 0 replays as fast as possible.")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="Print every published tick.")
     args = parser.parse_args()
 
-    digitalTwinServiceMetadata = discoverDigitalTwinService()
+    if (args.discoveryCache):
+        cache = discovery_cache.DiscoveryCache(args.discoveryCache, args.discoveryTtl)
+        digitalTwinServiceMetadata, serviceCached = discovery_cache.discoverDigitalTwinServiceCached(cache)
+        if (serviceCached):
+            discovery_cache.refreshInBackground(cache, discovery_cache.refreshService)
+    else:
+        digitalTwinServiceMetadata = discoverDigitalTwinService()
 
     if (args.twinFile):
-        registerSignals(digitalTwinServiceMetadata, twinFile=args.twinFile)
+        registerSignals(digitalTwinServiceMetadata, twinFile=args.twinFile, batchSize=args.registerBatchSize)
 
     if (args.recordingFile):
-        sendData(args.recordingFile)
+        sendData(args.recordingFile, args.speed, args.verbose)
     
 
@@ -0,0 +1,153 @@
+"""
+SPDX-FileCopyrightText: 2023 Contributors to the Eclipse Foundation
+
+See the NOTICE file(s) distributed with this work for additional
+information regarding copyright ownership.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import itertools
+import time
+from collections import deque
+
+# Replays recording rows against an absolute monotonic clock.
+#
+# Every row is due at start + (timestamp - first timestamp) / speed, so sleeping too long once does not delay
+# the rest of the replay. Rows sharing a timestamp form one tick, which is published without sleeping in
+# between. A speed of 0 replays as fast as possible.
+
+REPORT_INTERVAL = 5.0
+
+# Messages handed to paho but not yet written to its socket, and the seconds a message may take to be written
+MAX_IN_FLIGHT = 1000
+PUBLISH_TIMEOUT = 10.0
+
+
+class ReplayStats:
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.rows = 0
+        self.ticks = 0
+        self.firstTimestamp = None
+        self.lastTimestamp = None
+        self.maxLag = 0.0
+        self.started = time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def achievedRate(self) -> float:
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def targetRate(self) -> float:
+        """
+        Rows per second that the recording requires at the replay speed, infinite when replaying as fast as possible.
+        """
+        if self.speed <= 0:
+            return float("inf")
+        span = (self.lastTimestamp - self.firstTimestamp) / self.speed if self.rows else 0.0
+        return self.rows / span if span > 0 else float("inf")
+
+    def report(self) -> str:
+        if self.speed <= 0:
+            return f"Replayed {self.rows} rows in {self.ticks} ticks in {self.elapsed():.1f} s: {self.achievedRate():.0f} rows/s, as fast as possible"
+        return (f"Replayed {self.rows} rows in {self.ticks} ticks in {self.elapsed():.1f} s: "
+                f"{self.achievedRate():.0f} rows/s, target {self.targetRate():.0f} rows/s, max lag {self.maxLag * 1000:.1f} ms")
+
+
+# Publishes over a paho client whose network loop runs in its own thread.
+#
+# paho only queues a message in publish, on an unbounded queue. At most maxInFlight messages are left unwritten:
+# publish waits for the oldest one beyond that, so a replay is paced by the broker connection instead of by
+# the queue. QoS 0 messages are written in order, and a message not written timeout seconds after it was queued
+# (e.g. dropped with the connection) is counted as failed.
+class BoundedPublisher:
+
+    def __init__(self, client, maxInFlight=MAX_IN_FLIGHT, timeout=PUBLISH_TIMEOUT):
+        self.client = client
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.published = 0
+        self.failed = 0
+        self._inFlight = deque()
+
+    def publish(self, topic, payload, qos=0):
+        self._inFlight.append((self.client.publish(topic, payload, qos=qos), time.monotonic() + self.timeout))
+        if len(self._inFlight) > self.maxInFlight:
+            self._complete(*self._inFlight.popleft())
+
+    def _complete(self, info, deadline):
+        try:
+            info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+            published = info.is_published()
+        except (RuntimeError, ValueError):
+            # Not queued, e.g. while disconnected
+            published = False
+        if published:
+            self.published += 1
+        else:
+            self.failed += 1
+
+    def flush(self):
+        """
+        Waits until every message was written to the socket or timed out.
+        """
+        while self._inFlight:
+            self._complete(*self._inFlight.popleft())
+
+
+def replay(rows, publish, speed=1.0, reportInterval=REPORT_INTERVAL, onTick=None, label=None, flush=None):
+    """
+    Calls publish(source_id, signal, value) for each (source_id, signal, timestamp, value) row when it is due.
+    Prints the achieved and target rate every reportInterval seconds, prefixed with label if given.
+    flush() is called after the last row, before the final report, so the stats include delivering the last rows.
+
+    Returns:
+        The ReplayStats of the replay
+    """
+    stats = ReplayStats(speed)
+    nextReport = stats.started + reportInterval
+
+    for timestamp, tick in itertools.groupby(rows, key=lambda row: row[2]):
+        if stats.firstTimestamp is None:
+            stats.firstTimestamp = timestamp
+        if speed > 0:
+            due = stats.started + (timestamp - stats.firstTimestamp) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            stats.maxLag = max(stats.maxLag, time.monotonic() - due)
+
+        count = 0
+        for source_id, signal, _, value in tick:
+            publish(source_id, signal, value)
+            count += 1
+        stats.rows += count
+        stats.ticks += 1
+        stats.lastTimestamp = timestamp
+        if onTick:
+            onTick(timestamp, count)
+
+        now = time.monotonic()
+        if now >= nextReport:
+            print(f"{label}: {stats.report()}" if label else stats.report())
+            nextReport = now + reportInterval
+
+    if flush:
+        flush()
+    print(f"{label}: {stats.report()}" if label else stats.report())
+    return stats
@@ -18,11 +18,13 @@ limitations under the License.
 
 SPDX-License-Identifier: Apache-2.0
 """
+import threading
 from contextlib import closing
 
 import grpc
 
 from proto_build.common import discoverDigitalTwinService
+from proto_build import discovery_cache
 
 import proto_build.invehicle_digital_twin.v1.invehicle_digital_twin_pb2 as invehicle_digital_twin_pb2
 import proto_build.invehicle_digital_twin.v1.invehicle_digital_twin_pb2_grpc as invehicle_digital_twin_pb2_grpc
@@ -37,8 +39,26 @@ INVEHICLE_DIGITAL_TWIN_SERVICE_NAMESPACE = "sdv.ibeji"
 INVEHICLE_DIGITAL_TWIN_SERVICE_NAME = "invehicle_digital_twin"
 INVEHICLE_DIGITAL_TWIN_SERVICE_VERSION = "1.0"
 
+# Deadline in seconds of each signal lookup in the Digital Twin Service
+FIND_SIGNAL_TIMEOUT = 5.0
+
 mqttClient = None
 
+# URI of the MQTT broker the client is connected to, or reconnecting to when _brokerMoved is set
+brokerUri = None
+
+# Set when the broker moved, the network loop then reconnects to brokerUri (see loopForever)
+_brokerMoved = threading.Event()
+
+# MQTT topic subscribed to for every signal ID
+subscriptions = {}
+
+# Called with the signal ID and the MQTT topic of every signal subscribed to, e.g. to route its messages
+onSubscribe = None
+
+# Called with the signal ID and the MQTT topic of every signal unsubscribed from, e.g. to drop its route
+onUnsubscribe = None
+
 
 def collectRequiredSignalIDs() -> list:
     #return ["dtmi:sdv:Trailer:Weight;1", "dtmi:sdv:Trailer:IsTrailerConnected;1"]
@@ -68,6 +88,41 @@ def findSignalByID(signalID, digitalTwinServiceMetadata) -> invehicle_digital_tw
 
     return response.entityAccessInfo
 
+
+def findSignalsByID(signalIDs, digitalTwinServiceMetadata, timeout=FIND_SIGNAL_TIMEOUT):
+    '''
+        Find several signals in the Digital Twin Service concurrently, over a single channel.
+        All lookups are sent at once, each with its own deadline, so the total time is bounded by the slowest lookup.
+
+        Returns:
+            A dictionary of the EntityAccessInfo of each signal found, by signal ID, and a dictionary of the errors
+            of the lookups that failed, by signal ID
+    '''
+
+    print(f"Finding {len(signalIDs)} signals in Digital Twin Service {digitalTwinServiceMetadata.name} at {digitalTwinServiceMetadata.uri}")
+
+    serviceAddress = digitalTwinServiceMetadata.uri.strip("http://").strip("https://")
+
+    signals = {}
+    failures = {}
+    with closing(grpc.insecure_channel(serviceAddress)) as channel:
+        stub = invehicle_digital_twin_pb2_grpc.InvehicleDigitalTwinStub(channel)
+        futures = {
+            signalID: stub.FindById.future(invehicle_digital_twin_pb2.FindByIdRequest(id=signalID), timeout=timeout)
+            for signalID in signalIDs
+        }
+        for signalID, future in futures.items():
+            try:
+                signals[signalID] = future.result().entityAccessInfo
+            except grpc.RpcError as e:
+                failures[signalID] = e
+
+    for signalID, e in failures.items():
+        print(f"Error finding signal {signalID}: {e.code()} {e.details()}")
+
+    return signals, failures
+
+
 def getSubscriptionInfo(entityAccessInfo) -> managed_subscribe_pb2.SubscriptionInfoResponse:
     print(f"Getting subscription info for {entityAccessInfo.name}")
 
@@ -99,40 +154,174 @@ def subscribe(signal: invehicle_digital_twin_pb2.EntityAccessInfo):
 
     if (endpointInfo.protocol == "mqtt_v5"):
         startClient(endpointInfo)
-        mqttClient.subscribe(endpointInfo.context)
+        subscriptions[signal.id] = endpointInfo.context
+        if _subscribeNow():
+            mqttClient.subscribe(endpointInfo.context)
+        if onSubscribe:
+            onSubscribe(signal.id, endpointInfo.context)
+
+
+def unsubscribe(signalID):
+    '''
+        Unsubscribes from the topic of a signal, unless another signal uses it too
+    '''
+    topic = subscriptions.pop(signalID, None)
+    if topic is None:
+        return
+    print(f"Unsubscribing from signal {signalID} on topic {topic}")
+    if topic not in subscriptions.values() and _subscribeNow():
+        mqttClient.unsubscribe(topic)
+    if onUnsubscribe:
+        onUnsubscribe(signalID, topic)
+
+
+def subscribeAll(signals: list):
+    '''
+        Subscribes to all signals with a single SUBSCRIBE of all their topics
+    '''
+    topics = []
+    for signal in signals:
+        endpointInfo = signal.endpointInfoList[0]
+        if (endpointInfo.protocol == "mqtt_v5"):
+            startClient(endpointInfo)
+            topics.append((signal.id, endpointInfo.context))
+
+    if topics:
+        print(f"Subscribing to {len(topics)} signals")
+        subscriptions.update(topics)
+        if _subscribeNow():
+            mqttClient.subscribe([(topic, 0) for _, topic in topics])
+        if onSubscribe:
+            for signalID, topic in topics:
+                onSubscribe(signalID, topic)
+
+
+def _subscribeNow():
+    # Until the client is connected, on_connect subscribes to the topics of all signals
+    return mqttClient.is_connected() and not _brokerMoved.is_set()
+
+
+def _brokerAddress(uri):
+    # Extract the address and the port from a string with the form  "mqtt://0.0.0.0:1883"
+    address = uri.split("//")[1].split(":")[0]
+    port = int(uri.split("//")[1].split(":")[1])
+    return address, port
 
 
 def startClient(subscriptionInfo):
-    global mqttClient
+    '''
+        Connects the client to the broker of subscriptionInfo. When the client is connected to another broker, it is
+        disconnected and loopForever reconnects it to the new one, where on_connect subscribes again to all topics.
+    '''
+    global mqttClient, brokerUri
+    if (mqttClient != None and brokerUri == subscriptionInfo.uri):
+        return
+
     if (mqttClient == None):
+        address, port = _brokerAddress(subscriptionInfo.uri)
         mqttClient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
         mqttClient.on_connect = on_connect
         mqttClient.on_message = on_message
+        mqttClient.connect(address, port, 60)
+    else:
+        print(f"MQTT broker moved from {brokerUri} to {subscriptionInfo.uri}, reconnecting")
+        # The connection may be in use by the network loop in another thread, which makes the switch instead
+        _brokerMoved.set()
+        mqttClient.disconnect()
+    brokerUri = subscriptionInfo.uri
 
-        # Extract the address and the port from a string with the form  "mqtt://0.0.0.0:1883"
-        address = subscriptionInfo.uri.split("//")[1].split(":")[0]
-        port = int(subscriptionInfo.uri.split("//")[1].split(":")[1])
 
-        mqttClient.connect(address, port, 60)
+def loopForever():
+    '''
+        Runs the network loop of the client in this thread until it is disconnected. When the broker moved, the
+        client is reconnected to the new broker and the loop runs on.
+    '''
+    while True:
+        mqttClient.loop_forever(retry_first_connection=True)
+        if not _brokerMoved.is_set():
+            return
+        _brokerMoved.clear()
+        address, port = _brokerAddress(brokerUri)
+        # Connects when the loop starts again, retrying until the broker is reachable
+        mqttClient.connect_async(address, port, 60)
 
 
 def on_connect(client, userdata, flags, rc, properties):
     print(f"Connected to MQTT broker with result code {rc}")
+    # Also after reconnecting, the session of the broker is not kept
+    if not rc.is_failure and subscriptions:
+        client.subscribe([(topic, 0) for topic in set(subscriptions.values())])
 
 def on_message(client, userdata, msg):
     print(f"Received message {msg.payload} on topic {msg.topic}")
 
 
-def start(requiredSignalIDs: list):
-    digitalTwinServiceMetadata = discoverDigitalTwinService()
+def start(requiredSignalIDs: list, cache=None):
+    '''
+        Finds and subscribes to the required signals.
+        With a DiscoveryCache, cached signals are subscribed to right away and validated in the background afterwards.
 
-    for signalID in requiredSignalIDs:
-        signal = findSignalByID(signalID, digitalTwinServiceMetadata)
-        subscribe(signal)
+        Returns:
+            The errors of the signals that could not be found, by signal ID
+    '''
+    if cache is None:
+        digitalTwinServiceMetadata = discoverDigitalTwinService()
+        signals, failures = findSignalsByID(requiredSignalIDs, digitalTwinServiceMetadata)
+    else:
+        digitalTwinServiceMetadata, serviceCached = discovery_cache.discoverDigitalTwinServiceCached(cache)
+        signals = {}
+        for signalID in requiredSignalIDs:
+            entityAccessInfo = cache.getSignal(signalID)
+            if entityAccessInfo is not None:
+                signals[signalID] = entityAccessInfo
+        missing = [signalID for signalID in requiredSignalIDs if signalID not in signals]
+        print(f"Using {len(signals)} cached signals, finding {len(missing)}")
+
+        failures = {}
+        if missing:
+            found, failures = findSignalsByID(missing, digitalTwinServiceMetadata)
+            if failures and serviceCached:
+                # The cached service may have moved, discover it again and retry
+                digitalTwinServiceMetadata = discovery_cache.refreshService(cache)
+                serviceCached = False
+                retried, failures = findSignalsByID(list(failures), digitalTwinServiceMetadata)
+                found.update(retried)
+            for signalID, entityAccessInfo in found.items():
+                cache.putSignal(signalID, entityAccessInfo)
+            cache.save()
+            signals.update(found)
+
+        cachedSignalIDs = [signalID for signalID in requiredSignalIDs if signalID in signals and signalID not in missing]
+        if serviceCached or cachedSignalIDs:
+            discovery_cache.refreshInBackground(cache, lambda cache: refreshSignals(cache, cachedSignalIDs))
+
+    subscribeAll([signals[signalID] for signalID in requiredSignalIDs if signalID in signals])
+
+    return failures
+
+
+def refreshSignals(cache, signalIDs):
+    '''
+        Looks up cached signals again and updates the cache. Signals whose endpoint changed are unsubscribed from their
+        old topic and subscribed to the new one, on the new broker if it moved.
+    '''
+    digitalTwinServiceMetadata = discovery_cache.refreshService(cache)
+    signals, _ = findSignalsByID(signalIDs, digitalTwinServiceMetadata)
+    for signalID, entityAccessInfo in signals.items():
+        cached = cache.getSignal(signalID)
+        cache.putSignal(signalID, entityAccessInfo)
+        if cached is not None and cached.endpointInfoList != entityAccessInfo.endpointInfoList:
+            endpointInfo = entityAccessInfo.endpointInfoList[0]
+            if subscriptions.get(signalID) == endpointInfo.context and brokerUri == endpointInfo.uri:
+                # Subscribed again when the client followed another signal to the new broker
+                continue
+            print(f"Endpoint of signal {signalID} changed, subscribing again")
+            unsubscribe(signalID)
+            subscribe(entityAccessInfo)
 
 if __name__ == "__main__":
     start(collectRequiredSignalIDs())
-    mqttClient.loop_forever()
+    loopForever()
 
 
     
@@ -0,0 +1,162 @@
+"""
+SPDX-FileCopyrightText: 2023 Contributors to the Eclipse Foundation
+
+See the NOTICE file(s) distributed with this work for additional
+information regarding copyright ownership.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from google.protobuf import json_format
+
+from proto_build.common import CHARIOTT_SERVICE_DISCOVERY_URI, INVEHICLE_DIGITAL_TWIN_SERVICE_NAMESPACE, INVEHICLE_DIGITAL_TWIN_SERVICE_NAME, INVEHICLE_DIGITAL_TWIN_SERVICE_VERSION, discoverDigitalTwinService
+
+import proto_build.invehicle_digital_twin.v1.invehicle_digital_twin_pb2 as invehicle_digital_twin_pb2
+import proto_build.service_discovery.v1.service_registry_pb2 as service_registry_pb2
+
+# On-disk cache of the discovered Digital Twin Service and of the EntityAccessInfo of each signal.
+#
+# The topology of the vehicle almost never changes between restarts, so cached entries younger than the TTL are
+# used right away and validated against the live services in the background afterwards. The cache is keyed by
+# a hash of the discovery parameters and of its format version; a cache written with a different key is ignored.
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_FILE = "discovery_cache.json"
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def cacheKey() -> str:
+    parameters = [
+        CACHE_FORMAT_VERSION,
+        CHARIOTT_SERVICE_DISCOVERY_URI,
+        INVEHICLE_DIGITAL_TWIN_SERVICE_NAMESPACE,
+        INVEHICLE_DIGITAL_TWIN_SERVICE_NAME,
+        INVEHICLE_DIGITAL_TWIN_SERVICE_VERSION,
+    ]
+    return hashlib.sha256(json.dumps(parameters).encode("utf-8")).hexdigest()
+
+
+class DiscoveryCache:
+
+    def __init__(self, cacheFile=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL):
+        self.cacheFile = cacheFile
+        self.ttl = ttl
+        self.key = cacheKey()
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.cacheFile) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"service": None, "signals": {}}
+        if data.get("key") != self.key:
+            print(f"Ignoring discovery cache {self.cacheFile}, it was written for other discovery parameters")
+            return {"service": None, "signals": {}}
+        return {"service": data.get("service"), "signals": data.get("signals", {})}
+
+    def save(self):
+        with self._lock:
+            data = {"key": self.key, **self._entries}
+            tmp = self.cacheFile + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.cacheFile)
+
+    def _get(self, entry, messageType):
+        if entry is None or time.time() - entry["storedAt"] > self.ttl:
+            return None
+        return json_format.ParseDict(entry["value"], messageType())
+
+    def _entry(self, message) -> dict:
+        return {"storedAt": time.time(), "value": json_format.MessageToDict(message)}
+
+    def getService(self) -> service_registry_pb2.ServiceMetadata:
+        """
+        Returns the cached Digital Twin Service, or None if it is not cached or expired.
+        """
+        with self._lock:
+            return self._get(self._entries["service"], service_registry_pb2.ServiceMetadata)
+
+    def putService(self, serviceMetadata):
+        with self._lock:
+            self._entries["service"] = self._entry(serviceMetadata)
+
+    def getSignal(self, signalID) -> invehicle_digital_twin_pb2.EntityAccessInfo:
+        """
+        Returns the cached EntityAccessInfo of a signal, or None if it is not cached or expired.
+        """
+        with self._lock:
+            return self._get(self._entries["signals"].get(signalID), invehicle_digital_twin_pb2.EntityAccessInfo)
+
+    def putSignal(self, signalID, entityAccessInfo):
+        with self._lock:
+            self._entries["signals"][signalID] = self._entry(entityAccessInfo)
+
+
+def discoverDigitalTwinServiceCached(cache):
+    """
+    Returns the Digital Twin Service from the cache, discovering it only if it is not cached.
+
+    Returns:
+        The service and whether it came from the cache
+    """
+    serviceMetadata = cache.getService()
+    if serviceMetadata is not None:
+        print(f"Using cached Digital Twin Service {serviceMetadata.name} at {serviceMetadata.uri}")
+        return serviceMetadata, True
+
+    serviceMetadata = discoverDigitalTwinService()
+    cache.putService(serviceMetadata)
+    cache.save()
+    return serviceMetadata, False
+
+
+def refreshInBackground(cache, refresh):
+    """
+    Runs refresh(cache) once in a background thread, to validate entries that were served from the cache.
+    Errors are printed, the cached entries stay in use.
+    """
+    def run():
+        try:
+            refresh(cache)
+            cache.save()
+        except Exception as e:
+            print(f"Refreshing the discovery cache failed: {e}")
+
+    thread = threading.Thread(target=run, name="discovery-refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+def refreshService(cache) -> service_registry_pb2.ServiceMetadata:
+    """
+    Discovers the Digital Twin Service again and updates the cache.
+
+    Returns:
+        The discovered service
+    """
+    serviceMetadata = discoverDigitalTwinService()
+    cached = cache.getService()
+    if cached is not None and cached != serviceMetadata:
+        print(f"Digital Twin Service moved from {cached.uri} to {serviceMetadata.uri}")
+    cache.putService(serviceMetadata)
+    return serviceMetadata
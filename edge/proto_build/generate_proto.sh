@@ -25,4 +25,7 @@ python -m grpc_tools.protoc --proto_path ${ORCHESTRATION_REPO} --python_out=. --
 python -m grpc_tools.protoc --proto_path ${ORCHESTRATION_REPO} --python_out=. --grpc_python_out=. ${ORCHESTRATION_REPO}/module/managed_subscribe/v1/managed_subscribe.proto
 
 # Generates the proto interface for the service discovery
-python -m grpc_tools.protoc --proto_path ${ORCHESTRATION_REPO} --python_out=. --grpc_python_out=. ${ORCHESTRATION_REPO}/service_discovery/v1/service_registry.proto
\ No newline at end of file
+python -m grpc_tools.protoc --proto_path ${ORCHESTRATION_REPO} --python_out=. --grpc_python_out=. ${ORCHESTRATION_REPO}/service_discovery/v1/service_registry.proto
+
+# Generates the proto interface for the risk events sent to the cloud, defined in this repository
+python -m grpc_tools.protoc --proto_path . --python_out=. risk_event/v1/risk_event.proto
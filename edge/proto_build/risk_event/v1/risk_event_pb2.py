@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: risk_event/v1/risk_event.proto
+# Protobuf Python Version: 4.25.1
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x1erisk_event/v1/risk_event.proto\x12\nrisk_event\"\xa6\x01\n\rSignalSamples\x12\x11\n\tsignal_id\x18\x01 \x01(\r\x12\x13\n\x0bsignal_name\x18\x02 \x01(\t\x12\x12\n\x06values\x18\x03 \x03(\x01\x42\x02\x10\x01\x12\x18\n\x0c\x66loat_values\x18\x04 \x03(\x02\x42\x02\x10\x01\x12\x0e\n\x06scalar\x18\x05 \x01(\x08\x12\x17\n\x0b\x62ool_values\x18\x06 \x03(\x08\x42\x02\x10\x01\x12\x16\n\nint_values\x18\x07 \x03(\x11\x42\x02\x10\x01\"\xa3\x01\n\tRiskEvent\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x10\n\x08\x65vent_id\x18\x02 \x01(\r\x12\x12\n\nrisk_level\x18\x03 \x01(\r\x12\x11\n\ttimestamp\x18\x04 \x01(\x01\x12-\n\nevent_data\x18\x05 \x03(\x0b\x32\x19.risk_event.SignalSamples\x12\r\n\x05start\x18\x06 \x01(\x08\x12\x11\n\tsource_id\x18\x07 \x01(\t\"7\n\x0eRiskEventBatch\x12%\n\x06\x65vents\x18\x01 \x03(\x0b\x32\x15.risk_event.RiskEventb\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'risk_event.v1.risk_event_pb2', _globals)
+if _descriptor._USE_C_DESCRIPTORS == False:
+  DESCRIPTOR._options = None
+  _globals['_SIGNALSAMPLES'].fields_by_name['values']._options = None
+  _globals['_SIGNALSAMPLES'].fields_by_name['values']._serialized_options = b'\020\001'
+  _globals['_SIGNALSAMPLES'].fields_by_name['float_values']._options = None
+  _globals['_SIGNALSAMPLES'].fields_by_name['float_values']._serialized_options = b'\020\001'
+  _globals['_SIGNALSAMPLES'].fields_by_name['bool_values']._options = None
+  _globals['_SIGNALSAMPLES'].fields_by_name['bool_values']._serialized_options = b'\020\001'
+  _globals['_SIGNALSAMPLES'].fields_by_name['int_values']._options = None
+  _globals['_SIGNALSAMPLES'].fields_by_name['int_values']._serialized_options = b'\020\001'
+  _globals['_SIGNALSAMPLES']._serialized_start=47
+  _globals['_SIGNALSAMPLES']._serialized_end=213
+  _globals['_RISKEVENT']._serialized_start=216
+  _globals['_RISKEVENT']._serialized_end=379
+  _globals['_RISKEVENTBATCH']._serialized_start=381
+  _globals['_RISKEVENTBATCH']._serialized_end=436
+# @@protoc_insertion_point(module_scope)
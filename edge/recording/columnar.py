@@ -0,0 +1,251 @@
+"""
+SPDX-FileCopyrightText: 2023 Contributors to the Eclipse Foundation
+
+See the NOTICE file(s) distributed with this work for additional
+information regarding copyright ownership.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import csv
+import json
+import mmap
+import struct
+
+import numpy as np
+
+# Binary columnar recording format.
+#
+# A recording holds the same rows as the source_id, signal, timestamp, value CSV, stored as columns that can
+# be memory mapped and used without parsing:
+#
+#   magic (8 bytes) | header length (uint32, little endian) | JSON header | padding | columns
+#
+# The JSON header holds the interned source ids and signal names and the offset, dtype and length of every
+# column. Columns are aligned to 8 bytes:
+#
+# - source_ids, signal_ids: int32 indices into the interned sources and signals
+# - timestamps: float64
+# - values: float64 (or float32 when converted with --float32, which loses precision)
+# - signal_offsets, signal_rows: per signal index. The rows of signal i are signal_rows[signal_offsets[i]:signal_offsets[i + 1]]
+# - source_offsets, source_rows: the same index per source, so the rows of one vehicle are read without scanning
+#   the recording. Recordings converted before it was added are indexed when opened.
+
+COLUMNAR_MAGIC = b"EIREC\x00\x00\x01"
+COLUMNAR_VERSION = 1
+
+# Rows parsed from the CSV before they are packed into arrays
+CONVERT_CHUNK_ROWS = 1 << 20
+
+
+def is_columnar_recording(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+
+def convert_csv_recording(csv_file, output_file, value_dtype="float64"):
+    """
+    Converts a recording in the CSV format into the binary columnar format.
+
+    Returns:
+        The number of rows written
+    """
+    sources = {}
+    signals = {}
+    chunks = {"source_ids": [], "signal_ids": [], "timestamps": [], "values": []}
+
+    def flush(rows):
+        chunks["source_ids"].append(np.array([r[0] for r in rows], dtype=np.int32))
+        chunks["signal_ids"].append(np.array([r[1] for r in rows], dtype=np.int32))
+        chunks["timestamps"].append(np.array([r[2] for r in rows], dtype=np.float64))
+        chunks["values"].append(np.array([r[3] for r in rows], dtype=value_dtype))
+
+    with open(csv_file, newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        # Ignore the first line, which is the header
+        next(reader)
+        rows = []
+        for row in reader:
+            rows.append((
+                sources.setdefault(row[0], len(sources)),
+                signals.setdefault(row[1], len(signals)),
+                float(row[2]),
+                float(row[3])
+            ))
+            if len(rows) == CONVERT_CHUNK_ROWS:
+                flush(rows)
+                rows = []
+        flush(rows)
+
+    columns = {name: np.concatenate(parts) for name, parts in chunks.items()}
+
+    columns["signal_offsets"], columns["signal_rows"] = _row_index(columns["signal_ids"], len(signals))
+    columns["source_offsets"], columns["source_rows"] = _row_index(columns["source_ids"], len(sources))
+
+    write_columnar_recording(output_file, list(sources), list(signals), columns)
+    return len(columns["signal_ids"])
+
+
+def _row_index(ids, count):
+    # Row numbers grouped by id, in recording order, and the offset of the rows of every id
+    rows = np.argsort(ids, kind="stable").astype(np.int64)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=count), out=offsets[1:])
+    return offsets, rows
+
+
+def write_columnar_recording(output_file, sources, signals, columns):
+    # Compute the layout first, the header has to contain the offsets of the columns
+    header = {"version": COLUMNAR_VERSION, "sources": sources, "signals": signals, "columns": {}}
+    header_bytes = b""
+    # The offsets depend on the header size, which depends on the offsets, iterate until stable
+    while True:
+        start = _align(len(COLUMNAR_MAGIC) + 4 + len(header_bytes))
+        offset = start
+        for name, column in columns.items():
+            header["columns"][name] = {"offset": offset, "dtype": column.dtype.str, "length": len(column)}
+            offset = _align(offset + column.nbytes)
+        new_header_bytes = json.dumps(header).encode("utf-8")
+        if _align(len(COLUMNAR_MAGIC) + 4 + len(new_header_bytes)) == start:
+            header_bytes = new_header_bytes
+            break
+        header_bytes = new_header_bytes
+
+    with open(output_file, "wb") as f:
+        f.write(COLUMNAR_MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        for name, column in columns.items():
+            f.write(b"\x00" * (header["columns"][name]["offset"] - f.tell()))
+            f.write(np.ascontiguousarray(column).tobytes())
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+class ColumnarRecording:
+    """
+    A recording in the binary columnar format, memory mapped.
+    The columns are read-only NumPy arrays backed by the file, nothing is parsed or copied when opening it.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+            self.close()
+            raise ValueError(f"{filename} is not a columnar recording.")
+        header_length = struct.unpack_from("<I", self._mmap, len(COLUMNAR_MAGIC))[0]
+        header_start = len(COLUMNAR_MAGIC) + 4
+        header = json.loads(self._mmap[header_start:header_start + header_length].decode("utf-8"))
+        if header["version"] != COLUMNAR_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported columnar recording version {header['version']}.")
+
+        self.sources = header["sources"]
+        self.signals = header["signals"]
+        columns = {
+            name: np.frombuffer(self._mmap, dtype=np.dtype(c["dtype"]), count=c["length"], offset=c["offset"])
+            for name, c in header["columns"].items()
+        }
+        self.source_ids = columns["source_ids"]
+        self.signal_ids = columns["signal_ids"]
+        self.timestamps = columns["timestamps"]
+        self.values = columns["values"]
+        self._signal_offsets = columns["signal_offsets"]
+        self._signal_rows = columns["signal_rows"]
+        if "source_offsets" in columns:
+            self._source_offsets = columns["source_offsets"]
+            self._source_rows = columns["source_rows"]
+        else:
+            self._source_offsets, self._source_rows = _row_index(self.source_ids, len(self.sources))
+
+    def __len__(self):
+        return len(self.signal_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # The arrays keep the map alive, so release them before closing it
+        self.source_ids = self.signal_ids = self.timestamps = self.values = None
+        self._signal_offsets = self._signal_rows = None
+        self._source_offsets = self._source_rows = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Still referenced by arrays handed out to callers, released with them
+            pass
+        self._file.close()
+
+    def signal_rows(self, signal):
+        """
+        Returns the row numbers of all samples of a signal, in recording order.
+        """
+        i = self.signals.index(signal)
+        return self._signal_rows[self._signal_offsets[i]:self._signal_offsets[i + 1]]
+
+    def source_rows(self, source):
+        """
+        Returns the row numbers of all samples of a source (a vehicle), in recording order.
+        """
+        i = self.sources.index(source)
+        return self._source_rows[self._source_offsets[i]:self._source_offsets[i + 1]]
+
+    def rows(self, chunk_rows=65536):
+        """
+        Iterates over the rows as (source_id, signal, timestamp, value) tuples, like the CSV rows after parsing.
+        """
+        for start in range(0, len(self), chunk_rows):
+            end = start + chunk_rows
+            source_ids = self.source_ids[start:end].tolist()
+            signal_ids = self.signal_ids[start:end].tolist()
+            timestamps = self.timestamps[start:end].tolist()
+            values = self.values[start:end].tolist()
+            for source_id, signal_id, timestamp, value in zip(source_ids, signal_ids, timestamps, values):
+                yield self.sources[source_id], self.signals[signal_id], timestamp, value
+
+
+def read_recording_rows(filename):
+    """
+    Iterates over the rows of a recording in either the CSV or the columnar format,
+    as (source_id, signal, timestamp, value) tuples.
+    """
+    if is_columnar_recording(filename):
+        with ColumnarRecording(filename) as recording:
+            yield from recording.rows()
+    else:
+        with open(filename, newline='') as csvfile:
+            reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+            # Ignore the first line, which is the header
+            next(reader)
+            for row in reader:
+                yield row[0], row[1], float(row[2]), float(row[3])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Converts a CSV recording into the binary columnar format")
+    parser.add_argument("csv_file", help="Path to the CSV recording.")
+    parser.add_argument("output_file", help="Path of the columnar recording to write.")
+    parser.add_argument("--float32", dest="float32", action="store_true", help="Store values as float32 instead of float64.")
+    args = parser.parse_args()
+
+    rows = convert_csv_recording(args.csv_file, args.output_file, "float32" if args.float32 else "float64")
+    print(f"Converted {rows} rows from {args.csv_file} to {args.output_file}")
@@ -0,0 +1,66 @@
+"""
+SPDX-FileCopyrightText: 2023 Contributors to the Eclipse Foundation
+
+See the NOTICE file(s) distributed with this work for additional
+information regarding copyright ownership.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+
+import numpy as np
+
+# Synthetic signals shaped like the properties of the DTDL model, used by the benchmarks and the load generator.
+#
+# Every property is updated with its own period of 10-100 ms. Booleans are mostly stable with occasional toggles,
+# integers take values in [-1, 1], the speed follows a slow wave around 110 km/h and the other signals random walks.
+
+
+def generate_signal_columns(twinFile, duration, seed=0, phase=0.0):
+    """
+    Generates duration seconds of updates of every property of the DTDL model. phase shifts the speed wave, in
+    radians, so several generated vehicles do not drive in lockstep.
+
+    Returns:
+        The property names and, in timestamp order, the property index, timestamp and value of every update
+    """
+    rng = np.random.default_rng(seed)
+    with open(twinFile) as f:
+        properties = [c for c in json.load(f)['contents'] if c['@type'] == "Property"]
+
+    signalIds = []
+    timestamps = []
+    values = []
+    for i, prop in enumerate(properties):
+        period = rng.choice([0.01, 0.02, 0.05, 0.1])
+        ts = np.arange(rng.uniform(0, period), duration, period)
+        if prop['schema'] == "boolean":
+            # Mostly stable, with occasional toggles
+            v = (np.cumsum(rng.random(len(ts)) < 0.01) % 2).astype(float)
+        elif prop['schema'] == "integer":
+            v = rng.integers(-1, 2, len(ts)).astype(float)
+        elif prop['name'] == "Vehicle_Speed_Speed":
+            v = np.clip(110 + 90 * np.sin(ts / 30 + phase) + rng.normal(0, 2, len(ts)), 0, None)
+        else:
+            v = np.cumsum(rng.normal(0, 0.3, len(ts)))
+        signalIds.append(np.full(len(ts), i, dtype=np.int32))
+        timestamps.append(ts)
+        values.append(v)
+
+    signalIds = np.concatenate(signalIds)
+    timestamps = np.concatenate(timestamps)
+    values = np.concatenate(values)
+    order = np.argsort(timestamps, kind="stable")
+    return [p['name'] for p in properties], signalIds[order], timestamps[order], values[order]
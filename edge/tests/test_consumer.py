@@ -0,0 +1,137 @@
+import socket
+import threading
+
+import pytest
+
+import proto_build.invehicle_digital_twin.v1.invehicle_digital_twin_pb2 as invehicle_digital_twin_pb2
+from proto_build import consumer
+
+# Checks that the consumer follows a signal whose broker moved while its network loop runs in another thread,
+# subscribing again to all topics on the new broker. The brokers only implement what the consumer uses.
+
+TIMEOUT = 10.0
+
+
+class Broker:
+
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen()
+        self.uri = f"mqtt://127.0.0.1:{self.server.getsockname()[1]}"
+        self.subscribed = []
+        self.unsubscribed = []
+        self.disconnected = threading.Event()
+        self.changed = threading.Condition()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        reader = connection.makefile("rb")
+        while True:
+            header = reader.read(1)
+            if not header:
+                self.disconnected.set()
+                return
+            length, multiplier = 0, 1
+            while True:
+                byte = reader.read(1)[0]
+                length += (byte & 127) * multiplier
+                multiplier *= 128
+                if not byte & 128:
+                    break
+            body = reader.read(length)
+            command = header[0] & 0xF0
+            if command == 0x10:
+                self._send(connection, bytes([0x20, 3, 0, 0, 0]))
+            elif command in (0x80, 0xA0):
+                topics = _topics(body, command == 0x80)
+                with self.changed:
+                    (self.subscribed if command == 0x80 else self.unsubscribed).extend(topics)
+                    self.changed.notify_all()
+                self._send(connection, bytes([command + 0x10, 2 + 1 + len(topics)]) + body[:2] + bytes([0] * (1 + len(topics))))
+            elif command == 0xC0:
+                self._send(connection, bytes([0xD0, 0]))
+            elif command == 0xE0:
+                self.disconnected.set()
+                connection.close()
+                return
+
+    def _send(self, connection, packet):
+        # The client may close the connection right after its last packet
+        try:
+            connection.sendall(packet)
+        except OSError:
+            pass
+
+    def wait_subscribed(self, topics):
+        with self.changed:
+            assert self.changed.wait_for(lambda: set(topics) <= set(self.subscribed), TIMEOUT), self.subscribed
+
+    def close(self):
+        self.server.close()
+
+
+def _topics(body, options):
+    # Packet id and empty properties, then the topic filters, each followed by its options on SUBSCRIBE
+    position = 3
+    topics = []
+    while position < len(body):
+        length = int.from_bytes(body[position:position + 2], "big")
+        topics.append(body[position + 2:position + 2 + length].decode())
+        position += 2 + length + (1 if options else 0)
+    return topics
+
+
+def signal(signalID, topic, broker):
+    return invehicle_digital_twin_pb2.EntityAccessInfo(
+        id=signalID,
+        name=signalID,
+        endpointInfoList=[invehicle_digital_twin_pb2.EndpointInfo(protocol="mqtt_v5", uri=broker.uri, context=topic)]
+    )
+
+
+@pytest.fixture
+def brokers(monkeypatch):
+    monkeypatch.setattr(consumer, "mqttClient", None)
+    monkeypatch.setattr(consumer, "brokerUri", None)
+    monkeypatch.setattr(consumer, "subscriptions", {})
+    monkeypatch.setattr(consumer, "_brokerMoved", threading.Event())
+    monkeypatch.setattr(consumer, "onSubscribe", None)
+    monkeypatch.setattr(consumer, "onUnsubscribe", None)
+    brokers = (Broker(), Broker())
+    yield brokers
+    for broker in brokers:
+        broker.close()
+
+
+def test_follows_moved_broker_from_another_thread(brokers):
+    old, new = brokers
+    consumer.subscribeAll([signal("speed", "Vehicle/Speed/Speed", old), signal("rpm", "Engine/RPM", old)])
+    loop = threading.Thread(target=consumer.loopForever, daemon=True)
+    loop.start()
+    old.wait_subscribed(["Vehicle/Speed/Speed", "Engine/RPM"])
+
+    # As refreshSignals does in the background thread of the discovery cache
+    unsubscribed = []
+    consumer.onUnsubscribe = lambda signalID, topic: unsubscribed.append((signalID, topic))
+    consumer.unsubscribe("speed")
+    consumer.subscribe(signal("speed", "Vehicle/Speed/Kmh", new))
+
+    assert old.disconnected.wait(TIMEOUT)
+    new.wait_subscribed(["Vehicle/Speed/Kmh", "Engine/RPM"])
+    assert "Vehicle/Speed/Speed" not in new.subscribed
+    assert unsubscribed == [("speed", "Vehicle/Speed/Speed")]
+    assert consumer.brokerUri == new.uri
+    assert loop.is_alive()
+
+    consumer.mqttClient.disconnect()
+    loop.join(TIMEOUT)
+    assert not loop.is_alive()
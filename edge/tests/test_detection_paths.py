@@ -0,0 +1,171 @@
+import csv
+import json
+from collections import Counter
+
+import pytest
+
+from applications.insurance_event_detector import backtest, event_definitions, fleet
+from applications.insurance_event_detector.condition_matrix import ConditionMatrix
+from applications.insurance_event_detector.event_definitions import EventDefinition
+from applications.insurance_event_detector.event_detector import Signal, frame_event_detector, group_frames, risk_event_detector, setup_signal_event_index, setup_signal_history, setup_signal_ids, setup_timeout_dict, update_signal_value
+from applications.insurance_event_detector.sharding import ShardedDetector
+from applications.insurance_event_detector.signal_registry import default_registry
+from benchmarks.detection_benchmark import DEFAULT_TWIN_FILE, generate_signal_stream
+from recording.columnar import convert_csv_recording, read_recording_rows
+
+# Replays a synthetic recording through every detection path and checks that they report the same risk events as
+# the streaming detector, with the default event definitions and with events using time windows and event_name
+# conditions.
+
+HIST_SIGNALS = 60
+
+SPEED = "Vehicle_Speed_Speed"
+BRAKE = "Chassis_Brake_Pressed"
+STEERING = "Chassis_SteeringWheel_Angle"
+
+
+def _signal(name, operator, value, method=False, context_length=1):
+    return {"signal_name": name, "method": method, "context_length": context_length, "operator": operator, "value": value}
+
+
+def _window(name, operator, value, method, window):
+    return {"signal_name": name, "method": method, "window": window, "operator": operator, "value": value}
+
+
+def _event(name, operator, value):
+    return {"event_name": name, "operator": operator, "value": value}
+
+
+def create_window_event_dict():
+    return {
+        "fast": EventDefinition("fast", 1, 1, [_window(SPEED, "gt", 110, "mean", 2.0)], [_window(SPEED, "lt", 100, "mean", 2.0)], {SPEED: {"window": 1.0}, STEERING: 3}, 0),
+        "jump": EventDefinition("jump", 2, 1, [_signal(SPEED, "gt", 120), _window(SPEED, "lt", 118, "prev", 0.5)], [], {SPEED: 1, BRAKE: {"window": 0.25}}, 0.3),
+        "span": EventDefinition("span", 3, 1, [_window(STEERING, "gt", 0.5, "max", 1.0), _window(STEERING, "lt", -0.5, "min", 1.0)], [_window(STEERING, "lt", 0.2, "max", 1.0)], {STEERING: 5}, 0),
+        "steer": EventDefinition("steer", 4, 1, [_window(STEERING, "gt", 0.3, "mean", 3.0), _signal(STEERING, "gt", 0.5, "mean", 10)], [_window(STEERING, "lt", 0.0, "mean", 3.0)], {STEERING: {"window": 3.0}}, 0),
+        "combo": EventDefinition("combo", 5, 1, [_event("fast", "eq", 1), _signal(BRAKE, "eq", 1)], [_event("fast", "eq", 0)], {BRAKE: 2}, 0),
+    }
+
+
+EVENT_SETS = [event_definitions.create_event_dict, create_window_event_dict]
+
+
+def synthetic_rows(duration=20, seed=1, source_id="veh-0000"):
+    # Timestamps are rounded to 20 ms, so signals share timestamps and frames hold several signals
+    registry = default_registry()
+    return [
+        (source_id, registry.name_of(signal.id), round(round(signal.timestamp / 0.02) * 0.02, 2), signal.value)
+        for signal in generate_signal_stream(DEFAULT_TWIN_FILE, duration, seed)
+    ]
+
+
+def write_csv(filename, rows):
+    with open(filename, "w", newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(["source_id", "signal", "timestamp", "value"])
+        for source_id, signal, timestamp, value in rows:
+            writer.writerow([source_id, signal, repr(timestamp), repr(value)])
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    filename = tmp_path_factory.mktemp("recording") / "recording.csv"
+    write_csv(filename, synthetic_rows())
+    return str(filename)
+
+
+def serialize(riskEvent):
+    eventData = default_registry().data_by_name(riskEvent.eventData)
+    return (
+        riskEvent.name,
+        riskEvent.eventId,
+        riskEvent.riskLevel,
+        riskEvent.timestamp,
+        json.dumps(eventData, sort_keys=True, default=lambda o: o.tolist()),
+    )
+
+
+def detect_stream(filename, create_event_dict, frames=False, matrix=False):
+    event_dict = create_event_dict()
+    timeout_dict = setup_timeout_dict(event_dict.values())
+    signal_history = setup_signal_history(event_dict, HIST_SIGNALS)
+    signal_event_index = setup_signal_event_index(event_dict)
+    signal_ids = setup_signal_ids(signal_history)
+    conditions = ConditionMatrix(event_dict, signal_history) if matrix else None
+    riskEvents = []
+    callback = lambda riskEvent: riskEvents.append(serialize(riskEvent))
+
+    signals = [Signal(signal_ids[name], value, timestamp) for _, name, timestamp, value in read_recording_rows(filename) if name in signal_ids]
+    if frames:
+        for frame in group_frames(signals):
+            frame_event_detector(event_dict, timeout_dict, frame, signal_history, callback, signal_event_index, conditions)
+    else:
+        for signal in signals:
+            update_signal_value(signal_history, signal)
+            risk_event_detector(event_dict, timeout_dict, signal, signal_history, callback, signal_event_index, conditions)
+    return riskEvents
+
+
+def detect_backtest(filename, create_event_dict, frames=False):
+    riskEvents = []
+    backtest.run_backtest(backtest.load_recording(filename), create_event_dict(), HIST_SIGNALS, lambda riskEvent: riskEvents.append(serialize(riskEvent)), frames)
+    return riskEvents
+
+
+def detect_sharded(filename, create_event_dict, shards=2):
+    riskEvents = []
+    detector = ShardedDetector(lambda riskEvent: riskEvents.append(serialize(riskEvent)), HIST_SIGNALS, shards, create_event_dict=create_event_dict)
+    signal_ids = detector.signal_ids
+    for _, name, timestamp, value in read_recording_rows(filename):
+        if name in signal_ids:
+            detector.submit(signal_ids[name], value, timestamp)
+    detector.close()
+    return riskEvents
+
+
+@pytest.mark.parametrize("create_event_dict", EVENT_SETS)
+@pytest.mark.parametrize("frames", [False, True])
+def test_condition_matrix_matches_stream(recording, create_event_dict, frames):
+    expected = detect_stream(recording, create_event_dict, frames)
+    assert expected
+    assert detect_stream(recording, create_event_dict, frames, matrix=True) == expected
+
+
+@pytest.mark.parametrize("create_event_dict", EVENT_SETS)
+@pytest.mark.parametrize("frames", [False, True])
+def test_backtest_matches_stream(recording, create_event_dict, frames):
+    expected = detect_stream(recording, create_event_dict, frames)
+    assert expected
+    assert detect_backtest(recording, create_event_dict, frames) == expected
+
+
+@pytest.mark.parametrize("create_event_dict", EVENT_SETS)
+def test_sharded_matches_stream(recording, create_event_dict):
+    # The events of different workers interleave, compare them as a multiset
+    expected = detect_stream(recording, create_event_dict)
+    assert expected
+    assert Counter(detect_sharded(recording, create_event_dict)) == Counter(expected)
+
+
+def test_columnar_recording_matches_csv(recording, tmp_path):
+    columnar = str(tmp_path / "recording.rec")
+    convert_csv_recording(recording, columnar)
+    for create_event_dict in EVENT_SETS:
+        assert detect_stream(columnar, create_event_dict) == detect_stream(recording, create_event_dict)
+        assert detect_backtest(columnar, create_event_dict) == detect_backtest(recording, create_event_dict)
+
+
+@pytest.mark.parametrize("frames", [False, True])
+def test_fleet_matches_single_vehicles(tmp_path, frames):
+    vehicles = {"veh-0000": synthetic_rows(10, 1, "veh-0000"), "veh-0001": synthetic_rows(10, 2, "veh-0001")}
+    fleet_file = str(tmp_path / "fleet.csv")
+    write_csv(fleet_file, sorted(vehicles["veh-0000"] + vehicles["veh-0001"], key=lambda row: row[2]))
+
+    riskEvents = {}
+    fleet.process_fleet_file(fleet_file, lambda riskEvent: riskEvents.setdefault(riskEvent.sourceId, []).append(serialize(riskEvent)), HIST_SIGNALS, workers=2, frames=frames)
+
+    for sourceId, rows in vehicles.items():
+        vehicle_file = str(tmp_path / f"{sourceId}.csv")
+        write_csv(vehicle_file, rows)
+        expected = detect_stream(vehicle_file, event_definitions.create_event_dict, frames)
+        assert expected
+        assert riskEvents[sourceId] == expected
@@ -0,0 +1,73 @@
+import pytest
+
+from applications.insurance_event_detector import event_definitions, ingestion
+from applications.insurance_event_detector import main
+from applications.insurance_event_detector.event_detector import setup_signal_event_index, setup_signal_history, setup_signal_ids, setup_timeout_dict, setup_topic_dispatch
+
+# Checks that a message with a bad payload is skipped on its own by the MQTT batch processors of the detector,
+# leaving the rest of its batch and the pending frame as if it had not been received.
+
+SPEED_TOPIC = "Vehicle/Speed/Speed"
+
+
+def setup_detector(monkeypatch):
+    event_dict = event_definitions.create_event_dict()
+    signal_history = setup_signal_history(event_dict, 60)
+    signal_event_index = setup_signal_event_index(event_dict)
+    signal_ids = setup_signal_ids(signal_history)
+    topics = {name.replace("_", "/"): signal_id for name, signal_id in signal_ids.items()}
+    riskEvents = []
+    monkeypatch.setattr(main, "event_dict", event_dict)
+    monkeypatch.setattr(main, "timeout_dict", setup_timeout_dict(event_dict.values()))
+    monkeypatch.setattr(main, "signal_history", signal_history)
+    monkeypatch.setattr(main, "topic_dispatch", setup_topic_dispatch(topics, signal_history, signal_event_index))
+    monkeypatch.setattr(main, "ingestion_queue", ingestion.IngestionQueue(100))
+    monkeypatch.setattr(main, "frame_affected", set())
+    monkeypatch.setattr(main, "frame_timestamp", None)
+    monkeypatch.setattr(main, "sharded_detector", None)
+    monkeypatch.setattr(main, "frames", False)
+    monkeypatch.setattr(main, "risk_event_callback", lambda riskEvent: riskEvents.append((riskEvent.name, riskEvent.timestamp)))
+    return riskEvents
+
+
+def speed_batch(values, start=0.0):
+    return [(SPEED_TOPIC, str(value).encode(), round(start + i * 0.1, 3)) for i, value in enumerate(values)]
+
+
+def run(monkeypatch, batch, frames):
+    riskEvents = setup_detector(monkeypatch)
+    main.frames = frames
+    main.process_mqtt_batch(batch)
+    if frames:
+        main.flush_mqtt_frame()
+    speed = main.topic_dispatch[SPEED_TOPIC][0].last_n(10).tolist()
+    return riskEvents, speed, main.ingestion_queue.metrics()["invalid"]
+
+
+@pytest.mark.parametrize("frames", [False, True])
+def test_bad_payload_skips_only_its_message(monkeypatch, frames):
+    batch = speed_batch([100, 120, 140, 160, 180, 190])
+    expected = run(monkeypatch, batch, frames)
+    assert expected[0]
+    assert expected[2] == 0
+    # The bad message shares the timestamp of the frame before it
+    bad = batch[:3] + [(SPEED_TOPIC, b"not a number", batch[2][2])] + batch[3:]
+    assert run(monkeypatch, bad, frames) == (expected[0], expected[1], 1)
+
+
+def test_bad_payload_in_sharded_mode(monkeypatch):
+    setup_detector(monkeypatch)
+    submitted = []
+
+    class Detector:
+
+        def submit(self, signal_id, value, timestamp):
+            submitted.append(value)
+
+        def publish(self):
+            pass
+
+    monkeypatch.setattr(main, "sharded_detector", Detector())
+    main.process_mqtt_batch(speed_batch([1, 2]) + [(SPEED_TOPIC, b"", 0.3)] + speed_batch([3], 0.4))
+    assert submitted == [1.0, 2.0, 3.0]
+    assert main.ingestion_queue.metrics()["invalid"] == 1
@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+
+from applications.insurance_event_detector.event_definitions import EventDefinition
+from applications.insurance_event_detector.event_detector import setup_signal_history
+from applications.insurance_event_detector.signal_history import SignalBuffer, TimedSignalBuffer
+
+# Checks the ring buffers of the signal history and their incremental aggregates against the same values computed
+# from a plain list of all samples.
+
+AGGREGATES = {"mean": np.mean, "min": np.min, "max": np.max}
+
+
+def assert_same(got, expected):
+    assert (np.isnan(got) and np.isnan(expected)) or got == pytest.approx(expected, abs=1e-9)
+
+
+def random_values(rng, n, nan_rate=0.01):
+    values = rng.normal(0, 10, n)
+    values[rng.random(n) < nan_rate] = np.nan
+    return values.tolist()
+
+
+def test_signal_buffer_wraps_around():
+    buffer = SignalBuffer(4)
+    values = [float(i) for i in range(11)]
+    for i, value in enumerate(values):
+        buffer.append(value)
+        assert len(buffer) == min(i + 1, 4)
+        assert buffer.last() == value
+        assert buffer.last_n(4).tolist() == values[max(0, i - 3):i + 1]
+        for n in range(1, len(buffer) + 1):
+            assert buffer.back(n) == values[i + 1 - n]
+
+
+def test_signal_buffer_last_n_is_read_only_view():
+    buffer = SignalBuffer(3)
+    buffer.append(1.0)
+    view = buffer.last_n(3)
+    assert view.tolist() == [1.0]
+    with pytest.raises(ValueError):
+        view[0] = 2.0
+
+
+def test_signal_buffer_bounds():
+    with pytest.raises(ValueError):
+        SignalBuffer(0)
+    buffer = SignalBuffer(2)
+    with pytest.raises(IndexError):
+        buffer.last()
+    buffer.append(1.0)
+    with pytest.raises(IndexError):
+        buffer.back(2)
+    with pytest.raises(IndexError):
+        buffer.back(0)
+    buffer.clear()
+    assert len(buffer) == 0
+    assert buffer.last_n(2).tolist() == []
+
+
+def test_signal_buffer_generation_changes():
+    buffer = SignalBuffer(2)
+    generations = {buffer.generation}
+    buffer.append(1.0)
+    generations.add(buffer.generation)
+    buffer.clear()
+    generations.add(buffer.generation)
+    assert len(generations) == 3
+    assert buffer.generation != SignalBuffer(2).generation
+
+
+@pytest.mark.parametrize("window", [1, 3, 10])
+def test_rolling_aggregates_match_recomputation(window):
+    rng = np.random.default_rng(window)
+    buffer = SignalBuffer(10)
+    values = random_values(rng, 200)
+    # Registered after some samples, the aggregates catch up with the values already in the buffer
+    for value in values[:5]:
+        buffer.append(value)
+    for method in AGGREGATES:
+        buffer.add_aggregate(method, window)
+    for i, value in enumerate(values[5:], 5):
+        buffer.append(value)
+        recent = np.array(values[max(0, i + 1 - window):i + 1])
+        for method, aggregate in AGGREGATES.items():
+            assert_same(getattr(buffer, method)(window), aggregate(recent))
+
+
+def test_rolling_aggregates_after_clear():
+    buffer = SignalBuffer(5)
+    for method in AGGREGATES:
+        buffer.add_aggregate(method, 3)
+    for value in (np.nan, 1.0, 2.0):
+        buffer.append(value)
+    buffer.clear()
+    for value in (4.0, 6.0):
+        buffer.append(value)
+    assert buffer.mean(3) == 5.0
+    assert buffer.min(3) == 4.0
+    assert buffer.max(3) == 6.0
+
+
+def test_add_aggregate_validation():
+    buffer = SignalBuffer(5)
+    assert buffer.add_aggregate("mean", 3) is buffer.add_aggregate("mean", 3)
+    with pytest.raises(ValueError):
+        buffer.add_aggregate("mean", 6)
+    with pytest.raises(ValueError):
+        buffer.add_aggregate("median", 3)
+
+
+def test_timed_signal_buffer_matches_recomputation():
+    rng = np.random.default_rng(5)
+    buffer = TimedSignalBuffer(5, 2.0)
+    for method in AGGREGATES:
+        buffer.add_time_aggregate(method, 1.5)
+    buffer.add_aggregate("mean", 3)
+    timestamps = []
+    values = []
+    timestamp = 0.0
+    for i in range(3000):
+        # Several samples can share a timestamp
+        timestamp += float(rng.choice([0, 0.01, 0.1, 0.5]))
+        value = float(rng.normal()) if rng.random() > 0.01 else np.nan
+        buffer.append(value, timestamp)
+        timestamps.append(timestamp)
+        values.append(value)
+        all_timestamps = np.array(timestamps)
+        all_values = np.array(values)
+
+        window = all_values[all_timestamps > timestamp - 1.5]
+        for method, aggregate in AGGREGATES.items():
+            assert_same(getattr(buffer, method + "_over")(1.5), aggregate(window))
+        assert np.array_equal(buffer.window_values(1.5), window, equal_nan=True)
+        assert buffer.covers(1.9) == (all_timestamps[0] <= timestamp - 1.9)
+        if buffer.covers(1.9):
+            position = np.searchsorted(all_timestamps, timestamp - 1.9, side='right') - 1
+            assert_same(buffer.value_at(timestamp - 1.9), all_values[position])
+        assert_same(buffer.mean(3), np.mean(all_values[-3:]))
+        assert np.array_equal(buffer.last_n(5), all_values[-5:], equal_nan=True)
+        assert buffer.last_timestamp == timestamp
+    # Memory is bounded by the retention, not by the number of samples appended
+    assert len(buffer._values) < 1000
+
+
+def test_timed_signal_buffer_validation():
+    with pytest.raises(ValueError):
+        TimedSignalBuffer(5, 0)
+    buffer = TimedSignalBuffer(5, 2.0)
+    with pytest.raises(ValueError):
+        buffer.append(1.0)
+    with pytest.raises(ValueError):
+        buffer.add_time_aggregate("mean", 3.0)
+    with pytest.raises(ValueError):
+        buffer.add_time_aggregate("median", 1.0)
+    assert not buffer.covers(0)
+    buffer.append(1.0, 10.0)
+    with pytest.raises(IndexError):
+        buffer.value_at(9.0)
+    assert buffer.value_at(10.0) == 1.0
+
+
+def test_context_length_beyond_history_is_rejected():
+    condition = {"signal_name": "Vehicle_Speed_Speed", "method": "mean", "context_length": 61, "operator": "gt", "value": 100}
+    event_dict = {"fast": EventDefinition("fast", 1, 1, [condition], [], {}, 0)}
+    with pytest.raises(ValueError):
+        setup_signal_history(event_dict, 60)
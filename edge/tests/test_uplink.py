@@ -0,0 +1,193 @@
+import os
+import struct
+import zlib
+
+from applications.insurance_event_detector import uplink
+from applications.insurance_event_detector.event_detector import RiskEvent
+from applications.insurance_event_detector.uplink import Spool, Uplink, decode_batch
+
+# Checks that spooled batches survive restarts and crashes: a partially written record at the end of the file,
+# an acknowledgement written just before the file was compacted, and spools of earlier versions without header.
+
+PAYLOADS = [bytes([i]) * (10 + i) for i in range(8)]
+
+
+def pending(spool):
+    """
+    Returns the unacknowledged payloads without acknowledging them.
+    """
+    payloads = []
+    ack_offset = spool.ack_offset
+    while True:
+        record = spool.next_record()
+        if record is None:
+            break
+        payloads.append(record[0])
+        spool.ack_offset = record[1]
+    spool.ack_offset = ack_offset
+    return payloads
+
+
+def drain(spool):
+    payloads = []
+    while True:
+        record = spool.next_record()
+        if record is None:
+            return payloads
+        payloads.append(record[0])
+        spool.acknowledge(record[1])
+
+
+def test_restart_keeps_unacknowledged_batches(tmp_path):
+    spool = Spool(tmp_path)
+    for payload in PAYLOADS[:5]:
+        spool.append(payload)
+    for _ in range(2):
+        spool.acknowledge(spool.next_record()[1])
+    spool.close()
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[2:5]
+    assert drain(spool) == PAYLOADS[2:5]
+    # Once everything is acknowledged, only the header is left
+    assert os.path.getsize(spool.spool_file) == struct.calcsize("<8sQ")
+    spool.append(PAYLOADS[5])
+    spool.close()
+
+    spool = Spool(tmp_path)
+    assert drain(spool) == [PAYLOADS[5]]
+    spool.close()
+
+
+def test_truncated_trailing_record_is_discarded(tmp_path):
+    spool = Spool(tmp_path)
+    for payload in PAYLOADS[:3]:
+        spool.append(payload)
+    spool.close()
+    # Crash while appending: the header announces more bytes than were written
+    with open(tmp_path / uplink.SPOOL_FILE, "ab") as f:
+        f.write(struct.pack("<II", 100, 0) + b"partial")
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[:3]
+    spool.append(PAYLOADS[3])
+    spool.close()
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[:4]
+    spool.close()
+
+
+def test_corrupt_trailing_record_is_discarded(tmp_path):
+    spool = Spool(tmp_path)
+    for payload in PAYLOADS[:2]:
+        spool.append(payload)
+    spool.close()
+    with open(tmp_path / uplink.SPOOL_FILE, "ab") as f:
+        f.write(struct.pack("<II", 4, zlib.crc32(b"full")) + b"fuII")
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[:2]
+    spool.close()
+
+
+def test_compaction(tmp_path):
+    spool = Spool(tmp_path, compact_bytes=30)
+    for payload in PAYLOADS:
+        spool.append(payload)
+    size = os.path.getsize(spool.spool_file)
+    spool.acknowledge(spool.next_record()[1])
+    assert os.path.getsize(spool.spool_file) == size
+    spool.acknowledge(spool.next_record()[1])
+    assert os.path.getsize(spool.spool_file) < size
+    assert pending(spool) == PAYLOADS[2:]
+    spool.append(b"new")
+    spool.close()
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[2:] + [b"new"]
+    spool.close()
+
+
+def test_crash_between_acknowledgement_and_compaction(tmp_path):
+    spool = Spool(tmp_path, compact_bytes=30)
+    for payload in PAYLOADS:
+        spool.append(payload)
+    # The acknowledged offset is written before the file is compacted
+    spool._write_ack_offset(spool.next_record()[1])
+    spool.close()
+
+    spool = Spool(tmp_path, compact_bytes=30)
+    assert pending(spool) == PAYLOADS[1:]
+    spool.acknowledge(spool.next_record()[1])
+    spool.close()
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[2:]
+    spool.close()
+
+
+def test_oldest_batches_are_dropped(tmp_path):
+    spool = Spool(tmp_path, max_bytes=60)
+    for i, payload in enumerate(PAYLOADS):
+        spool.append(payload)
+        if i == 0:
+            in_flight = spool.next_record()
+    assert spool.pending_bytes() <= 60
+    assert pending(spool) == PAYLOADS[-2:]
+    assert spool.dropped_batches == 6
+    # Acknowledging a batch that was dropped while it was sent changes nothing
+    spool.acknowledge(in_flight[1])
+    assert pending(spool) == PAYLOADS[-2:]
+    spool.close()
+
+    spool = Spool(tmp_path, max_bytes=60)
+    assert pending(spool) == PAYLOADS[-2:]
+    spool.close()
+
+
+def test_newest_batch_is_kept(tmp_path):
+    spool = Spool(tmp_path, max_bytes=5)
+    spool.append(PAYLOADS[7])
+    assert pending(spool) == [PAYLOADS[7]]
+    spool.close()
+
+
+def test_spool_without_header(tmp_path):
+    with open(tmp_path / uplink.SPOOL_FILE, "wb") as f:
+        for payload in PAYLOADS[:3]:
+            f.write(struct.pack("<II", len(payload), zlib.crc32(payload)) + payload)
+    with open(tmp_path / uplink.ACK_FILE, "w") as f:
+        f.write(str(8 + len(PAYLOADS[0])))
+
+    spool = Spool(tmp_path)
+    assert pending(spool) == PAYLOADS[1:3]
+    assert drain(spool) == PAYLOADS[1:3]
+    spool.close()
+
+    spool = Spool(tmp_path)
+    assert spool.next_record() is None
+    spool.close()
+
+
+def test_uplink_retries_until_delivered(tmp_path):
+    sent = []
+    attempts = []
+
+    def send(payload):
+        attempts.append(payload)
+        if len(attempts) <= 2:
+            raise ConnectionError("offline")
+        sent.append(payload)
+
+    link = Uplink(tmp_path, send, max_batch_events=2, max_batch_delay=0.05, retry_interval=0.01)
+    for i in range(5):
+        link.submit(RiskEvent("speeding", 1, 1, float(i), {}))
+    link.close()
+
+    assert [event["timestamp"] for payload in sent for event in decode_batch(payload)] == [0.0, 1.0, 2.0, 3.0, 4.0]
+    metrics = link.metrics()
+    assert metrics["batches"] == 3
+    assert metrics["sent_batches"] == 3
+    assert metrics["failed_sends"] == 2
+    assert metrics["spool_bytes"] == 0